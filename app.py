@@ -1,6 +1,7 @@
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, Response, stream_with_context
 import requests
 import os
+import json
 import re
 import markdown
 import io
@@ -15,6 +16,23 @@ from reportlab.pdfgen import canvas
 import base64
 from dotenv import load_dotenv
 import logging
+import threading
+import time
+import hashlib
+import zlib
+import unicodedata
+import sqlite3
+import socket
+import select
+import uuid
+import random
+import math
+from collections import OrderedDict, deque
+import queue
+from contextlib import contextmanager, nullcontext
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 # Configuration du logging
 logging.basicConfig(
@@ -64,10 +82,165 @@ app = Flask(__name__)
 # ============================================
 
 # API Configuration
-API_TIMEOUT = 60  # secondes
+API_TIMEOUT = 60  # secondes par appel amont (moins s'il reste moins de temps avant l'échéance, voir REQUEST_TIMEOUTS)
 API_MAX_TOKENS = 3000
 API_TEMPERATURE = 0.3
-MAX_NOTES_LENGTH = 50000  # caractères (50KB max pour les notes)
+MAX_NOTES_LENGTH = 50000  # caractères (50KB max pour les notes en un seul appel)
+
+# Notes longues : condensé par morceaux en parallèle (map) puis passe finale du template (reduce)
+MAP_REDUCE_ENABLED = os.getenv('MAP_REDUCE_ENABLED', 'true').lower() == 'true'
+LONG_NOTES_MAX_LENGTH = int(os.getenv('LONG_NOTES_MAX_LENGTH', 1000000))  # caractères
+MAP_REDUCE_CHUNK_SIZE = int(os.getenv('MAP_REDUCE_CHUNK_SIZE', 12000))  # caractères par morceau
+MAP_REDUCE_CONCURRENCY = int(os.getenv('MAP_REDUCE_CONCURRENCY', 4))
+MAP_REDUCE_CHUNK_MAX_TOKENS = 1500
+MAP_REDUCE_MAX_PASSES = 3  # au-delà, condensé encore trop long : erreur 413
+MAP_REDUCE_DIGEST_CACHE_SIZE = 16  # condensés gardés en mémoire (mêmes notes, autres templates)
+
+# Génération par sections en parallèle pour les templates longs et structurés (opt-in)
+SECTIONS_PARALLEL_ENABLED = os.getenv('SECTIONS_PARALLEL_ENABLED', 'false').lower() == 'true'
+SECTIONS_PARALLEL_TEMPLATES = [t.strip() for t in os.getenv(
+    'SECTIONS_PARALLEL_TEMPLATES', 'hpp_audit,dat,bilan_tma,specifications_techniques,procedure_exploitation'
+).split(',') if t.strip()]
+SECTIONS_CONCURRENCY = int(os.getenv('SECTIONS_CONCURRENCY', 6))
+SECTIONS_CONSISTENCY_PASS = os.getenv('SECTIONS_CONSISTENCY_PASS', 'true').lower() == 'true'
+SECTION_MAX_TOKENS = 1200
+CONSISTENCY_MAX_TOKENS = 800
+
+# Marqueur de fin des comptes rendus Markdown, envoyé comme séquence d'arrêt au provider :
+# aucun commentaire final n'est généré
+REPORT_STOP_SEQUENCES_ENABLED = os.getenv('REPORT_STOP_SEQUENCES_ENABLED', 'true').lower() == 'true'
+REPORT_END_MARKER = '<<FIN>>'
+# Flux abandonné avant sa fin (marqueur reçu, rapport terminé) : la suite est lue sans être relayée
+# jusqu'au bloc usage final (tokens en cache), au plus ce nombre de secondes
+REPORT_USAGE_DRAIN_SECONDS = float(os.getenv('REPORT_USAGE_DRAIN_SECONDS', 3))
+
+# Sortie structurée (JSON) : arbre de sections typé au lieu de Markdown (opt-in, ou "structured": true)
+STRUCTURED_OUTPUT_ENABLED = os.getenv('STRUCTURED_OUTPUT_ENABLED', 'false').lower() == 'true'
+
+# Budget de tokens et choix du modèle (petit / moyen / grand) selon la taille de la demande (opt-in)
+BUDGET_ENABLED = os.getenv('BUDGET_ENABLED', 'false').lower() == 'true'
+# {"mistral": {"small": "...", "medium": "...", "large": "..."}} : complète DEFAULT_MODEL_TIERS
+MODEL_TIERS = json.loads(os.getenv('MODEL_TIERS', '{}') or '{}')
+BUDGET_SMALL_MAX_TOKENS = int(os.getenv('BUDGET_SMALL_MAX_TOKENS', 2000))  # entrée + sortie estimées
+BUDGET_LARGE_MIN_TOKENS = int(os.getenv('BUDGET_LARGE_MIN_TOKENS', 12000))
+# {"hpp_audit": "large"} : gamme imposée par template, quelle que soit la taille
+BUDGET_TEMPLATE_TIERS = json.loads(os.getenv('BUDGET_TEMPLATE_TIERS', '{}') or '{}')
+BUDGET_OUTPUT_MARGIN = float(os.getenv('BUDGET_OUTPUT_MARGIN', 1.3))  # marge sur le p95 des sorties observées
+BUDGET_MIN_OUTPUT_TOKENS = 512
+BUDGET_MIN_SAMPLES = 5  # en dessous, la sortie attendue est API_MAX_TOKENS
+BUDGET_ECHO_TEMPLATES = ('correction_orthographe',)  # sortie proportionnelle aux notes
+
+# Ollama : préchargement des modèles, maintien en mémoire et taille de contexte par demande
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', '')  # modèle des comptes rendus générés avec Ollama
+OLLAMA_PRELOAD_MODELS = [m.strip() for m in os.getenv('OLLAMA_PRELOAD_MODELS', OLLAMA_MODEL).split(',') if m.strip()]
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')  # durée Ollama ("30m", "2h"), secondes ou -1 (permanent)
+# Ollama lit une chaîne comme une durée Go ("-1" est refusé faute d'unité) : un nombre part en entier
+if re.fullmatch(r'-?\d+', OLLAMA_KEEP_ALIVE.strip()):
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)
+OLLAMA_NUM_CTX = int(os.getenv('OLLAMA_NUM_CTX', 8192))  # contexte par défaut (et du préchargement)
+OLLAMA_MAX_CTX = int(os.getenv('OLLAMA_MAX_CTX', 32768))
+OLLAMA_CTX_MARGIN = 1.2  # marge sur l'estimation à 4 caractères par token
+OLLAMA_PRELOAD_TIMEOUT = 300  # secondes (chargement d'un gros modèle sur disque lent)
+
+# Ollama : créneaux d'exécution côté SmartReport (mêmes valeurs que le serveur Ollama)
+OLLAMA_NUM_PARALLEL = int(os.getenv('OLLAMA_NUM_PARALLEL', 1))  # demandes simultanées par modèle
+OLLAMA_MAX_LOADED_MODELS = int(os.getenv('OLLAMA_MAX_LOADED_MODELS', 1))  # modèles actifs simultanément
+OLLAMA_QUEUE_SIZE = int(os.getenv('OLLAMA_QUEUE_SIZE', 50))  # demandes en attente, tous modèles confondus
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv('OLLAMA_QUEUE_TIMEOUT', 600))  # secondes d'attente maximum
+# Petites demandes (diagrammes, notes courtes) : modèles de repli, la file la plus courte est retenue
+OLLAMA_SMALL_JOB_TOKENS = int(os.getenv('OLLAMA_SMALL_JOB_TOKENS', 2000))
+OLLAMA_SMALL_JOB_MODELS = [m.strip() for m in os.getenv('OLLAMA_SMALL_JOB_MODELS', '').split(',') if m.strip()]
+OLLAMA_QUEUE_POLL = 1.0  # secondes entre deux publications de la position dans la file
+
+# Déconnexion du client : les appels amont de la requête abandonnée sont coupés
+CLIENT_DISCONNECT_POLL = 0.5  # secondes entre deux vérifications des connexions clientes
+
+# Échéance de bout en bout : files d'attente, nouvelles tentatives et appels amont se partagent
+# le temps restant (en-tête X-Request-Timeout en secondes, sinon délai par défaut de l'endpoint)
+REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout'
+REQUEST_TIMEOUT_MAX = float(os.getenv('REQUEST_TIMEOUT_MAX', 1800))  # secondes
+REQUEST_TIMEOUTS = {
+    'diagram': float(os.getenv('REQUEST_TIMEOUT_DIAGRAM', 120)),
+    'report': float(os.getenv('REQUEST_TIMEOUT_REPORT', 300)),
+    'report_stream': float(os.getenv('REQUEST_TIMEOUT_STREAM', 600)),
+    'batch': float(os.getenv('REQUEST_TIMEOUT_BATCH', 1800)),
+    'job': float(os.getenv('REQUEST_TIMEOUT_JOB', 1800)),  # travail asynchrone, depuis sa prise en charge
+}
+
+# Pool de connexions HTTP vers les providers IA (keep-alive)
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 4))  # hôtes distincts gardés en cache
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 16))  # connexions simultanées par hôte
+HTTP_WARMUP_TIMEOUT = 5  # secondes
+
+# Cache disque des comptes rendus générés
+REPORT_CACHE_ENABLED = os.getenv('REPORT_CACHE_ENABLED', 'true').lower() == 'true'
+REPORT_CACHE_DIR = os.getenv('REPORT_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'reports'))
+REPORT_CACHE_MAX_BYTES = int(os.getenv('REPORT_CACHE_MAX_MB', 50)) * 1024 * 1024
+REPORT_CACHE_TTL = int(os.getenv('REPORT_CACHE_TTL', 24 * 3600))  # secondes
+
+# Cache des diagrammes Mermaid (mémoire, persistance optionnelle dans un fichier JSON)
+DIAGRAM_CACHE_MAX_ENTRIES = int(os.getenv('DIAGRAM_CACHE_MAX_ENTRIES', 500))
+DIAGRAM_CACHE_FILE = os.getenv('DIAGRAM_CACHE_FILE', '')
+
+# Génération par lots
+BATCH_MAX_ITEMS = 100
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', 4))
+
+# Brouillons spéculatifs générés pendant la saisie des notes (opt-in)
+SPECULATE_ENABLED = os.getenv('SPECULATE_ENABLED', 'false').lower() == 'true'
+SPECULATE_MAX_CONCURRENCY = int(os.getenv('SPECULATE_MAX_CONCURRENCY', 2))  # tous utilisateurs confondus
+SPECULATE_MAX_PER_USER = int(os.getenv('SPECULATE_MAX_PER_USER', 1))  # brouillons en cours par utilisateur
+SPECULATE_USER_TOKEN_BUDGET = int(os.getenv('SPECULATE_USER_TOKEN_BUDGET', 100000))  # tokens estimés par fenêtre
+SPECULATE_BUDGET_WINDOW = 3600  # secondes
+SPECULATE_MAX_LOAD = int(os.getenv('SPECULATE_MAX_LOAD', 2))  # générations réelles en cours au-delà desquelles on s'abstient
+SPECULATE_MIN_CHANGE_CHARS = int(os.getenv('SPECULATE_MIN_CHANGE_CHARS', 200))  # changement relançant un brouillon
+SPECULATE_MIN_CHANGE_RATIO = 0.1  # ... ou 10 % des notes
+SPECULATE_DRAFT_TTL = 1800  # secondes sans nouvel instantané avant l'oubli d'un brouillon
+
+# Hedging : requête de secours vers un second provider quand le premier tarde (opt-in)
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+HEDGE_PROVIDERS = [p.strip() for p in os.getenv('HEDGE_PROVIDERS', '').split(',') if p.strip()]
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))
+HEDGE_MIN_SAMPLES = 5  # en dessous, HEDGE_DEFAULT_DELAY s'applique
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 10))  # secondes
+HEDGE_MIN_DELAY = 1.0  # secondes
+
+# Limitation de débit côté client, par provider : {"mistral": {"rpm": 60, "tpm": 500000}}
+# Sans configuration, le débit s'ajuste sur les en-têtes Retry-After / x-ratelimit-* des réponses
+RATE_LIMITS = json.loads(os.getenv('RATE_LIMITS', '{}') or '{}')
+RATE_LIMIT_QUEUE_SIZE = int(os.getenv('RATE_LIMIT_QUEUE_SIZE', 50))  # demandes en attente par provider
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 30))  # secondes d'attente maximum
+RATE_LIMIT_DEFAULT_BACKOFF = 2.0  # secondes, si le provider n'indique pas de délai
+
+# Nouvelles tentatives (erreurs transitoires) et disjoncteur par provider
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', 2))  # tentatives supplémentaires
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 0.5))  # secondes
+RETRY_MAX_DELAY = 8.0  # secondes
+RETRY_STATUSES = (502, 503, 504)
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))  # échecs consécutifs
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', 30))  # secondes avant appel test
+
+# Routage automatique vers le provider le plus rapide parmi les providers sains (opt-in)
+ROUTING_ENABLED = os.getenv('ROUTING_ENABLED', 'false').lower() == 'true'
+ROUTER_PROVIDERS = [p.strip() for p in os.getenv('ROUTER_PROVIDERS', '').split(',') if p.strip()]
+# Providers autorisés par template, ex: {"hpp_audit": ["mistral", "openai"], "*": ["mistral"]}
+ROUTER_TEMPLATE_PROVIDERS = json.loads(os.getenv('ROUTER_TEMPLATE_PROVIDERS', '{}') or '{}')
+ROUTER_PROBE_INTERVAL = int(os.getenv('ROUTER_PROBE_INTERVAL', 30))  # secondes
+ROUTER_EWMA_ALPHA = 0.3
+ROUTER_MAX_ERROR_RATE = 0.5  # au-delà, le provider est considéré dégradé
+
+# File de travaux asynchrones (SQLite WAL partagé entre processus)
+JOBS_DB_PATH = os.getenv('JOBS_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'jobs.sqlite3'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))  # 0 = ce processus ne consomme pas la file
+JOB_MAX_ATTEMPTS = 3
+JOB_LEASE_SECONDS = API_TIMEOUT * 3  # bail non renouvelé au-delà : travail 'running' considéré orphelin
+JOB_HEARTBEAT_INTERVAL = 5  # secondes : renouvellement du bail et détection des annulations
+JOB_POLL_INTERVAL = 0.5  # secondes
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', 24 * 3600))  # secondes
+
+# Génération Mermaid streamée : au-delà de ce nombre de caractères sans en-tête de
+# diagramme, la réponse est considérée comme de la prose et l'appel est interrompu
+MERMAID_PROSE_ABORT_CHARS = int(os.getenv('MERMAID_PROSE_ABORT_CHARS', 300))
 
 # PDF Configuration
 PDF_DEFAULT_FONT_SIZE = 10
@@ -93,6 +266,22 @@ config = {
     'gemini_api_key': os.getenv('GEMINI_API_KEY', ''),
 }
 
+# Modèles par défaut selon le provider
+DEFAULT_MODELS = {
+    'mistral': 'mistral-medium-latest',
+    'openai': 'gpt-4-turbo-preview',
+    'deepseek': 'deepseek-chat',
+    'gemini': 'gemini-pro'
+}
+if OLLAMA_MODEL:
+    DEFAULT_MODELS['ollama'] = OLLAMA_MODEL
+
+# Gammes de modèles par provider pour le budget de tokens (la gamme moyenne reste DEFAULT_MODELS)
+DEFAULT_MODEL_TIERS = {
+    'mistral': {'small': 'mistral-small-latest', 'medium': 'mistral-medium-latest', 'large': 'mistral-large-latest'},
+    'openai': {'small': 'gpt-4o-mini', 'medium': 'gpt-4-turbo-preview', 'large': 'gpt-4o'},
+}
+
 SYSTEM_PROMPT = """Tu convertis une description FR/EN en code Mermaid v10 **valide**.
 Règles :
 - Détecte type pertinent : flowchart, sequence, class, state, er, gantt, architecture.
@@ -128,6 +317,27 @@ graph TB
     style Server fill:#fff4e6
     style B fill:#fef3c7"""
 
+# Aliases de templates pour rétrocompatibilité (migration des anciens IDs)
+TEMPLATE_ALIASES = {
+    'audit_technique': 'hpp_audit',
+    'intervention_technique': 'hpp_intervention'
+}
+
+# Patterns Mermaid courants (en-têtes de diagramme)
+MERMAID_PATTERNS = [
+    r'flowchart\s+(TD|LR|TB|RL|BT)',
+    r'sequenceDiagram',
+    r'classDiagram',
+    r'stateDiagram',
+    r'erDiagram',
+    r'gantt',
+    r'pie\s+(title|showData)',
+    r'graph\s+(TD|LR|TB|RL|BT)',
+    r'journey',
+    r'gitGraph',
+    r'gitgraph'
+]
+
 # Prompts pour génération de comptes rendus
 REPORT_PROMPTS = {
     'client_formel': """Tu es un chef de projet / responsable relation client chez ENOVACOM.
@@ -3629,6 +3839,583 @@ IMPORTANT : Markdown pur. Commence par ## Classification des Livrables.
 Ton rôle : créer un document de classification complet."""
 }
 
+# ============================================
+# CLIENTS HTTP DES PROVIDERS IA
+# ============================================
+
+# Une session requests (pool keep-alive) par couple (provider, base_url)
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(provider, base_url=None):
+    """Retourne la session HTTP mutualisée pour un provider (créée à la demande)"""
+    if base_url is None:
+        base_url = config.get(f'{provider}_base_url', '')
+    key = (provider, base_url.rstrip('/'))
+    with _http_sessions_lock:
+        session = _http_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[key] = session
+            logger.info(f"Pool HTTP créé pour {provider} ({key[1]})")
+        return session
+
+def reset_http_sessions(provider):
+    """Ferme les pools d'un provider (changement d'URL ou de clé) et réchauffe le nouveau"""
+    with _http_sessions_lock:
+        stale = [key for key in _http_sessions if key[0] == provider]
+        sessions = [_http_sessions.pop(key) for key in stale]
+    for session in sessions:
+        session.close()
+    if stale:
+        logger.info(f"Pools HTTP {provider} reconstruits")
+    warm_http_sessions([provider], background=True)
+    if provider == 'ollama':
+        preload_ollama_models(background=True)
+
+def warm_http_sessions(providers=None, background=False):
+    """Ouvre à l'avance les connexions TCP/TLS vers les providers configurés"""
+    if providers is None:
+        providers = [config.get('active_provider', 'mistral')]
+        providers += [p for p in ('mistral', 'openai', 'deepseek', 'gemini')
+                      if p not in providers and config.get(f'{p}_api_key')]
+
+    def _warm():
+        for provider in providers:
+            base_url = config.get(f'{provider}_base_url', '')
+            if not base_url:
+                continue
+            try:
+                # Le code retour importe peu : seule la connexion établie nous intéresse
+                get_http_session(provider, base_url).head(base_url, timeout=HTTP_WARMUP_TIMEOUT, allow_redirects=False)
+                logger.info(f"Connexion {provider} préchauffée")
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Préchauffage {provider} impossible: {e}")
+
+    if background:
+        threading.Thread(target=_warm, daemon=True).start()
+    else:
+        _warm()
+
+# ============================================
+# OLLAMA (PRÉCHARGEMENT ET TAILLE DE CONTEXTE)
+# ============================================
+
+def ollama_context_size(prompt_tokens, num_predict):
+    """num_ctx d'une demande Ollama : prompt + sortie, avec OLLAMA_NUM_CTX comme plancher.
+
+    Ollama recharge le modèle dès que num_ctx change : les demandes qui tiennent dans
+    OLLAMA_NUM_CTX gardent cette valeur (celle du préchargement) et les autres passent à
+    la puissance de deux supérieure, plafonnée par OLLAMA_MAX_CTX.
+    """
+    needed = int((prompt_tokens + num_predict) * OLLAMA_CTX_MARGIN)
+    size = OLLAMA_NUM_CTX
+    while size < needed and size < OLLAMA_MAX_CTX:
+        size *= 2
+    if needed > OLLAMA_MAX_CTX:
+        logger.warning(f"Ollama : ~{needed} tokens nécessaires, contexte plafonné à {OLLAMA_MAX_CTX} (notes tronquées)")
+    return min(size, OLLAMA_MAX_CTX)
+
+def ollama_chat_payload(payload, stream=False, model=None):
+    """Traduit une charge utile compatible OpenAI en appel natif /api/chat
+    (num_ctx et num_predict dimensionnés pour la demande, keep_alive)"""
+    num_predict = int(payload.get('max_tokens') or API_MAX_TOKENS)
+    prompt_tokens = estimate_text_tokens(''.join(m['content'] for m in payload['messages']))
+    chat = {
+        'model': model or payload['model'],
+        'messages': payload['messages'],
+        'stream': stream,
+        'keep_alive': OLLAMA_KEEP_ALIVE,
+        'options': {
+            'temperature': payload.get('temperature', API_TEMPERATURE),
+            'num_predict': num_predict,
+            'num_ctx': ollama_context_size(prompt_tokens, num_predict),
+        },
+    }
+    if payload.get('format'):
+        chat['format'] = payload['format']  # sortie structurée (schéma JSON)
+    if payload.get('stop'):
+        chat['options']['stop'] = payload['stop']
+    return chat
+
+def preload_ollama_models(models=None, background=False):
+    """Charge à l'avance les modèles Ollama en mémoire (même num_ctx que les demandes courantes)"""
+    models = OLLAMA_PRELOAD_MODELS if models is None else models
+    base_url = config.get('ollama_base_url', '').rstrip('/')
+    if not models or not base_url:
+        return
+
+    def _preload():
+        for model in models:
+            started = time.monotonic()
+            try:
+                # Une conversation vide charge le modèle sans rien générer
+                response = get_http_session('ollama', base_url).post(f"{base_url}/api/chat", json={
+                    'model': model,
+                    'messages': [],
+                    'keep_alive': OLLAMA_KEEP_ALIVE,
+                    'options': {'num_ctx': OLLAMA_NUM_CTX},
+                }, timeout=OLLAMA_PRELOAD_TIMEOUT)
+                response.raise_for_status()
+                logger.info(f"Modèle Ollama {model} préchargé en {time.monotonic() - started:.1f}s")
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Préchargement Ollama {model} impossible: {e}")
+
+    if background:
+        threading.Thread(target=_preload, daemon=True, name='ollama-preload').start()
+    else:
+        _preload()
+
+class OllamaTicket:
+    """Demande en attente (ou en cours) d'un créneau Ollama"""
+
+    def __init__(self, model, cost, sequence, tag=None):
+        self.model = model
+        self.cost = cost
+        self.sequence = sequence
+        self.tag = tag  # demandeur (travail asynchrone) dont la position est consultable
+        self.state = 'queued'  # queued -> running -> done
+        self.enqueued_at = time.monotonic()
+
+class OllamaScheduler:
+    """Créneaux d'exécution Ollama : OLLAMA_NUM_PARALLEL demandes par modèle et
+    OLLAMA_MAX_LOADED_MODELS modèles actifs, comme le serveur.
+
+    Au-delà, les demandes attendent ici dans une file par modèle (position connue,
+    ordre d'arrivée) au lieu d'attendre dans Ollama, où l'attente consommait API_TIMEOUT.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues = {}  # modèle -> file des tickets en attente
+        self.running = {}  # modèle -> demandes en cours
+        self.sequence = 0
+        self.counters = {'granted': 0, 'waited': 0, 'rejected': 0, 'timeouts': 0, 'rerouted': 0,
+                         'wait_total': 0.0, 'wait_max': 0.0}
+
+    def _load(self, model):
+        return len(self.queues.get(model, ())) + self.running.get(model, 0)
+
+    def _dispatch(self):
+        """Attribue les créneaux libres aux têtes de file, la plus ancienne demande d'abord"""
+        while True:
+            heads = sorted((q[0] for q in self.queues.values() if q), key=lambda ticket: ticket.sequence)
+            for ticket in heads:
+                running = self.running.get(ticket.model, 0)
+                loaded = sum(1 for count in self.running.values() if count)
+                if running < OLLAMA_NUM_PARALLEL and (running or loaded < OLLAMA_MAX_LOADED_MODELS):
+                    self.queues[ticket.model].popleft()
+                    self.running[ticket.model] = running + 1
+                    ticket.state = 'running'
+                    waited = time.monotonic() - ticket.enqueued_at
+                    self.counters['granted'] += 1
+                    if waited > 0.01:
+                        self.counters['waited'] += 1
+                        self.counters['wait_total'] += waited
+                        self.counters['wait_max'] = max(self.counters['wait_max'], waited)
+                    break
+            else:
+                break
+        self.cond.notify_all()
+
+    def enqueue(self, model, cost, tag=None):
+        """Place une demande en file ; GenerationError 503 si la file est pleine.
+
+        Une petite demande peut être servie par un modèle de OLLAMA_SMALL_JOB_MODELS
+        dont la file est plus courte : le modèle retenu est ticket.model.
+        """
+        with self.cond:
+            queued = sum(len(q) for q in self.queues.values())
+            if queued >= OLLAMA_QUEUE_SIZE:
+                self.counters['rejected'] += 1
+                raise GenerationError("File d'attente Ollama saturée. Réessayez dans quelques instants.", 503,
+                                      {'queue_length': queued})
+            if cost <= OLLAMA_SMALL_JOB_TOKENS and OLLAMA_SMALL_JOB_MODELS:
+                # À charge égale, le modèle demandé est conservé
+                chosen = min([model] + [m for m in OLLAMA_SMALL_JOB_MODELS if m != model], key=self._load)
+                if chosen != model:
+                    self.counters['rerouted'] += 1
+                    model = chosen
+            self.sequence += 1
+            ticket = OllamaTicket(model, cost, self.sequence, tag)
+            self.queues.setdefault(model, deque()).append(ticket)
+            self._dispatch()
+            return ticket
+
+    def wait(self, ticket, timeout):
+        """Attend le créneau au plus timeout secondes : True s'il est attribué"""
+        with self.cond:
+            return self.cond.wait_for(lambda: ticket.state == 'running', timeout)
+
+    def position(self, ticket):
+        """Rang dans la file du modèle (1 = prochaine demande servie), 0 si en cours"""
+        with self.cond:
+            return self._position(ticket)
+
+    def _position(self, ticket):
+        if ticket.state != 'queued':
+            return 0
+        return self.queues[ticket.model].index(ticket) + 1
+
+    def tag_position(self, tag):
+        """Meilleure position en file des demandes d'un demandeur, ou None s'il n'attend pas"""
+        with self.cond:
+            positions = [self._position(ticket) for q in self.queues.values() for ticket in q if ticket.tag == tag]
+        return min(positions) if positions else None
+
+    def release(self, ticket):
+        """Libère le créneau (ou retire la demande de la file si elle attend encore)"""
+        with self.cond:
+            if ticket.state == 'running':
+                self.running[ticket.model] -= 1
+            elif ticket.state == 'queued':
+                self.queues[ticket.model].remove(ticket)
+            ticket.state = 'done'
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, model, cost, scope=None, tag=None):
+        """Créneau pour la durée du bloc ; GenerationError 503 si OLLAMA_QUEUE_TIMEOUT est dépassé
+        (l'attente s'interrompt si la portée d'annulation est annulée)"""
+        ticket = self.enqueue(model, cost, tag)
+        try:
+            deadline = time.monotonic() + OLLAMA_QUEUE_TIMEOUT
+            while not self.wait(ticket, min(OLLAMA_QUEUE_POLL, max(0.0, deadline - time.monotonic()))):
+                if scope is not None:
+                    scope.check()
+                if time.monotonic() >= deadline:
+                    self.timed_out(ticket)
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def idle(self):
+        """Aucune demande en cours ni en attente"""
+        with self.cond:
+            return not any(self.queues.values()) and not any(self.running.values())
+
+    def timed_out(self, ticket):
+        with self.cond:
+            self.counters['timeouts'] += 1
+            details = {'queue_position': self._position(ticket), 'model': ticket.model}
+        raise GenerationError("File d'attente Ollama : délai d'attente dépassé. Réessayez dans quelques instants.", 503,
+                              details)
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats.update({
+                'queues': {model: len(q) for model, q in self.queues.items() if q},
+                'running': {model: count for model, count in self.running.items() if count},
+                'parallel': OLLAMA_NUM_PARALLEL,
+                'max_loaded_models': OLLAMA_MAX_LOADED_MODELS,
+            })
+        stats['wait_avg'] = round(stats['wait_total'] / stats['waited'], 3) if stats['waited'] else 0.0
+        stats['wait_total'] = round(stats['wait_total'], 3)
+        stats['wait_max'] = round(stats['wait_max'], 3)
+        return stats
+
+ollama_scheduler = OllamaScheduler()
+
+def ollama_slot(provider, payload, scope=None, tag=None):
+    """Créneau Ollama pour un appel (contexte neutre pour les autres providers, ticket None)"""
+    if provider != 'ollama':
+        return nullcontext()
+    return ollama_scheduler.slot(payload['model'], estimate_request_tokens(payload), scope, tag)
+
+def ollama_queue_events(ticket, scope=None):
+    """Générateur SSE : publie la position dans la file Ollama jusqu'à l'attribution du créneau"""
+    deadline = time.monotonic() + OLLAMA_QUEUE_TIMEOUT
+    position = None
+    while True:
+        # Position publiée dès la mise en file, puis à chaque changement
+        current = ollama_scheduler.position(ticket)
+        if current and current != position:
+            position = current
+            yield sse_event('queued', {'position': position, 'model': ticket.model})
+        if ollama_scheduler.wait(ticket, OLLAMA_QUEUE_POLL):
+            return
+        if scope is not None:
+            scope.check()
+        if time.monotonic() > deadline:
+            ollama_scheduler.timed_out(ticket)
+
+class GenerationError(Exception):
+    """Erreur de génération à renvoyer telle quelle au client (message + code HTTP)"""
+
+    def __init__(self, message, status=500, details=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.details = details or {}  # champs ajoutés au corps JSON de l'erreur
+
+class GenerationCancelled(GenerationError):
+    """Génération interrompue volontairement (requête concurrente gagnante, client parti...)"""
+
+    def __init__(self, message='Génération annulée'):
+        super().__init__(message, 499)
+
+class DeadlineExceeded(GenerationError):
+    """Échéance de la requête atteinte avant la fin de la génération"""
+
+    def __init__(self, message='Délai de la requête dépassé'):
+        super().__init__(message, 504)
+
+class CancelScope:
+    """Annulation d'appels amont en cours : les flux HTTP attachés sont coupés immédiatement.
+
+    Une portée peut dépendre d'une portée parente (la requête du client, par exemple) :
+    l'annulation du parent se propage et l'échéance est héritée. Une portée dont
+    l'échéance (time.monotonic) est dépassée est annulée à la vérification suivante.
+    """
+
+    def __init__(self, parent=None, deadline=None):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.responses = set()
+        self.callbacks = []
+        self.expired = False
+        self.deadline = deadline if deadline is not None or parent is None else parent.deadline
+        if parent is not None:
+            parent.on_cancel(self.cancel)
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def remaining(self):
+        """Secondes restantes avant l'échéance, ou None sans échéance"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def extend_deadline(self, deadline):
+        """Repousse l'échéance (None : aucune échéance) ; utilisé pour un appel partagé"""
+        with self.lock:
+            if self.deadline is not None:
+                self.deadline = None if deadline is None else max(self.deadline, deadline)
+
+    def attach(self, response):
+        """Associe une réponse HTTP en cours (coupée aussitôt si l'annulation a déjà eu lieu)"""
+        with self.lock:
+            self.responses.add(response)
+        if self.cancelled:
+            abort_response(response)
+
+    def detach(self, response):
+        with self.lock:
+            self.responses.discard(response)
+
+    def on_cancel(self, callback):
+        """Appelle callback lors de l'annulation (immédiatement si elle a déjà eu lieu)"""
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.event.set()
+            responses, callbacks = list(self.responses), self.callbacks
+            self.callbacks = []
+        if responses:
+            with cancel_counters_lock:
+                cancel_counters['upstream_aborted'] += len(responses)
+        for response in responses:
+            abort_response(response)
+        for callback in callbacks:
+            callback()
+
+    def expire(self):
+        """Annulation pour échéance dépassée"""
+        with self.lock:
+            if self.cancelled:
+                return
+            self.expired = True
+        with cancel_counters_lock:
+            cancel_counters['deadline_exceeded'] += 1
+        self.cancel()
+
+    def check(self):
+        if not self.cancelled and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.expire()
+        if self.cancelled:
+            raise DeadlineExceeded() if self.expired else GenerationCancelled()
+
+cancel_counters = {'client_disconnects': 0, 'upstream_aborted': 0, 'deadline_exceeded': 0}
+cancel_counters_lock = threading.Lock()
+
+def client_disconnected_probe(environ):
+    """Fonction indiquant si le client HTTP s'est déconnecté, ou None si le serveur ne le permet pas"""
+    check = environ.get('waitress.client_disconnected')
+    if callable(check):
+        # Waitress : nécessite channel_request_lookahead > 0
+        return check
+    sock = environ.get('werkzeug.socket')
+    if sock is None:
+        return None
+
+    def probe():
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            # Socket lisible sans données : le client a fermé la connexion
+            return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+        except ValueError:
+            return False  # socket TLS ou déjà fermé côté serveur : état inconnu
+        except OSError:
+            return True
+    return probe
+
+class DisconnectMonitor:
+    """Surveille les clients des générations en cours (un seul thread pour toutes les requêtes)
+    et annule la portée d'une requête dont le client s'est déconnecté ou dont l'échéance est dépassée"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.thread = None
+
+    def watch(self, probe, scope):
+        token = object()
+        with self.lock:
+            self.watched[token] = (probe, scope)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True, name='disconnect-monitor')
+                self.thread.start()
+        return token
+
+    def unwatch(self, token):
+        with self.lock:
+            self.watched.pop(token, None)
+
+    def _loop(self):
+        while True:
+            time.sleep(CLIENT_DISCONNECT_POLL)
+            with self.lock:
+                watched = list(self.watched.items())
+            for token, (probe, scope) in watched:
+                remaining = scope.remaining()
+                if remaining is not None and remaining <= 0:
+                    self.unwatch(token)
+                    logger.info("Échéance dépassée : génération en cours annulée")
+                    scope.expire()
+                    continue
+                try:
+                    gone = probe is not None and probe()
+                except Exception:
+                    gone = False
+                if not gone:
+                    continue
+                self.unwatch(token)
+                with cancel_counters_lock:
+                    cancel_counters['client_disconnects'] += 1
+                logger.info("Client déconnecté : génération en cours annulée")
+                scope.cancel()
+
+disconnect_monitor = DisconnectMonitor()
+
+def request_deadline(endpoint):
+    """Échéance (time.monotonic) de la requête en cours : en-tête REQUEST_TIMEOUT_HEADER
+    (secondes > 0, plafonné à REQUEST_TIMEOUT_MAX), sinon délai par défaut de l'endpoint"""
+    seconds = REQUEST_TIMEOUTS[endpoint]
+    value = request.headers.get(REQUEST_TIMEOUT_HEADER)
+    if value:
+        try:
+            requested = float(value)
+        except ValueError:
+            requested = math.nan
+        # 0, négatif, nan ou inf : le client ne peut pas lever l'échéance de l'endpoint
+        if math.isfinite(requested) and requested > 0:
+            seconds = min(requested, REQUEST_TIMEOUT_MAX)
+        else:
+            logger.debug(f"En-tête {REQUEST_TIMEOUT_HEADER} ignoré: {value[:20]}")
+    if seconds <= 0:
+        return None  # échéance désactivée par configuration
+    return time.monotonic() + seconds
+
+def client_cancel_scope(endpoint):
+    """Portée d'annulation liée au client de la requête en cours, avec l'échéance de l'endpoint :
+    retourne (portée, arrêt de la surveillance)"""
+    scope = CancelScope(deadline=request_deadline(endpoint))
+    probe = client_disconnected_probe(request.environ)
+    if probe is None and scope.deadline is None:
+        return scope, lambda: None
+    token = disconnect_monitor.watch(probe, scope)
+    return scope, lambda: disconnect_monitor.unwatch(token)
+
+@contextmanager
+def watch_client_disconnect(endpoint):
+    """Portée d'annulation de la requête en cours, surveillée pendant la durée du bloc"""
+    scope, stop = client_cancel_scope(endpoint)
+    try:
+        yield scope
+    finally:
+        stop()
+
+def call_timeout(scope=None):
+    """Délai d'un appel HTTP amont : API_TIMEOUT, réduit au temps restant avant l'échéance
+    de la portée (le reste du budget sert aux nouvelles tentatives) ; DeadlineExceeded si
+    elle est déjà dépassée"""
+    remaining = scope.remaining() if scope is not None else None
+    if remaining is None:
+        return API_TIMEOUT
+    if remaining <= 0:
+        scope.check()
+    return max(min(API_TIMEOUT, remaining), 0.001)
+
+def abort_response(response):
+    """Coupe une réponse streamée, y compris si un autre thread est bloqué en lecture"""
+    connection = getattr(response.raw, '_connection', None) or getattr(response.raw, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+def iter_chat_stream(response, on_usage=None):
+    """Itère sur les fragments de texte d'un flux SSE compatible OpenAI
+    (on_usage reçoit le bloc usage s'il est transmis, en général dans le dernier fragment)"""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            break
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            logger.debug(f"Fragment SSE ignoré: {data[:100]}")
+            continue
+        if on_usage and chunk.get('usage'):
+            on_usage(chunk['usage'])
+        choices = chunk.get('choices') or []
+        if choices:
+            text = (choices[0].get('delta') or {}).get('content')
+            if text:
+                yield text
+
+def iter_provider_stream(provider, response, on_usage=None):
+    """Fragments de texte d'une complétion streamée (NDJSON natif pour Ollama, SSE sinon)"""
+    if provider == 'ollama':
+        return iter_ollama_stream(response)
+    return iter_chat_stream(response, on_usage)
+
+def sse_event(event, data):
+    """Formate un événement Server-Sent Events (données JSON)"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def wants_event_stream():
+    """Le client demande-t-il une réponse en Server-Sent Events ?"""
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -3651,6 +4438,8 @@ def conditions():
 
 @app.route('/api/generate', methods=['POST'])
 def generate():
+    if wants_event_stream():
+        return generate_stream()
     try:
         data = request.json
         prompt = data.get('prompt', '')
@@ -3662,202 +4451,1091 @@ def generate():
         # Utiliser le provider actif configuré
         provider = config.get('active_provider', 'mistral')
         
+        force_regenerate = bool(data.get('force_regenerate'))
+        
         # Si c'est Ollama, utiliser la fonction spécifique
         if provider == 'ollama':
-            return generate_ollama(prompt, model)
+            return generate_ollama(prompt, model, force_regenerate)
         # Sinon, utiliser la fonction générique pour providers compatibles OpenAI
         else:
-            return generate_ai_provider(prompt, model, provider)
+            return generate_ai_provider(prompt, model, provider, force_regenerate)
             
     except Exception as e:
         return jsonify({'error': f'Erreur serveur: {str(e)}'}), 500
 
-def generate_ollama(prompt, model):
-    try:
-        url = f"{config['ollama_base_url']}/api/generate"
-        payload = {
-            "model": model,
-            "prompt": f"{SYSTEM_PROMPT}\n\nDescription: {prompt}",
-            "stream": False
-        }
-        
-        response = requests.post(url, json=payload, timeout=60)
-        response.raise_for_status()
-        
-        result = response.json()
-        mermaid_code = result.get('response', '').strip()
-        
+@app.route('/api/generate/stream', methods=['POST'])
+def generate_stream():
+    """Variante streamée (SSE) de /api/generate : événements token, done, error"""
+    data = request.get_json(silent=True) or {}
+    prompt = data.get('prompt', '')
+    model = data.get('model', '')
+    provider = config.get('active_provider', 'mistral')
+    
+    if not prompt.strip():
+        return jsonify({'error': 'Prompt requis'}), 400
+    
+    key = diagram_cache_key(prompt, model, provider)
+    if not data.get('force_regenerate'):
+        cached = diagram_cache.get(key)
+        if cached is not None:
+            return Response(sse_event('done', {'mermaid': cached, 'cached': True}), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+    
+    def produce(scope):
+        # Ollama : position dans la file publiée jusqu'à l'attribution d'un créneau
+        ticket = ollama_scheduler.enqueue(model, mermaid_request_tokens(prompt)) if provider == 'ollama' else None
+        try:
+            if ticket:
+                yield from ollama_queue_events(ticket, scope)
+            response, fragments = open_mermaid_stream(prompt, ticket.model if ticket else model, provider, scope)
+            scope.attach(response)
+            text = ''
+            try:
+                for fragment in guard_mermaid_stream(response, fragments, provider):
+                    text += fragment
+                    yield sse_event('token', {'text': fragment})
+            finally:
+                scope.detach(response)
+                response.close()
+        except requests.exceptions.RequestException as e:
+            scope.check()
+            raise diagram_provider_error(e, provider)
+        finally:
+            if ticket:
+                ollama_scheduler.release(ticket)
+        mermaid_code = strip_mermaid_fences(text)
         if not is_valid_mermaid(mermaid_code):
-            return jsonify({'error': 'Réponse invalide: pas de code Mermaid détecté'}), 422
-            
-        return jsonify({'mermaid': mermaid_code})
+            raise GenerationError('Réponse invalide: pas de code Mermaid détecté', 422)
+        diagram_cache.put(key, mermaid_code)
+        yield sse_event('done', {'mermaid': mermaid_code, 'cached': False})
+        return mermaid_code
+    
+    # Les demandes identiques simultanées (double clic) partagent le même flux amont ;
+    # l'ouverture du flux se fait avant la réponse pour renvoyer les erreurs HTTP classiques
+    scope, stop_watching = client_cancel_scope('diagram')
+    events = diagram_flight.stream(key, produce, scope,
+                                   lambda mermaid_code: sse_event('done', {'mermaid': mermaid_code, 'cached': False}))
+    try:
+        first = next(events)
+    except GenerationError as e:
+        stop_watching()
+        return jsonify(dict(e.details, error=e.message)), e.status
+    except Exception as e:
+        stop_watching()
+        return jsonify({'error': f'Erreur serveur: {str(e)}'}), 500
+    
+    def generate():
+        yield first
+        try:
+            yield from events
+        except GenerationError as e:
+            yield sse_event('error', {'error': e.message, 'status': e.status})
+    
+    stream = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    stream.call_on_close(stop_watching)
+    # Client parti : désistement de l'appel partagé, dont le flux amont est coupé s'il n'est plus attendu
+    stream.call_on_close(events.close)
+    return stream
+
+def generate_ollama(prompt, model, force_regenerate=False):
+    try:
+        with watch_client_disconnect('diagram') as scope:
+            mermaid_code, cached = generate_diagram_code(prompt, model, 'ollama', force_regenerate, scope)
+        return jsonify({'mermaid': mermaid_code, 'cached': cached})
         
-    except requests.exceptions.Timeout:
-        return jsonify({'error': 'Timeout: Ollama ne répond pas'}), 408
-    except requests.exceptions.ConnectionError:
-        return jsonify({'error': 'Impossible de se connecter à Ollama'}), 503
+    except GenerationError as e:
+        return jsonify(dict(e.details, error=e.message)), e.status
     except Exception as e:
         return jsonify({'error': f'Erreur Ollama: {str(e)}'}), 500
 
-def generate_mistral(prompt, model):
+def generate_ai_provider(prompt, model, provider, force_regenerate=False):
+    """Génération de diagramme Mermaid avec n'importe quel provider compatible OpenAI"""
     try:
-        if not config['mistral_api_key']:
-            return jsonify({'error': 'Clé API Mistral manquante dans la configuration'}), 401
-            
-        url = f"{config['mistral_base_url']}/v1/chat/completions"
-        headers = {
-            'Authorization': f"Bearer {config['mistral_api_key']}",
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"Description: {prompt}"}
-            ],
-            "temperature": 0.1,
-            "max_tokens": 2000
-        }
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=60)
-        
-        # Debug logging
-        print(f"Mistral API Status: {response.status_code}")
-        if response.status_code != 200:
-            print(f"Mistral API Error: {response.text}")
-        
-        response.raise_for_status()
+        with watch_client_disconnect('diagram') as scope:
+            mermaid_code, cached = generate_diagram_code(prompt, model, provider, force_regenerate, scope)
         
-        result = response.json()
-        mermaid_code = result['choices'][0]['message']['content'].strip()
-        
-        # Nettoyer le code Mermaid des balises markdown
-        if mermaid_code.startswith('```mermaid'):
-            lines = mermaid_code.split('\n')
-            mermaid_code = '\n'.join(lines[1:-1]) if len(lines) > 2 else mermaid_code
-        elif mermaid_code.startswith('```'):
-            lines = mermaid_code.split('\n')
-            mermaid_code = '\n'.join(lines[1:-1]) if len(lines) > 2 else mermaid_code
-        
-        mermaid_code = mermaid_code.strip()
-        
-        if not is_valid_mermaid(mermaid_code):
-            print(f"⚠️ Code Mermaid invalide généré: {mermaid_code[:100]}...")
-            return jsonify({'error': 'Réponse invalide: pas de code Mermaid détecté'}), 422
-            
-        return jsonify({'mermaid': mermaid_code})
+        logger.info(f"Diagramme généré avec succès via {provider}")
+        return jsonify({'mermaid': mermaid_code, 'cached': cached})
         
-    except requests.exceptions.Timeout:
-        return jsonify({'error': 'Timeout: Mistral ne répond pas dans les délais'}), 408
-    except requests.exceptions.HTTPError as e:
-        if hasattr(e, 'response') and e.response is not None:
-            if e.response.status_code == 401:
-                return jsonify({'error': 'Clé API Mistral invalide ou expirée'}), 401
-            elif e.response.status_code == 403:
-                return jsonify({'error': 'Accès non autorisé à l\'API Mistral'}), 403
-            elif e.response.status_code == 429:
-                return jsonify({'error': 'Limite de débit API Mistral atteinte'}), 429
-            else:
-                return jsonify({'error': f'Erreur API Mistral: {e.response.status_code}'}), 503
-        return jsonify({'error': f'Erreur HTTP Mistral: {str(e)}'}), 503
-    except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Erreur de connexion Mistral: {str(e)}'}), 503
+    except GenerationError as e:
+        return jsonify(dict(e.details, error=e.message)), e.status
     except KeyError as e:
-        return jsonify({'error': f'Réponse API Mistral malformée: {str(e)}'}), 502
+        return jsonify({'error': f'Réponse {provider} malformée: {str(e)}'}), 502
     except Exception as e:
-        return jsonify({'error': f'Erreur Mistral: {str(e)}'}), 500
+        return jsonify({'error': f'Erreur {provider}: {str(e)}'}), 500
 
-def generate_ai_provider(prompt, model, provider):
-    """Génération de diagramme Mermaid avec n'importe quel provider compatible OpenAI"""
-    try:
-        # Récupérer la configuration du provider
-        base_url = config.get(f'{provider}_base_url', '')
-        api_key = config.get(f'{provider}_api_key', '')
-        
-        if not base_url:
-            return jsonify({'error': f'Provider {provider} non configuré'}), 400
-        
-        if not api_key:
-            return jsonify({'error': f'Clé API {provider} manquante'}), 401
-        
-        # Construction de l'URL
-        url = f"{base_url}/v1/chat/completions"
-        
-        headers = {
-            'Authorization': f"Bearer {api_key}",
-            'Content-Type': 'application/json'
-        }
-        
-        # Utiliser le modèle fourni ou un par défaut selon le provider
-        if not model:
-            default_models = {
-                'mistral': 'mistral-medium-latest',
-                'openai': 'gpt-4-turbo-preview',
-                'deepseek': 'deepseek-chat',
-                'gemini': 'gemini-pro'
-            }
-            model = default_models.get(provider, 'mistral-medium-latest')
-        
+def diagram_provider_error(e, provider):
+    """Convertit une exception requests de génération de diagramme en GenerationError"""
+    if provider == 'ollama':
+        if isinstance(e, requests.exceptions.Timeout):
+            return GenerationError('Timeout: Ollama ne répond pas', 408)
+        if isinstance(e, requests.exceptions.ConnectionError):
+            return GenerationError('Impossible de se connecter à Ollama', 503)
+        return GenerationError(f'Erreur Ollama: {str(e)}', 500)
+    
+    if isinstance(e, requests.exceptions.Timeout):
+        return GenerationError(f'Timeout: {provider} ne répond pas', 408)
+    if isinstance(e, requests.exceptions.HTTPError):
+        if getattr(e, 'response', None) is not None:
+            status = e.response.status_code
+            if status == 401:
+                return GenerationError(f'Clé API {provider} invalide', 401)
+            elif status == 403:
+                return GenerationError(f'Accès non autorisé à {provider}', 403)
+            elif status == 429:
+                return GenerationError(f'Limite de débit {provider} atteinte', 429)
+            return GenerationError(f'Erreur {provider}: {status}', 503)
+        return GenerationError(f'Erreur HTTP {provider}', 503)
+    return GenerationError(f'Erreur connexion {provider}: {str(e)}', 503)
+
+def mermaid_request_tokens(prompt):
+    """Coût estimé d'une génération de diagramme (prompt système, description, sortie)"""
+    return estimate_text_tokens(f"{SYSTEM_PROMPT}\n\nDescription: {prompt}") + 2000
+
+def open_mermaid_stream(prompt, model, provider, scope=None):
+    """Lance la génération streamée d'un diagramme : retourne (réponse HTTP, itérateur de fragments)
+    (scope : portée dont l'échéance borne l'appel)"""
+    if provider == 'ollama':
+        url = f"{config['ollama_base_url']}/api/generate"
+        full_prompt = f"{SYSTEM_PROMPT}\n\nDescription: {prompt}"
         payload = {
             "model": model,
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"Description: {prompt}"}
-            ],
-            "temperature": 0.1,
-            "max_tokens": 2000
+            "prompt": full_prompt,
+            "stream": True,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": {"num_predict": 2000, "num_ctx": ollama_context_size(estimate_text_tokens(full_prompt), 2000)},
         }
-        
-        logger.info(f"Génération diagramme avec {provider} (modèle: {model})")
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=API_TIMEOUT)
-        
-        # Debug
-        if response.status_code != 200:
-            logger.error(f"{provider} API Error {response.status_code}: {response.text[:200]}")
-        
+        response = send_to_provider('ollama', payload, lambda: get_http_session('ollama').post(
+            url, json=payload, timeout=call_timeout(scope), stream=True), scope)
         response.raise_for_status()
-        
-        result = response.json()
-        mermaid_code = result['choices'][0]['message']['content'].strip()
-        
-        # Nettoyer le code Mermaid des balises markdown
-        if mermaid_code.startswith('```mermaid'):
-            lines = mermaid_code.split('\n')
-            mermaid_code = '\n'.join(lines[1:-1]) if len(lines) > 2 else mermaid_code
-        elif mermaid_code.startswith('```'):
-            lines = mermaid_code.split('\n')
-            mermaid_code = '\n'.join(lines[1:-1]) if len(lines) > 2 else mermaid_code
-        
-        mermaid_code = mermaid_code.strip()
+        return response, iter_ollama_stream(response)
+    
+    # Récupérer la configuration du provider
+    base_url = config.get(f'{provider}_base_url', '')
+    api_key = config.get(f'{provider}_api_key', '')
+    
+    if not base_url:
+        raise GenerationError(f'Provider {provider} non configuré', 400)
+    
+    if not api_key:
+        raise GenerationError(f'Clé API {provider} manquante', 401)
+    
+    # Construction de l'URL
+    url = f"{base_url}/v1/chat/completions"
+    
+    headers = {
+        'Authorization': f"Bearer {api_key}",
+        'Content-Type': 'application/json'
+    }
+    
+    # Utiliser le modèle fourni ou un par défaut selon le provider
+    if not model:
+        model = DEFAULT_MODELS.get(provider, 'mistral-medium-latest')
+    
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Description: {prompt}"}
+        ],
+        "temperature": 0.1,
+        "max_tokens": 2000,
+        "stream": True
+    }
+    
+    logger.info(f"Génération diagramme avec {provider} (modèle: {model})")
+    
+    response = send_to_provider(provider, payload, lambda: get_http_session(provider, base_url).post(
+        url, json=payload, headers=headers, timeout=call_timeout(scope), stream=True), scope)
+    
+    # Debug
+    if response.status_code != 200:
+        logger.error(f"{provider} API Error {response.status_code}: {response.text[:200]}")
+    
+    response.raise_for_status()
+    response.encoding = 'utf-8'
+    return response, iter_chat_stream(response)
+
+def iter_ollama_stream(response):
+    """Itère sur les fragments de texte d'un flux NDJSON Ollama (/api/generate ou /api/chat)"""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            continue
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            logger.debug(f"Ligne NDJSON ignorée: {line[:100]}")
+            continue
+        if chunk.get('error'):
+            raise GenerationError(f"Erreur Ollama: {chunk['error']}", 502)
+        text = chunk.get('response') or (chunk.get('message') or {}).get('content')
+        if text:
+            yield text
+        if chunk.get('done'):
+            break
+
+def mermaid_prefix_status(text):
+    """Diagnostic du début d'une réponse : True (en-tête Mermaid vu), False (prose), None (indécis)"""
+    if any(re.search(pattern, text, re.IGNORECASE) for pattern in MERMAID_PATTERNS):
+        return True
+    if len(text.strip()) >= MERMAID_PROSE_ABORT_CHARS:
+        return False
+    return None
+
+def guard_mermaid_stream(response, fragments, provider):
+    """Relaie les fragments d'un diagramme en coupant l'appel amont si le modèle répond en prose"""
+    head = ''
+    decided = False
+    for fragment in fragments:
+        if decided:
+            yield fragment
+            continue
+        # Début de réponse retenu tant que l'en-tête du diagramme n'est pas confirmé
+        head += fragment
+        status = mermaid_prefix_status(head)
+        if status is False:
+            response.close()
+            logger.warning(f"Génération {provider} interrompue: réponse en prose ({head[:80]!r}...)")
+            raise GenerationError('Réponse invalide: pas de code Mermaid détecté', 422)
+        if status is True:
+            decided = True
+            yield head
+    if head and not decided:
+        yield head
+
+def collect_mermaid_stream(response, fragments, provider):
+    """Consomme un flux de diagramme (avec arrêt anticipé) et retourne le code nettoyé"""
+    try:
+        return strip_mermaid_fences(''.join(guard_mermaid_stream(response, fragments, provider)))
+    finally:
+        response.close()
+
+def strip_mermaid_fences(mermaid_code):
+    """Nettoie le code Mermaid des balises markdown"""
+    mermaid_code = mermaid_code.strip()
+    if mermaid_code.startswith('```mermaid'):
+        lines = mermaid_code.split('\n')
+        mermaid_code = '\n'.join(lines[1:-1]) if len(lines) > 2 else mermaid_code
+    elif mermaid_code.startswith('```'):
+        lines = mermaid_code.split('\n')
+        mermaid_code = '\n'.join(lines[1:-1]) if len(lines) > 2 else mermaid_code
+    return mermaid_code.strip()
+
+# ============================================
+# LIMITATION DE DÉBIT PAR PROVIDER
+# ============================================
+
+class TokenBucket:
+    """Seau à jetons rechargé en continu (capacité exprimée par minute, None = illimité)"""
+
+    def __init__(self, per_minute=None):
+        self.capacity = per_minute
+        self.level = float(per_minute or 0)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def set_capacity(self, per_minute):
+        if per_minute and per_minute != self.capacity:
+            self.level = min(self.level, per_minute) if self.capacity else float(per_minute)
+            self.capacity = per_minute
+
+    def wait_time(self, amount, now):
+        """Secondes à attendre avant de pouvoir prélever amount jetons"""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.capacity
+
+    def take(self, amount):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+class ProviderRateLimiter:
+    """Limiteur requêtes/min et tokens/min d'un provider, avec file d'attente équitable (FIFO).
+
+    Les demandes patientent dans une file bornée jusqu'à leur échéance au lieu d'échouer ;
+    les en-têtes Retry-After et x-ratelimit-* des réponses ajustent le débit.
+    """
+
+    def __init__(self, provider, rpm=None, tpm=None):
+        self.provider = provider
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.configured = bool(rpm), bool(tpm)
+        self.blocked_until = 0.0
+        self.cond = threading.Condition()
+        self.waiters = deque()
+        self.counters = {'acquired': 0, 'waited': 0, 'rejected': 0, 'timeouts': 0, 'throttled': 0,
+                         'wait_total': 0.0, 'wait_max': 0.0}
+
+    def _wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def acquire(self, cost, deadline, scope=None):
+        """Attend son tour et le débit disponible ; GenerationError 429 si file pleine ou échéance dépassée
+        (l'attente s'interrompt, et libère sa place, si la portée d'annulation est annulée)"""
+        ticket = object()
+        started = time.monotonic()
+        if scope is not None:
+            scope.on_cancel(self._wake)
+        with self.cond:
+            if len(self.waiters) >= RATE_LIMIT_QUEUE_SIZE:
+                self.counters['rejected'] += 1
+                raise GenerationError(f"File d'attente {self.provider} saturée. Réessayez dans quelques instants.", 429)
+            self.waiters.append(ticket)
+            try:
+                while True:
+                    if scope is not None:
+                        scope.check()
+                    now = time.monotonic()
+                    if self.waiters[0] is ticket:
+                        wait = max(self.blocked_until - now,
+                                   self.requests.wait_time(1, now),
+                                   self.tokens.wait_time(cost, now))
+                        if wait <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(cost)
+                            break
+                        if now + wait > deadline:
+                            self.counters['timeouts'] += 1
+                            raise GenerationError(f'Limite de débit {self.provider} atteinte. Réessayez dans quelques instants.', 429)
+                    else:
+                        wait = deadline - now
+                        if wait <= 0:
+                            self.counters['timeouts'] += 1
+                            raise GenerationError(f'Limite de débit {self.provider} atteinte. Réessayez dans quelques instants.', 429)
+                    self.cond.wait(wait)
+            finally:
+                self.waiters.remove(ticket)
+                self.cond.notify_all()
+            waited = time.monotonic() - started
+            self.counters['acquired'] += 1
+            if waited > 0.01:
+                self.counters['waited'] += 1
+                self.counters['wait_total'] += waited
+                self.counters['wait_max'] = max(self.counters['wait_max'], waited)
+
+    def block_for(self, seconds):
+        """Suspend les envois vers le provider (429 ou quota épuisé)"""
+        with self.cond:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.cond.notify_all()
+
+    def update_from_headers(self, response):
+        """Ajuste le débit à partir des en-têtes de limitation renvoyés par le provider"""
+        headers = response.headers
+        if response.status_code == 429:
+            with self.cond:
+                self.counters['throttled'] += 1
+            self.block_for(parse_retry_after(headers) or RATE_LIMIT_DEFAULT_BACKOFF)
+            return
+        
+        # Limites annoncées (OpenAI, DeepSeek...) : utilisées si aucune limite n'est configurée
+        with self.cond:
+            limit = header_number(headers, 'x-ratelimit-limit-requests')
+            if limit and not self.configured[0]:
+                self.requests.set_capacity(limit)
+            limit = header_number(headers, 'x-ratelimit-limit-tokens', 'x-ratelimitbysize-limit-minute')
+            if limit and not self.configured[1]:
+                self.tokens.set_capacity(limit)
+        
+        for remaining_names, reset_name in ((('x-ratelimit-remaining-requests',), 'x-ratelimit-reset-requests'),
+                                            (('x-ratelimit-remaining-tokens', 'x-ratelimitbysize-remaining-minute'),
+                                             'x-ratelimit-reset-tokens')):
+            remaining = header_number(headers, *remaining_names)
+            if remaining is not None and remaining <= 0:
+                self.block_for(parse_duration(headers.get(reset_name)) or RATE_LIMIT_DEFAULT_BACKOFF)
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats.update({
+                'queue_depth': len(self.waiters),
+                'rpm': self.requests.capacity,
+                'tpm': self.tokens.capacity,
+                'blocked_for': round(max(0.0, self.blocked_until - time.monotonic()), 3),
+            })
+        stats['wait_avg'] = round(stats['wait_total'] / stats['waited'], 3) if stats['waited'] else 0.0
+        stats['wait_total'] = round(stats['wait_total'], 3)
+        stats['wait_max'] = round(stats['wait_max'], 3)
+        return stats
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider):
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(provider)
+        if limiter is None:
+            limits = RATE_LIMITS.get(provider, {})
+            limiter = ProviderRateLimiter(provider, limits.get('rpm'), limits.get('tpm'))
+            _rate_limiters[provider] = limiter
+        return limiter
+
+def header_number(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value)
+        except ValueError:
+            continue
+    return None
+
+def parse_duration(value):
+    """Durée au format '20', '1.5s', '6m0s' ou '150ms' (en-têtes de reset) -> secondes"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        total += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return total or None
+
+def parse_retry_after(headers):
+    """En-tête Retry-After (secondes ou date HTTP) -> secondes"""
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def estimate_text_tokens(text):
+    """Estimation grossière du nombre de tokens d'un texte (≈ 4 caractères par token)"""
+    return len(text) // 4
+
+def estimate_request_tokens(payload):
+    """Estimation grossière des tokens consommés par un appel (entrée + max_tokens)"""
+    text = ''.join(m.get('content', '') for m in payload.get('messages', [])) + payload.get('prompt', '')
+    return estimate_text_tokens(text) + int(payload.get('max_tokens', 0))
+
+def send_with_rate_limit(provider, payload, send, scope=None):
+    """Envoie une requête via le limiteur du provider ; un 429 est réessayé après le délai indiqué
+    tant que l'échéance RATE_LIMIT_MAX_WAIT (ou celle de la portée, si plus proche) le permet
+    (sinon la réponse 429 est retournée)"""
+    limiter = get_rate_limiter(provider)
+    deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT
+    if scope is not None and scope.deadline is not None:
+        deadline = min(deadline, scope.deadline)
+    cost = estimate_request_tokens(payload)
+    while True:
+        limiter.acquire(cost, deadline, scope)
+        response = send()
+        limiter.update_from_headers(response)
+        if response.status_code != 429:
+            return response
+        retry_after = parse_retry_after(response.headers) or RATE_LIMIT_DEFAULT_BACKOFF
+        if time.monotonic() + retry_after > deadline:
+            return response
+        logger.info(f"429 {provider} : nouvelle tentative dans {retry_after:.1f}s")
+        response.close()
+
+# ============================================
+# NOUVELLES TENTATIVES ET DISJONCTEUR PAR PROVIDER
+# ============================================
+
+class CircuitBreaker:
+    """Disjoncteur d'un provider : après CIRCUIT_FAILURE_THRESHOLD échecs consécutifs, les
+    appels échouent immédiatement pendant CIRCUIT_RESET_TIMEOUT, puis un appel test
+    (semi-ouvert) décide de la refermeture.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.counters = {'opened': 0, 'rejected': 0}
+
+    def before_call(self):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self.opened_at >= CIRCUIT_RESET_TIMEOUT:
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'half_open' and not self.probing:
+                # Un seul appel test à la fois
+                self.probing = True
+                return
+            self.counters['rejected'] += 1
+        raise GenerationError(f'{self.provider} indisponible (échecs répétés). Réessayez dans quelques instants.', 503)
+
+    def record_success(self):
+        with self.lock:
+            if self.state != 'closed':
+                logger.info(f"Disjoncteur {self.provider} refermé")
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if self.state != 'open':
+                    self.counters['opened'] += 1
+                    logger.warning(f"Disjoncteur {self.provider} ouvert après {self.failures} échecs")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def release(self):
+        """Fin d'un appel test sans verdict (erreur non liée à la disponibilité du provider)"""
+        with self.lock:
+            self.probing = False
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, state=self.state, consecutive_failures=self.failures)
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+retry_counters = {'retries': 0}
+
+def get_circuit_breaker(provider):
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(provider)
+        if breaker is None:
+            breaker = _circuit_breakers[provider] = CircuitBreaker(provider)
+        return breaker
+
+def retry_delay(attempt):
+    """Backoff exponentiel avec gigue complète"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+def can_retry(attempt, breaker, delay, scope=None):
+    """Nouvelle tentative possible : tentatives restantes, disjoncteur fermé et assez de temps
+    avant l'échéance de la portée pour le délai d'attente"""
+    if attempt >= RETRY_ATTEMPTS or breaker.state == 'open':
+        return False
+    remaining = scope.remaining() if scope is not None else None
+    return remaining is None or remaining > delay
+
+def send_to_provider(provider, payload, send, scope=None):
+    """Envoi d'une requête au provider : disjoncteur, limiteur de débit et nouvelles tentatives
+    (erreurs de connexion, timeouts, 502/503/504) avec backoff exponentiel et gigue.
+
+    scope : portée de la requête ; son échéance borne l'attente du limiteur et les nouvelles
+    tentatives (send doit calculer son délai au moment de l'envoi, voir call_timeout).
+    """
+    breaker = get_circuit_breaker(provider)
+    attempt = 0
+    while True:
+        if scope is not None:
+            scope.check()
+        breaker.before_call()
+        delay = retry_delay(attempt)
+        try:
+            response = send_with_rate_limit(provider, payload, send, scope)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            breaker.record_failure()
+            if not can_retry(attempt, breaker, delay, scope):
+                raise
+            reason = type(e).__name__
+        except Exception:
+            breaker.release()
+            raise
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                if response.status_code < 500:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+                return response
+            breaker.record_failure()
+            if not can_retry(attempt, breaker, delay, scope):
+                return response
+            reason = f'HTTP {response.status_code}'
+            response.close()
+        
+        attempt += 1
+        with _circuit_breakers_lock:
+            retry_counters['retries'] += 1
+        logger.info(f"{provider} : {reason}, nouvelle tentative {attempt}/{RETRY_ATTEMPTS} dans {delay:.2f}s")
+        time.sleep(delay)
+
+# ============================================
+# ROUTAGE DES PROVIDERS (latence et santé)
+# ============================================
+
+class ProviderRouter:
+    """Choisit le provider le plus rapide parmi les providers sains.
+
+    Chaque appel met à jour des moyennes mobiles exponentielles (latence totale,
+    temps jusqu'au premier token, taux d'erreur) par provider et modèle ; des sondes
+    en tâche de fond interrogent la liste des modèles de chaque provider configuré.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}   # (provider, model) -> moyennes
+        self.health = {}   # provider -> dernier résultat de sonde
+        self._probe_thread = None
+
+    def _ewma(self, previous, value):
+        if previous is None:
+            return value
+        return ROUTER_EWMA_ALPHA * value + (1 - ROUTER_EWMA_ALPHA) * previous
+
+    def record(self, provider, model, latency, ok, ttft=None):
+        with self.lock:
+            stats = self.models.setdefault((provider, model), {
+                'latency': None, 'ttft': None, 'error_rate': 0.0, 'calls': 0, 'errors': 0})
+            stats['calls'] += 1
+            stats['error_rate'] = self._ewma(stats['error_rate'], 0.0 if ok else 1.0)
+            if ok:
+                stats['latency'] = self._ewma(stats['latency'], latency)
+                if ttft is not None:
+                    stats['ttft'] = self._ewma(stats['ttft'], ttft)
+            else:
+                stats['errors'] += 1
+
+    @contextmanager
+    def observe(self, provider, model):
+        """Mesure un appel ; l'appelant peut renseigner marks['ttft'] au premier token"""
+        started = time.monotonic()
+        marks = {}
+        try:
+            yield marks
+        except (GenerationCancelled, DeadlineExceeded):
+            raise
+        except GenerationError as e:
+            # Erreur du demandeur (clé, requête refusée) : pas une défaillance du provider,
+            # sauf délai dépassé chez le provider (408) et limite de débit (429)
+            if e.status in (408, 429) or not 400 <= e.status < 500:
+                self.record(provider, model, time.monotonic() - started, ok=False)
+            raise
+        except Exception:
+            self.record(provider, model, time.monotonic() - started, ok=False)
+            raise
+        else:
+            self.record(provider, model, time.monotonic() - started, ok=True, ttft=marks.get('ttft'))
+
+    def is_healthy(self, provider):
+        if get_circuit_breaker(provider).state == 'open':
+            return False
+        with self.lock:
+            probe = self.health.get(provider)
+            error_rates = [s['error_rate'] for (p, _), s in self.models.items() if p == provider and s['calls']]
+        if probe is not None and not probe['ok']:
+            return False
+        return not error_rates or min(error_rates) < ROUTER_MAX_ERROR_RATE
+
+    def score(self, provider):
+        """Latence attendue (TTFT en priorité), moyenne des modèles du provider pondérée par leurs
+        appels (le modèle dépend de la gamme choisie par demande) ; un provider sans historique
+        est essayé en premier"""
+        with self.lock:
+            samples = [(s['calls'], s['ttft'] if s['ttft'] is not None else s['latency'])
+                       for (p, _), s in self.models.items() if p == provider]
+        samples = [(calls, value) for calls, value in samples if calls and value is not None]
+        if not samples:
+            return 0.0
+        return sum(calls * value for calls, value in samples) / sum(calls for calls, _ in samples)
+
+    def choose(self, template):
+        """Provider retenu pour un template (provider actif si aucun candidat sain)"""
+        active = config.get('active_provider', 'mistral')
+        allowed = ROUTER_TEMPLATE_PROVIDERS.get(template) or ROUTER_TEMPLATE_PROVIDERS.get('*') or configured_providers()
+        candidates = [p for p in allowed if p in configured_providers() and self.is_healthy(p)]
+        if not candidates:
+            return active
+        # À score égal, le provider actif est préféré
+        return min(candidates, key=lambda p: (self.score(p), p != active))
+
+    def probe(self, provider):
+        """Sonde de santé : même appel que test_ai_provider (liste des modèles)"""
+        base_url = config.get(f'{provider}_base_url', '').rstrip('/')
+        headers = {'Content-Type': 'application/json'}
+        if provider != 'ollama':
+            headers['Authorization'] = f"Bearer {config.get(f'{provider}_api_key', '')}"
+        url = f"{base_url}/api/tags" if provider == 'ollama' else f"{base_url}/v1/models"
+        started = time.monotonic()
+        try:
+            response = get_http_session(provider, base_url).get(url, headers=headers, timeout=10)
+            response.raise_for_status()
+            ok, error = True, None
+        except requests.exceptions.RequestException as e:
+            ok, error = False, str(e)[:200]
+        with self.lock:
+            self.health[provider] = {'ok': ok, 'latency': round(time.monotonic() - started, 3),
+                                     'error': error, 'checked_at': time.time()}
+            if ok:
+                # Le routeur n'envoie plus d'appels à un provider écarté : chaque sonde réussie
+                # fait décroître son taux d'erreur, pour qu'il soit de nouveau choisi une fois rétabli
+                for (p, _), stats in self.models.items():
+                    if p == provider:
+                        stats['error_rate'] = self._ewma(stats['error_rate'], 0.0)
+        if not ok:
+            logger.warning(f"Sonde {provider} en échec: {error}")
+
+    def _probe_loop(self):
+        while True:
+            for provider in configured_providers():
+                self.probe(provider)
+            time.sleep(ROUTER_PROBE_INTERVAL)
+
+    def ensure_probes(self):
+        if not ROUTING_ENABLED or self._probe_thread is not None:
+            return
+        with self.lock:
+            if self._probe_thread is not None:
+                return
+            self._probe_thread = threading.Thread(target=self._probe_loop, daemon=True, name='provider-probes')
+            self._probe_thread.start()
+
+    def stats(self):
+        with self.lock:
+            models = {f'{p}:{m}': {k: (round(v, 3) if isinstance(v, float) else v) for k, v in s.items()}
+                      for (p, m), s in self.models.items()}
+            health = {p: dict(h) for p, h in self.health.items()}
+        return {'enabled': ROUTING_ENABLED, 'models': models, 'health': health}
+
+provider_router = ProviderRouter()
+
+def configured_providers():
+    """Providers utilisables : URL renseignée et clé API (sauf Ollama, sans clé)"""
+    providers = []
+    for provider in ('mistral', 'openai', 'deepseek', 'gemini', 'ollama'):
+        if not config.get(f'{provider}_base_url'):
+            continue
+        if provider == 'ollama':
+            # Ollama a toujours une URL par défaut : seulement s'il est actif ou explicitement autorisé
+            if config.get('active_provider') != 'ollama' and 'ollama' not in ROUTER_PROVIDERS:
+                continue
+        elif not config.get(f'{provider}_api_key'):
+            continue
+        if ROUTER_PROVIDERS and provider not in ROUTER_PROVIDERS:
+            continue
+        providers.append(provider)
+    return providers
+
+# ============================================
+# COALESCENCE DES GÉNÉRATIONS IDENTIQUES
+# ============================================
+
+class SingleFlight:
+    """Partage un même appel amont entre requêtes identiques simultanées.
+
+    Le premier appelant d'une clé exécute la fonction ; les suivants attendent
+    son résultat (ou son exception) au lieu de relancer un appel au provider.
+    La fonction reçoit la portée d'annulation de l'appel partagé, annulée seulement
+    quand tous les demandeurs ont été annulés (un demandeur sans portée la garde active) ;
+    son échéance est la plus lointaine de celles des demandeurs.
+
+    Variante streamée (stream) : le générateur d'événements SSE tourne dans un thread et
+    chaque demandeur relit tous ses événements depuis le début ; un demandeur streamé qui
+    rejoint un appel non streamé reçoit seulement l'événement final.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.counters = {'leaders': 0, 'followers': 0}
+
+    def _join(self, key, scope, streaming=False):
+        """Rejoint l'appel en cours pour la clé, ou le crée : retourne (appel, premier_demandeur)"""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.counters['followers'] += 1
+                leader = False
+            else:
+                call = {'cond': threading.Condition(), 'finished': False, 'result': None, 'error': None,
+                        'events': [] if streaming else None,
+                        'scope': CancelScope(deadline=scope.deadline if scope is not None else None),
+                        'interested': 0}
+                self.calls[key] = call
+                self.counters['leaders'] += 1
+                leader = True
+            call['interested'] += 1
+        if not leader:
+            call['scope'].extend_deadline(scope.deadline if scope is not None else None)
+        return call, leader
+
+    def _interest(self, call, scope):
+        """Désistement du demandeur (une seule fois), déclenché aussi par l'annulation de sa portée"""
+        released = []
+
+        def abandon():
+            with self.lock:
+                if released:
+                    return
+                released.append(True)
+                call['interested'] -= 1
+                abandoned = call['interested'] == 0
+            if abandoned:
+                call['scope'].cancel()
+        if scope is not None:
+            scope.on_cancel(abandon)
+        return abandon
+
+    def _run(self, key, call, fn):
+        try:
+            call['result'] = fn(call['scope'])
+        except Exception as e:
+            call['error'] = e
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            with call['cond']:
+                call['finished'] = True
+                call['cond'].notify_all()
+
+    def _pump(self, call, events):
+        """Publie les événements du générateur partagé ; retourne sa valeur de retour"""
+        while True:
+            try:
+                event = next(events)
+            except StopIteration as stop:
+                return stop.value
+            with call['cond']:
+                call['events'].append(event)
+                call['cond'].notify_all()
+
+    def do(self, key, fn, scope=None):
+        call, leader = self._join(key, scope)
+        self._interest(call, scope)
+        if leader:
+            self._run(key, call, fn)
+        else:
+            with call['cond']:
+                while not call['finished']:
+                    call['cond'].wait(CLIENT_DISCONNECT_POLL)
+                    if scope is not None:
+                        scope.check()
+        if call['error'] is not None:
+            if leader and scope is not None:
+                scope.check()  # échéance du demandeur dépassée : 504 plutôt que l'erreur de l'appel partagé
+            raise call['error']
+        return call['result']
+
+    def stream(self, key, produce, scope=None, final_event=None):
+        """Générateur : événements de produce(portée partagée), générateur d'événements SSE
+        dont la valeur de retour est le résultat partagé avec les appelants de do (et la
+        valeur de retour de ce générateur).
+
+        final_event(résultat) : événement final d'un demandeur ayant rejoint un appel non streamé.
+        """
+        call, leader = self._join(key, scope, streaming=True)
+        abandon = self._interest(call, scope)
+        if leader:
+            threading.Thread(target=self._run, args=(key, call, lambda shared: self._pump(call, produce(shared))),
+                             name='single-flight', daemon=True).start()
+        return self._subscribe(call, scope, abandon, final_event)
+
+    def _subscribe(self, call, scope, abandon, final_event):
+        index = 0
+        try:
+            while True:
+                with call['cond']:
+                    while not call['finished'] and (call['events'] is None or index >= len(call['events'])):
+                        call['cond'].wait(CLIENT_DISCONNECT_POLL)
+                        if scope is not None:
+                            scope.check()
+                    events = call['events'][index:] if call['events'] is not None else []
+                    finished = call['finished']
+                index += len(events)
+                yield from events
+                if finished:
+                    break
+        finally:
+            # Flux fermé avant la fin (client parti) : l'appel partagé n'est plus attendu par ce demandeur
+            if not call['finished']:
+                abandon()
+        if call['error'] is not None:
+            if scope is not None:
+                scope.check()
+            raise call['error']
+        if call['events'] is None and final_event is not None:
+            yield final_event(call['result'])
+        return call['result']
+
+    def stats(self):
+        with self.lock:
+            return {
+                'upstream_calls': self.counters['leaders'],
+                'saved_calls': self.counters['followers'],
+                'in_flight': len(self.calls),
+            }
+
+report_flight = SingleFlight()
+diagram_flight = SingleFlight()
+
+# Appels amont de comptes rendus réels en cours (JSON, SSE, travaux, sections), hors brouillons
+# spéculatifs : charge consultée avant de démarrer un brouillon
+report_load = {'in_flight': 0}
+report_load_lock = threading.Lock()
+
+@contextmanager
+def real_report_generation(req, key=None):
+    """Compte la génération pendant le bloc, sauf pour un brouillon spéculatif.
+
+    Les brouillons en cours sur le même provider sont préemptés (hors brouillon produisant
+    ce compte rendu, key) : la demande réelle ne les attend ni dans la file Ollama ni
+    derrière le limiteur de débit.
+    """
+    if req.get('speculative'):
+        yield
+        return
+    with report_load_lock:
+        report_load['in_flight'] += 1
+    if SPECULATE_ENABLED:
+        speculative_drafts.preempt(req['provider'], key)
+    try:
+        yield
+    finally:
+        with report_load_lock:
+            report_load['in_flight'] -= 1
+
+def counted_report_events(req, key, events):
+    """Générateur : relaie les événements d'une génération streamée en la comptant"""
+    with real_report_generation(req, key):
+        return (yield from events)
+
+# ============================================
+# CACHE DES DIAGRAMMES MERMAID
+# ============================================
+
+class DiagramCache:
+    """Cache LRU borné des diagrammes validés, avec persistance JSON optionnelle"""
+
+    def __init__(self, max_entries, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            for key, value in stored[-self.max_entries:]:
+                self.entries[key] = value
+        except FileNotFoundError:
+            return
+        except (OSError, TypeError, ValueError) as e:
+            # JSON valide mais de forme inattendue compris : on repart d'un cache vide
+            self.entries.clear()
+            logger.warning(f"Cache diagrammes illisible ({self.path}): {e}")
+            return
+        logger.info(f"Cache diagrammes chargé: {len(self.entries)} entrées")
+
+    def _save(self):
+        """Écrit le cache sur disque (appelé sous verrou)"""
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(list(self.entries.items()), f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Sauvegarde du cache diagrammes impossible: {e}")
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.counters['writes'] += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+            if self.path:
+                self._save()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({'entries': len(self.entries), 'max_entries': self.max_entries,
+                          'persistent': bool(self.path)})
+        return stats
+
+diagram_cache = DiagramCache(DIAGRAM_CACHE_MAX_ENTRIES, DIAGRAM_CACHE_FILE or None)
+
+def normalize_diagram_prompt(prompt):
+    """Forme canonique d'une description : casse, ponctuation et espaces repliés"""
+    text = unicodedata.normalize('NFKC', prompt).casefold()
+    text = ''.join(' ' if unicodedata.category(ch).startswith('P') else ch for ch in text)
+    return ' '.join(text.split())
+
+def diagram_cache_key(prompt, model, provider):
+    """Clé de cache d'un diagramme : description normalisée, provider et modèle"""
+    if not model and provider != 'ollama':
+        model = DEFAULT_MODELS.get(provider, 'mistral-medium-latest')
+    material = f"{provider}\n{model}\n{normalize_diagram_prompt(prompt)}"
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def generate_diagram_code(prompt, model, provider, force_regenerate=False, scope=None):
+    """Génère (ou relit en cache) un diagramme validé : retourne (code, depuis_le_cache)
+    (scope : portée d'annulation du demandeur)"""
+    key = diagram_cache_key(prompt, model, provider)
+    if not force_regenerate:
+        cached = diagram_cache.get(key)
+        if cached is not None:
+            logger.info(f"Diagramme servi depuis le cache ({provider})")
+            return cached, True
+    
+    def call_provider(shared_scope):
+        slot = (ollama_scheduler.slot(model, mermaid_request_tokens(prompt), shared_scope)
+                if provider == 'ollama' else nullcontext())
+        try:
+            with slot as ticket:
+                shared_scope.check()
+                response, fragments = open_mermaid_stream(prompt, ticket.model if ticket else model, provider,
+                                                          shared_scope)
+                shared_scope.attach(response)
+                try:
+                    mermaid_code = collect_mermaid_stream(response, fragments, provider)
+                finally:
+                    shared_scope.detach(response)
+        except requests.exceptions.RequestException as e:
+            shared_scope.check()
+            raise diagram_provider_error(e, provider)
         
         if not is_valid_mermaid(mermaid_code):
             logger.warning(f"Code Mermaid invalide généré par {provider}: {mermaid_code[:100]}...")
-            return jsonify({'error': 'Réponse invalide: pas de code Mermaid détecté'}), 422
-        
-        logger.info(f"Diagramme généré avec succès via {provider}")
-        return jsonify({'mermaid': mermaid_code})
+            raise GenerationError('Réponse invalide: pas de code Mermaid détecté', 422)
         
-    except requests.exceptions.Timeout:
-        return jsonify({'error': f'Timeout: {provider} ne répond pas'}), 408
-    except requests.exceptions.HTTPError as e:
-        if hasattr(e, 'response') and e.response is not None:
-            status = e.response.status_code
-            if status == 401:
-                return jsonify({'error': f'Clé API {provider} invalide'}), 401
-            elif status == 403:
-                return jsonify({'error': f'Accès non autorisé à {provider}'}), 403
-            elif status == 429:
-                return jsonify({'error': f'Limite de débit {provider} atteinte'}), 429
-            else:
-                return jsonify({'error': f'Erreur {provider}: {status}'}), 503
-        return jsonify({'error': f'Erreur HTTP {provider}'}), 503
-    except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Erreur connexion {provider}: {str(e)}'}), 503
-    except KeyError as e:
-        return jsonify({'error': f'Réponse {provider} malformée: {str(e)}'}), 502
-    except Exception as e:
-        return jsonify({'error': f'Erreur {provider}: {str(e)}'}), 500
+        # Seuls les diagrammes validés sont mis en cache
+        diagram_cache.put(key, mermaid_code)
+        return mermaid_code
+    
+    # Les demandes identiques simultanées partagent le même appel au provider
+    return diagram_flight.do(key, call_provider, scope), False
 
 def clean_squares(text):
     """Nettoie les carrés et symboles de la zone 'Geometric Shapes' et similaires.
@@ -3892,28 +5570,13 @@ def is_valid_mermaid(text):
         lines = text.split('\n')
         text = '\n'.join(lines[1:-1]) if len(lines) > 2 else text
     
-    # Patterns Mermaid courants
-    patterns = [
-        r'flowchart\s+(TD|LR|TB|RL|BT)',
-        r'sequenceDiagram',
-        r'classDiagram',
-        r'stateDiagram',
-        r'erDiagram',
-        r'gantt',
-        r'pie\s+(title|showData)',
-        r'graph\s+(TD|LR|TB|RL|BT)',
-        r'journey',
-        r'gitGraph',
-        r'gitgraph'
-    ]
-    
-    return any(re.search(pattern, text, re.IGNORECASE) for pattern in patterns)
+    return any(re.search(pattern, text, re.IGNORECASE) for pattern in MERMAID_PATTERNS)
 
 @app.route('/api/ollama/models')
 def ollama_models():
     try:
         url = f"{config['ollama_base_url']}/api/tags"
-        response = requests.get(url, timeout=10)
+        response = get_http_session('ollama').get(url, timeout=10)
         response.raise_for_status()
         
         data = response.json()
@@ -3951,7 +5614,7 @@ def mistral_models():
             'Content-Type': 'application/json'
         }
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = get_http_session('mistral', base_url).get(url, headers=headers, timeout=10)
         
         response.raise_for_status()
         
@@ -3996,6 +5659,7 @@ def get_settings():
 def update_mistral_settings():
     try:
         data = request.json
+        previous = (config['mistral_base_url'], config['mistral_api_key'])
         
         # Mettre à jour la config en mémoire
         if 'base_url' in data:
@@ -4009,6 +5673,10 @@ def update_mistral_settings():
             'MISTRAL_BASE_URL': config['mistral_base_url'],
             'MISTRAL_API_KEY': config['mistral_api_key']
         })
+        
+        # Reconstruire le pool de connexions si la cible a changé
+        if (config['mistral_base_url'], config['mistral_api_key']) != previous:
+            reset_http_sessions('mistral')
             
         return jsonify({
             'success': True,
@@ -4041,7 +5709,7 @@ def test_ai_provider():
         
         logger.info(f"Test connexion {provider} - URL: {url}")
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = get_http_session(provider, base_url).get(url, headers=headers, timeout=10)
         response.raise_for_status()
         
         result = response.json()
@@ -4083,6 +5751,7 @@ def save_ai_settings():
         provider = data.get('provider', 'mistral')
         base_url = data.get('base_url', '').rstrip('/')
         api_key = data.get('api_key', '')
+        previous = (config.get(f'{provider}_base_url'), config.get(f'{provider}_api_key'))
         
         # Sauvegarder dans la config en mémoire
         config[f'{provider}_base_url'] = base_url
@@ -4107,6 +5776,10 @@ def save_ai_settings():
         
         update_env_file(env_updates)
         
+        # Reconstruire le pool de connexions si l'URL ou la clé a changé
+        if (base_url, api_key) != previous:
+            reset_http_sessions(provider)
+        
         logger.info(f"Paramètres {provider} sauvegardés")
         
         return jsonify({
@@ -4143,7 +5816,7 @@ def get_ai_models():
         else:
             url = f"{base_url}/v1/models"
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = get_http_session(provider, base_url).get(url, headers=headers, timeout=10)
         response.raise_for_status()
         
         result = response.json()
@@ -4173,159 +5846,2506 @@ def get_ai_models():
         logger.error(f"Erreur chargement modèles {provider}: {str(e)}")
         return jsonify({'error': f'Erreur: {str(e)}'}), 500
 
-@app.route('/api/generate-report', methods=['POST'])
-def generate_report():
-    """Génère un compte rendu professionnel à partir de notes brutes"""
-    try:
-        # Validation JSON
-        if not request.json:
-            return jsonify({'error': 'Corps JSON requis'}), 400
-        
-        data = request.json
-        notes = data.get('notes', '').strip()
-        template = data.get('template', 'client_formel')
-        meta = data.get('meta', {})
-        
-        # Validation notes
-        if not notes:
-            return jsonify({'error': 'Notes requises'}), 400
-        
-        # Validation taille (protection DoS)
-        if len(notes) > MAX_NOTES_LENGTH:
-            return jsonify({'error': f'Notes trop longues (max {MAX_NOTES_LENGTH} caractères)'}), 400
-        
-        # Aliases pour rétrocompatibilité (migration des anciens IDs)
-        template_aliases = {
-            'audit_technique': 'hpp_audit',
-            'intervention_technique': 'hpp_intervention'
+def report_provider_error(e, provider):
+    """Convertit une exception requests en GenerationError avec un message utilisateur"""
+    if isinstance(e, requests.exceptions.Timeout):
+        return GenerationError(f'Timeout: {provider} ne répond pas dans les délais', 408)
+    if isinstance(e, requests.exceptions.HTTPError):
+        if getattr(e, 'response', None) is not None:
+            if e.response.status_code == 401:
+                return GenerationError(f'Clé API {provider} invalide ou expirée', 401)
+            elif e.response.status_code == 429:
+                return GenerationError(f'Limite de débit {provider} atteinte. Réessayez dans quelques instants.', 429)
+            return GenerationError(f'Erreur {provider}: {e.response.status_code}', 503)
+        return GenerationError(f'Erreur HTTP {provider}: {str(e)}', 503)
+    return GenerationError(f"Erreur de connexion à {provider}: {str(e)}", 503)
+
+class TokenBudget:
+    """Budget de tokens par demande : estimation de l'entrée, statistiques de sortie par
+    template, puis choix de max_tokens et de la gamme de modèle (small / medium / large)"""
+
+    def __init__(self, window=100):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.window = window
+        self.tiers = {'small': 0, 'medium': 0, 'large': 0}
+
+    def record(self, template, text, max_tokens=None):
+        """Enregistre la longueur (en tokens estimés) d'un compte rendu produit"""
+        tokens = estimate_text_tokens(text)
+        # Sortie tronquée par max_tokens : la vraie longueur est inconnue, on l'estime au-dessus
+        if max_tokens and tokens >= max_tokens * 0.9:
+            tokens = int(max_tokens * BUDGET_OUTPUT_MARGIN)
+        with self.lock:
+            self.samples.setdefault(template, deque(maxlen=self.window)).append(tokens)
+
+    def expected_output(self, template, notes_tokens):
+        """Sortie attendue : p95 observé pour le template, sinon valeur par défaut"""
+        if template in BUDGET_ECHO_TEMPLATES:
+            return notes_tokens
+        with self.lock:
+            values = sorted(self.samples.get(template, ()))
+        if len(values) < BUDGET_MIN_SAMPLES:
+            return API_MAX_TOKENS
+        return values[min(len(values) - 1, int(0.95 * len(values)))]
+
+    def plan(self, provider, template, payload, notes):
+        """Retourne (modèle, max_tokens, gamme, tokens d'entrée estimés) pour une demande"""
+        input_tokens = estimate_text_tokens(''.join(m['content'] for m in payload['messages']))
+        expected = self.expected_output(template, estimate_text_tokens(notes))
+        max_tokens = max(BUDGET_MIN_OUTPUT_TOKENS, min(API_MAX_TOKENS, int(expected * BUDGET_OUTPUT_MARGIN)))
+        
+        tier = BUDGET_TEMPLATE_TIERS.get(template)
+        if tier not in self.tiers:
+            total = input_tokens + max_tokens
+            if total <= BUDGET_SMALL_MAX_TOKENS:
+                tier = 'small'
+            elif total >= BUDGET_LARGE_MIN_TOKENS:
+                tier = 'large'
+            else:
+                tier = 'medium'
+        with self.lock:
+            self.tiers[tier] += 1
+        
+        tiers = dict(DEFAULT_MODEL_TIERS.get(provider, {}), **MODEL_TIERS.get(provider, {}))
+        model = tiers.get(tier) or DEFAULT_MODELS.get(provider, 'mistral-medium-latest')
+        return model, max_tokens, tier, input_tokens
+
+    def stats(self):
+        with self.lock:
+            snapshot = {template: sorted(values) for template, values in self.samples.items()}
+            tiers = dict(self.tiers)
+        return {
+            'enabled': BUDGET_ENABLED,
+            'tiers': tiers,
+            'output_tokens': {
+                template: {
+                    'samples': len(values),
+                    'p50': values[len(values) // 2],
+                    'p95': values[min(len(values) - 1, int(0.95 * len(values)))],
+                }
+                for template, values in snapshot.items() if values
+            },
         }
-        if template in template_aliases:
-            template = template_aliases[template]
-        
-        if template not in REPORT_PROMPTS:
-            return jsonify({'error': f'Template inconnu: {template}'}), 400
-        
-        # Utiliser le provider actif
-        provider = config.get('active_provider', 'mistral')
-        base_url = config.get(f'{provider}_base_url', '')
-        api_key = config.get(f'{provider}_api_key', '')
-        
-        if not base_url:
-            return jsonify({'error': f'Provider {provider} non configuré'}), 400
-        
-        if not api_key and provider != 'ollama':
-            return jsonify({'error': f'Clé API {provider} manquante dans la configuration'}), 401
-        
-        # Obtenir la date actuelle pour contexte
-        current_date = datetime.now().strftime("%d/%m/%Y")
-        current_year = datetime.now().year
-        
-        # Construire le prompt utilisateur avec métadonnées
-        context_header = f"CONTEXTE TEMPOREL : Nous sommes le {current_date} (année {current_year}).\n\n"
-        
-        user_prompt = f"Notes de réunion :\n\n{notes}"
-        if meta.get('date'):
-            user_prompt = f"Date de la réunion : {meta['date']}\n\n" + user_prompt
-        if meta.get('participants'):
-            user_prompt = f"Participants : {meta['participants']}\n\n" + user_prompt
-        
-        # Ajouter le contexte temporel au début
-        user_prompt = context_header + user_prompt
-        
-        # Appel API (compatible OpenAI)
-        url = f"{base_url}/v1/chat/completions"
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        if provider != 'ollama':
-            headers['Authorization'] = f"Bearer {api_key}"
-        
-        # Modèles par défaut selon le provider
-        default_models = {
-            'mistral': 'mistral-medium-latest',
-            'openai': 'gpt-4-turbo-preview',
-            'deepseek': 'deepseek-chat',
-            'gemini': 'gemini-pro'
-        }
-        model = default_models.get(provider, 'mistral-medium-latest')
-        
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": REPORT_PROMPTS[template]},
-                {"role": "user", "content": user_prompt}
-            ],
-            "temperature": 0.3,
-            "max_tokens": 3000
-        }
-        
-        logger.info(f"API call {provider} -> {url} | model={model}")
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=API_TIMEOUT)
-        
-        logger.info(f"Generation CR via {provider} - Template: {template}, Status: {response.status_code}")
+
+token_budget = TokenBudget()
+
+def prepare_report_request(data, provider=None):
+    """Valide une demande de compte rendu et construit l'appel API correspondant
+    (provider actif par défaut)"""
+    if not data:
+        raise GenerationError('Corps JSON requis', 400)
+    
+    notes = data.get('notes', '').strip()
+    template = data.get('template', 'client_formel')
+    meta = data.get('meta', {})
+    
+    # Validation notes
+    if not notes:
+        raise GenerationError('Notes requises', 400)
+    
+    # Validation taille (protection DoS) ; au-delà de MAX_NOTES_LENGTH, génération en map-reduce
+    max_length = LONG_NOTES_MAX_LENGTH if MAP_REDUCE_ENABLED else MAX_NOTES_LENGTH
+    if len(notes) > max_length:
+        raise GenerationError(f'Notes trop longues (max {max_length} caractères)', 400)
+    
+    # Aliases pour rétrocompatibilité (migration des anciens IDs)
+    template = TEMPLATE_ALIASES.get(template, template)
+    
+    if template not in REPORT_PROMPTS:
+        raise GenerationError(f'Template inconnu: {template}', 400)
+    
+    # Utiliser le provider demandé, sinon le plus rapide (routage activé) ou le provider actif
+    if provider is None:
+        provider = provider_router.choose(template) if ROUTING_ENABLED else config.get('active_provider', 'mistral')
+    base_url = config.get(f'{provider}_base_url', '')
+    api_key = config.get(f'{provider}_api_key', '')
+    
+    if not base_url:
+        raise GenerationError(f'Provider {provider} non configuré', 400)
+    
+    if not api_key and provider != 'ollama':
+        raise GenerationError(f'Clé API {provider} manquante dans la configuration', 401)
+    
+    user_prompt = build_report_user_prompt(notes, meta)
+    
+    # Appel API (compatible OpenAI)
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    if provider != 'ollama':
+        headers['Authorization'] = f"Bearer {api_key}"
+    
+    model = DEFAULT_MODELS.get(provider, 'mistral-medium-latest')
+    
+    # Sortie structurée : arbre de sections JSON au lieu de Markdown
+    structured = bool(data.get('structured', STRUCTURED_OUTPUT_ENABLED))
+    system_prompt = REPORT_PROMPTS[template]
+    if structured:
+        system_prompt = f"{system_prompt}\n\n{STRUCTURED_OUTPUT_PROMPT}"
+    elif REPORT_STOP_SEQUENCES_ENABLED:
+        system_prompt = f"{system_prompt}\n\n{REPORT_END_PROMPT}"
+    
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "temperature": 0.3,
+        "max_tokens": 3000
+    }
+    if provider == 'openai':
+        # Regroupe les appels d'un même template sur les serveurs qui ont son prompt en cache
+        payload['prompt_cache_key'] = f"smartreport-{template}"
+    if REPORT_STOP_SEQUENCES_ENABLED and not structured:
+        # Le provider s'arrête au marqueur de fin : ni commentaire final ni tokens superflus
+        payload['stop'] = [REPORT_END_MARKER]
+    
+    budget = None
+    if BUDGET_ENABLED:
+        model, max_tokens, tier, input_tokens = token_budget.plan(provider, template, payload, notes)
+        payload.update(model=model, max_tokens=max_tokens)
+        budget = {'tier': tier, 'input_tokens': input_tokens, 'max_tokens': max_tokens}
+        logger.info(f"Budget {template}: ~{input_tokens} tokens en entrée, max_tokens={max_tokens}, modèle {model} ({tier})")
+    
+    return {
+        'provider': provider,
+        'base_url': base_url,
+        # Ollama : API native, seule à accepter num_ctx et keep_alive
+        'url': f"{base_url.rstrip('/')}/api/chat" if provider == 'ollama' else f"{base_url}/v1/chat/completions",
+        'headers': headers,
+        'payload': payload,
+        'template': template,
+        'notes': notes,
+        'meta': meta,
+        # Ignorer le cache des comptes rendus ("forcer la régénération")
+        'force_regenerate': bool(data.get('force_regenerate')),
+        # Requête de secours vers un second provider si le premier tarde (opt-in)
+        'hedge': bool(data.get('hedge', HEDGE_ENABLED)),
+        # Sections du template rédigées en parallèle puis assemblées (templates longs)
+        'sections_parallel': bool(data.get('sections_parallel', SECTIONS_PARALLEL_ENABLED and template in SECTIONS_PARALLEL_TEMPLATES))
+                             and template_sections(template) is not None and not structured,
+        # Réponse JSON validée (arbre de sections) au lieu de Markdown
+        'structured': structured,
+        'budget': budget,
+        'data': data,
+    }
+
+def build_report_user_prompt(notes, meta, notes_label='Notes de réunion'):
+    """Construit le prompt utilisateur (métadonnées, notes, contexte temporel).
+
+    Le contexte temporel change chaque jour : placé en fin de message, il laisse le
+    début de la requête (prompt du template puis notes) identique d'un appel à l'autre,
+    ce qui profite au cache de préfixe des providers.
+    """
+    # Obtenir la date actuelle pour contexte
+    current_date = datetime.now().strftime("%d/%m/%Y")
+    current_year = datetime.now().year
+    
+    # Construire le prompt utilisateur avec métadonnées
+    user_prompt = f"{notes_label} :\n\n{notes}"
+    if meta.get('date'):
+        user_prompt = f"Date de la réunion : {meta['date']}\n\n" + user_prompt
+    if meta.get('participants'):
+        user_prompt = f"Participants : {meta['participants']}\n\n" + user_prompt
+    
+    # Ajouter le contexte temporel à la fin
+    return user_prompt + f"\n\nCONTEXTE TEMPOREL : Nous sommes le {current_date} (année {current_year})."
+
+def derive_report_request(req, system=None, user=None, **payload_overrides):
+    """Copie d'une demande préparée avec d'autres messages ou paramètres d'appel"""
+    system_message, user_message = req['payload']['messages']
+    messages = [
+        {"role": "system", "content": system if system is not None else system_message['content']},
+        {"role": "user", "content": user if user is not None else user_message['content']},
+    ]
+    return dict(req, payload=dict(req['payload'], messages=messages, **payload_overrides))
+
+def cut_at_stop(text, stops):
+    """Texte coupé à la première séquence d'arrêt (provider qui ne les applique pas)"""
+    positions = [text.find(stop) for stop in stops or [] if stop and stop in text]
+    return text[:min(positions)] if positions else text
+
+def call_report_provider(req):
+    """Appel non streamé au provider : retourne le texte brut de la complétion.
+
+    Une demande annulable (req['scope']) passe par un appel streamé agrégé, seul moyen
+    de couper la connexion amont si le client s'en va.
+    """
+    if req.get('scope') is not None:
+        return call_report_provider_stream(req, req['scope'])
+    with provider_router.observe(req['provider'], req['payload']['model']):
+        return post_report_completion(req)
+
+def post_report_completion(req):
+    provider = req['provider']
+    # Ollama : l'appel attend son créneau ici, le délai API_TIMEOUT ne court qu'ensuite
+    with ollama_slot(provider, req['payload'], tag=req.get('queue_tag')) as ticket:
+        payload = structured_output_payload(provider, req['payload']) if req.get('structured') else req['payload']
+        payload = ollama_chat_payload(payload, model=ticket.model) if ticket else payload
+        logger.info(f"API call {provider} -> {req['url']} | model={payload['model']}")
         
+        try:
+            response = send_to_provider(provider, req['payload'], lambda: get_http_session(provider, req['base_url']).post(
+                req['url'], json=payload, headers=req['headers'], timeout=API_TIMEOUT))
+            
+            logger.info(f"Generation CR via {provider} - Template: {req['template']}, Status: {response.status_code}")
+            
+            if response.status_code != 200:
+                logger.error(f"Erreur API {provider}: {response.status_code}")
+                logger.debug(f"Response: {response.text[:500]}")
+            
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise report_provider_error(e, provider)
+    
+    try:
+        result = response.json()
+    except ValueError as e:
+        logger.error(f"Erreur parsing JSON: {e}")
+        logger.debug(f"Response text: {response.text[:1000]}")
+        raise GenerationError(f'Réponse {provider} non-JSON: {str(e)}', 502)
+    
+    prompt_cache_tracker.record(provider, result.get('usage') if isinstance(result, dict) else None)
+    try:
+        if provider == 'ollama':
+            content = result['message']['content']
+        else:
+            content = result['choices'][0]['message']['content']
+        return cut_at_stop(content, req['payload'].get('stop')).strip()
+    except (KeyError, IndexError) as e:
+        logger.error(f"Structure de réponse invalide: {e}")
+        logger.debug(f"Result keys: {result.keys() if isinstance(result, dict) else type(result)}")
+        logger.debug(f"Result: {str(result)[:500]}")
+        raise GenerationError(f'Réponse {provider} mal structurée: {str(e)}', 502)
+
+def open_report_stream(req, model=None, scope=None):
+    """Ouvre une complétion streamée (stream: true) et retourne la réponse HTTP en cours
+    (model : modèle Ollama attribué par l'ordonnanceur, si différent de la demande ;
+    scope : portée dont l'échéance borne l'appel)"""
+    provider = req['provider']
+    payload = structured_output_payload(provider, req['payload']) if req.get('structured') else req['payload']
+    if provider == 'ollama':
+        payload = ollama_chat_payload(payload, stream=True, model=model)
+    else:
+        payload = dict(payload, stream=True)
+    if provider == 'openai':
+        # OpenAI n'envoie le bloc usage (tokens en cache compris) en streaming que sur demande
+        payload['stream_options'] = {'include_usage': True}
+    logger.info(f"API stream {provider} -> {req['url']} | model={payload['model']}")
+    
+    try:
+        response = send_to_provider(provider, payload, lambda: get_http_session(provider, req['base_url']).post(
+            req['url'], json=payload, headers=req['headers'], timeout=call_timeout(scope), stream=True), scope)
         if response.status_code != 200:
             logger.error(f"Erreur API {provider}: {response.status_code}")
-            logger.debug(f"Response: {response.text[:500]}")
-        
         response.raise_for_status()
-        
+    except requests.exceptions.RequestException as e:
+        raise report_provider_error(e, provider)
+    
+    # Les flux SSE n'annoncent pas toujours de charset : forcer l'UTF-8
+    response.encoding = 'utf-8'
+    return response
+
+class LatencyTracker:
+    """Latences récentes (temps jusqu'au premier token) par provider"""
+
+    def __init__(self, window=100):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.window = window
+
+    def record(self, provider, seconds):
+        with self.lock:
+            self.samples.setdefault(provider, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, provider, pct):
+        """Percentile des latences récentes, ou None si l'historique est insuffisant"""
+        with self.lock:
+            values = sorted(self.samples.get(provider, ()))
+        if len(values) < HEDGE_MIN_SAMPLES:
+            return None
+        rank = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+        return values[rank]
+
+    def stats(self):
+        with self.lock:
+            snapshot = {provider: list(values) for provider, values in self.samples.items()}
+        return {
+            provider: {
+                'samples': len(values),
+                'p50': round(sorted(values)[len(values) // 2], 3),
+                'max': round(max(values), 3),
+            }
+            for provider, values in snapshot.items() if values
+        }
+
+class PromptCacheTracker:
+    """Tokens d'entrée servis depuis le cache de préfixe des providers (champ usage des réponses)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    @staticmethod
+    def cached_tokens(usage):
+        """Tokens en cache annoncés par le provider, ou None s'il ne les indique pas"""
+        details = usage.get('prompt_tokens_details') or {}
+        if details.get('cached_tokens') is not None:
+            return details['cached_tokens']  # OpenAI, Mistral
+        if usage.get('prompt_cache_hit_tokens') is not None:
+            return usage['prompt_cache_hit_tokens']  # DeepSeek
+        return None
+
+    def record(self, provider, usage):
+        if not isinstance(usage, dict):
+            return
+        cached = self.cached_tokens(usage)
+        with self.lock:
+            counters = self.counters.setdefault(provider, {
+                'calls': 0, 'reported': 0, 'hits': 0, 'prompt_tokens': 0, 'cached_tokens': 0})
+            counters['calls'] += 1
+            counters['prompt_tokens'] += int(usage.get('prompt_tokens') or 0)
+            if cached is not None:
+                counters['reported'] += 1
+                counters['cached_tokens'] += int(cached)
+                if cached:
+                    counters['hits'] += 1
+
+    def stats(self):
+        with self.lock:
+            snapshot = {provider: dict(counters) for provider, counters in self.counters.items()}
+        for counters in snapshot.values():
+            counters['cached_ratio'] = (round(counters['cached_tokens'] / counters['prompt_tokens'], 3)
+                                        if counters['prompt_tokens'] else None)
+        return snapshot
+
+ttft_tracker = LatencyTracker()
+prompt_cache_tracker = PromptCacheTracker()
+hedge_counters = {'hedged': 0, 'primary_wins': 0, 'secondary_wins': 0}
+hedge_counters_lock = threading.Lock()
+
+def call_report_provider_stream(req, scope=None, on_first_token=None):
+    """Appel streamé agrégé : même résultat que call_report_provider, mais annulable et mesuré"""
+    scope = scope or CancelScope()
+    scope.check()
+    text = ''.join(stream_report_attempt(req, scope, on_first_token))
+    scope.check()
+    # Marqueur de fin éventuellement reçu (séquence d'arrêt ignorée) : jamais recopié dans le rapport
+    return cut_at_stop(text, req['payload'].get('stop')).strip()
+
+def stream_report_attempt(req, scope, on_first_token=None, ticket=None):
+    """Générateur : fragments bruts d'une complétion streamée, mesurée par le routeur.
+
+    S'arrête après une séquence d'arrêt ignorée par le provider ; fermé plus tôt par
+    l'appelant (rapport terminé), il lit encore la fin du flux pour le bloc usage.
+    ticket : créneau Ollama déjà attribué (sinon réservé ici pour Ollama).
+    """
+    started = time.monotonic()
+    stops = req['payload'].get('stop') or []
+    tail = ''
+    slot = nullcontext(ticket) if ticket else ollama_slot(req['provider'], req['payload'], scope, req.get('queue_tag'))
+    with provider_router.observe(req['provider'], req['payload']['model']) as marks, slot as ticket:
         try:
-            result = response.json()
-        except ValueError as e:
-            logger.error(f"Erreur parsing JSON: {e}")
-            logger.debug(f"Response text: {response.text[:1000]}")
-            return jsonify({'error': f'Réponse {provider} non-JSON: {str(e)}'}), 502
-        
+            response = open_report_stream(req, model=ticket.model if ticket else None, scope=scope)
+        except requests.exceptions.RequestException as e:
+            scope.check()
+            raise report_provider_error(e, req['provider'])
+        scope.attach(response)
+        fragments = iter_provider_stream(req['provider'], response,
+                                         lambda usage: prompt_cache_tracker.record(req['provider'], usage))
         try:
-            report = result['choices'][0]['message']['content'].strip()
-        except (KeyError, IndexError) as e:
-            logger.error(f"Structure de réponse invalide: {e}")
-            logger.debug(f"Result keys: {result.keys() if isinstance(result, dict) else type(result)}")
-            logger.debug(f"Result: {str(result)[:500]}")
-            return jsonify({'error': f'Réponse {provider} mal structurée: {str(e)}'}), 502
-        
-        # Nettoyer le rapport : extraire UNIQUEMENT le Markdown pur
-        # Cas 1 : Markdown dans un bloc de code ```markdown ... ```
-        if '```markdown' in report:
-            match = re.search(r'```markdown\s*\n(.*?)\n```', report, re.DOTALL)
-            if match:
-                report = match.group(1).strip()
-        # Cas 2 : Bloc de code générique ``` ... ```
-        elif '```' in report:
-            match = re.search(r'```\s*\n(.*?)\n```', report, re.DOTALL)
+            for text in fragments:
+                if 'ttft' not in marks:
+                    marks['ttft'] = time.monotonic() - started
+                    ttft_tracker.record(req['provider'], marks['ttft'])
+                    if on_first_token:
+                        on_first_token()
+                scope.check()
+                try:
+                    yield text
+                except GeneratorExit:
+                    drain_stream_usage(req['provider'], fragments, scope)
+                    return
+                # Séquence d'arrêt ignorée par le provider : la suite n'est plus relayée
+                tail = tail[-32:] + text
+                if stops and any(stop in tail for stop in stops):
+                    drain_stream_usage(req['provider'], fragments, scope)
+                    break
+        except requests.exceptions.RequestException as e:
+            scope.check()
+            raise report_provider_error(e, req['provider'])
+        finally:
+            scope.detach(response)
+            response.close()
+
+def drain_stream_usage(provider, fragments, scope):
+    """Lit sans les relayer les fragments restants d'un flux arrêté tôt, pour recevoir le bloc usage
+    du dernier fragment (providers compatibles OpenAI), au plus REPORT_USAGE_DRAIN_SECONDS"""
+    if provider == 'ollama' or REPORT_USAGE_DRAIN_SECONDS <= 0:
+        return
+    deadline = time.monotonic() + REPORT_USAGE_DRAIN_SECONDS
+    try:
+        for _ in fragments:
+            if scope.cancelled or time.monotonic() > deadline:
+                return
+    except requests.exceptions.RequestException:
+        pass  # fin du flux illisible : seule la mesure des tokens en cache est perdue
+
+def hedge_secondary_provider(primary):
+    """Provider de secours pour le hedging (HEDGE_PROVIDERS ou premier provider configuré)"""
+    candidates = HEDGE_PROVIDERS or ['mistral', 'openai', 'deepseek', 'gemini']
+    for provider in candidates:
+        if provider == primary or not config.get(f'{provider}_base_url'):
+            continue
+        if provider == 'ollama' or config.get(f'{provider}_api_key'):
+            return provider
+    return None
+
+def hedge_delay(provider):
+    """Délai avant requête de secours : percentile HEDGE_PERCENTILE du TTFT récent du provider"""
+    observed = ttft_tracker.percentile(provider, HEDGE_PERCENTILE)
+    if observed is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, observed)
+
+def hedge_request(req, secondary, delay):
+    """Demande de secours vers secondary, ou None si ce provider ne peut pas la prendre.
+
+    Mêmes messages que la demande principale (condensé du map-reduce, section à régénérer...) :
+    seuls le provider, son modèle et ses en-têtes changent.
+    """
+    try:
+        system_message, user_message = req['payload']['messages']
+        secondary_req = derive_report_request(
+            prepare_report_request(req['data'], provider=secondary),
+            system=system_message['content'],
+            user=user_message['content'],
+            temperature=req['payload'].get('temperature'),
+            max_tokens=req['payload']['max_tokens'],
+        )
+    except GenerationError as e:
+        logger.warning(f"Hedging impossible vers {secondary}: {e.message}")
+        return None
+    secondary_req['structured'] = req.get('structured', False)
+    logger.info(f"Hedging: {req['provider']} sans premier token après {delay:.1f}s, envoi vers {secondary}")
+    with hedge_counters_lock:
+        hedge_counters['hedged'] += 1
+    return secondary_req
+
+def call_report_provider_hedged(req):
+    """Appel avec requête de secours : si le provider principal tarde à produire son
+    premier token, la même demande part vers un second provider ; la première réponse
+    complète l'emporte et l'autre appel est annulé.
+    """
+    primary = req['provider']
+    secondary = hedge_secondary_provider(primary)
+    if secondary is None:
+        return call_report_provider(req)
+    
+    results = queue.Queue()
+    first_token = threading.Event()
+    scopes = {primary: CancelScope(parent=req.get('scope'))}
+    
+    def attempt(attempt_req, on_first_token=None):
+        name = attempt_req['provider']
+        try:
+            results.put((name, call_report_provider_stream(attempt_req, scopes[name], on_first_token), None))
+        except Exception as e:
+            results.put((name, None, e))
+        finally:
+            if on_first_token:
+                on_first_token()
+    
+    threading.Thread(target=attempt, args=(req, first_token.set), daemon=True).start()
+    
+    delay = hedge_delay(primary)
+    if not first_token.wait(delay):
+        secondary_req = hedge_request(req, secondary, delay)
+        if secondary_req is not None:
+            scopes[secondary] = CancelScope(parent=req.get('scope'))
+            threading.Thread(target=attempt, args=(secondary_req,), daemon=True).start()
+    
+    error = None
+    for _ in range(len(scopes)):
+        name, text, exc = results.get()
+        if exc is None:
+            for other, scope in scopes.items():
+                if other != name:
+                    scope.cancel()
+            with hedge_counters_lock:
+                hedge_counters['primary_wins' if name == primary else 'secondary_wins'] += 1
+            if name != primary:
+                logger.info(f"Hedging: réponse retenue depuis {name}")
+            return text
+        # Échec d'une tentative : on attend l'autre si elle est encore en cours
+        if error is None or name == primary:
+            error = exc
+    raise error
+
+def hedged_report_fragments(req, scope):
+    """Générateur : fragments bruts d'une complétion streamée avec requête de secours.
+
+    Si le provider principal n'a produit aucun fragment après hedge_delay, la même demande
+    part vers un second provider ; le premier flux qui produit un fragment est relayé
+    et l'autre appel est annulé.
+    """
+    primary = req['provider']
+    secondary = hedge_secondary_provider(primary)
+    if secondary is None:
+        yield from stream_report_attempt(req, scope)
+        return
+    
+    events = queue.Queue()
+    finished = threading.Event()
+    scopes = {primary: CancelScope(parent=scope)}
+    
+    def attempt(attempt_req):
+        name = attempt_req['provider']
+        stream = stream_report_attempt(attempt_req, scopes[name])
+        try:
+            for text in stream:
+                if finished.is_set():
+                    break
+                events.put((name, text, None))
+            events.put((name, None, None))
+        except Exception as e:
+            events.put((name, None, e))
+        finally:
+            # Flux retenu arrêté par le consommateur : fin lue pour le bloc usage, puis fermeture
+            stream.close()
+    
+    threading.Thread(target=attempt, args=(req,), daemon=True).start()
+    delay = hedge_delay(primary)
+    hedge_at = time.monotonic() + delay
+    winner = None
+    ended = {}
+    try:
+        while True:
+            wait = CLIENT_DISCONNECT_POLL
+            if hedge_at is not None:
+                wait = max(0.0, min(wait, hedge_at - time.monotonic()))
+            try:
+                name, text, exc = events.get(timeout=wait)
+            except queue.Empty:
+                scope.check()
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    secondary_req = hedge_request(req, secondary, delay)
+                    if secondary_req is not None:
+                        scopes[secondary] = CancelScope(parent=scope)
+                        threading.Thread(target=attempt, args=(secondary_req,), daemon=True).start()
+                continue
+            
+            if winner is None and text is not None:
+                # Premier fragment : ce flux est relayé, l'autre est coupé
+                winner, hedge_at = name, None
+                for other, other_scope in scopes.items():
+                    if other != name:
+                        other_scope.cancel()
+                with hedge_counters_lock:
+                    hedge_counters['primary_wins' if name == primary else 'secondary_wins'] += 1
+                if name != primary:
+                    logger.info(f"Hedging: flux retenu depuis {name}")
+            if winner is not None and name != winner:
+                continue
+            if text is not None:
+                yield text
+                continue
+            if winner == name:
+                if exc is not None:
+                    raise exc
+                return
+            
+            # Tentative terminée sans fragment : comme en non streamé, pas de secours après
+            # l'échec du principal, et l'autre tentative éventuelle est attendue
+            ended[name] = exc
+            if name == primary:
+                hedge_at = None
+            if hedge_at is None and len(ended) == len(scopes):
+                error = ended.get(primary) or next((e for e in ended.values() if e is not None), None)
+                if error is not None:
+                    raise error
+                return
+    finally:
+        finished.set()
+        for name, attempt_scope in scopes.items():
+            if name != winner:
+                attempt_scope.cancel()
+
+# Consigne ajoutée au prompt des templates : le marqueur sert de séquence d'arrêt
+REPORT_END_PROMPT = f"""FIN DU DOCUMENT : quand le compte rendu est terminé, écris seul sur la dernière ligne {REPORT_END_MARKER} et rien d'autre après (ni commentaire, ni conclusion)."""
+
+def clean_report_markdown(report):
+    """Nettoie le rapport : extrait UNIQUEMENT le Markdown pur (même traitement qu'en streaming :
+    introduction retirée, bloc ```markdown ouvert puis refermé, marqueur de fin)"""
+    cleaner = ReportStreamCleaner()
+    cleaner.feed(report)
+    return cleaner.finish()[1]
+
+class ReportStreamCleaner:
+    """Extrait le Markdown d'une complétion au fil des fragments reçus.
+
+    L'introduction est retenue jusqu'au premier titre ou à l'ouverture d'un bloc
+    ```markdown / ```, puis le texte est relayé au fur et à mesure ; la clôture du
+    bloc de code ou le marqueur de fin (séquence d'arrêt ignorée par le provider)
+    termine le rapport : la suite du flux peut être abandonnée (done).
+    """
+
+    _FENCE_OPEN = re.compile(r'```(?:markdown|md)?[ \t]*\n')
+    _HEADING = re.compile(r'##\s')
+    _FENCE_CLOSE = '\n```'
+
+    def __init__(self, end_marker=REPORT_END_MARKER):
+        self.buffer = ''
+        self.mode = 'preamble'  # preamble -> body | fenced -> done
+        self.emitted = []
+        self.end_marker = end_marker
+        self.ended = False  # marqueur de fin reçu avant tout titre
+
+    @property
+    def done(self):
+        """Rapport terminé : les fragments suivants seraient ignorés"""
+        return self.mode == 'done' or self.ended
+
+    def _emit(self, text):
+        if text:
+            self.emitted.append(text)
+        return text
+
+    def _terminators(self):
+        terminators = [self.end_marker] if self.end_marker else []
+        if self.mode == 'fenced':
+            terminators.append(self._FENCE_CLOSE)
+        return terminators
+
+    def _pending_prefix(self, terminators):
+        """Longueur de la fin du tampon qui pourrait être le début d'un terminateur"""
+        keep = 0
+        for terminator in terminators:
+            for size in range(len(terminator) - 1, keep, -1):
+                if self.buffer.endswith(terminator[:size]):
+                    keep = size
+                    break
+        return keep
+
+    def feed(self, text):
+        """Ajoute un fragment et retourne la partie nettoyée publiable immédiatement"""
+        if self.done:
+            return ''
+        self.buffer += text
+        
+        if self.mode == 'preamble':
+            # Seul le texte précédant un éventuel marqueur de fin peut contenir le début du rapport
+            marker = self.buffer.find(self.end_marker) if self.end_marker else -1
+            head = self.buffer if marker == -1 else self.buffer[:marker]
+            stripped = head.lstrip()
+            fence = self._FENCE_OPEN.search(head)
+            heading = self._HEADING.search(head)
+            if stripped.startswith('#'):
+                self.mode = 'body'
+                self.buffer = self.buffer.lstrip()
+            elif fence and (not heading or fence.start() < heading.start()):
+                self.mode = 'fenced'
+                self.buffer = self.buffer[fence.end():]
+            elif heading:
+                self.mode = 'body'
+                self.buffer = self.buffer[heading.start():]
+            elif marker != -1:
+                # Fin annoncée sans aucun titre : le texte sera conservé tel quel (finish)
+                self.buffer = head
+                self.ended = True
+                return ''
+            else:
+                return ''
+        
+        # Publier jusqu'au premier terminateur, en retenant un éventuel début de terminateur
+        terminators = self._terminators()
+        ends = [index for index in (self.buffer.find(t) for t in terminators) if index != -1]
+        if ends:
+            out = self.buffer[:min(ends)]
+            self.buffer = ''
+            self.mode = 'done'
+            return self._emit(out)
+        keep = self._pending_prefix(terminators)
+        out = self.buffer[:len(self.buffer) - keep]
+        self.buffer = self.buffer[len(out):]
+        return self._emit(out)
+
+    def finish(self):
+        """Termine le flux : retourne le reliquat publiable et le rapport nettoyé complet"""
+        tail = ''
+        if self.mode == 'preamble':
+            # Aucun titre détecté : le texte est conservé tel quel
+            tail = self._emit(self.buffer.strip())
+        elif self.mode in ('body', 'fenced'):
+            tail = self._emit(self.buffer)
+        self.buffer = ''
+        self.mode = 'done'
+        return tail, ''.join(self.emitted).strip()
+
+# ============================================
+# NOTES LONGUES (MAP-REDUCE)
+# ============================================
+
+CONDENSE_PROMPT = """Tu es un assistant de prise de notes chez ENOVACOM.
+Tu reçois UN EXTRAIT de notes de réunion ou d'atelier trop longues pour être traitées d'un seul tenant.
+
+Ta mission : produire un condensé factuel et fidèle de cet extrait, qui servira ensuite à rédiger le compte rendu final.
+
+Règles :
+- Conserve TOUS les faits : décisions, actions (avec responsables et échéances), problèmes, risques, chiffres, dates, noms, versions, références techniques.
+- Supprime les répétitions, hésitations et digressions.
+- N'invente rien, n'interprète pas, ne rédige pas le compte rendu.
+- Garde les titres ou thèmes de l'extrait comme repères.
+- Format : Markdown simple, listes à puces, sans introduction ni conclusion."""
+
+def split_notes(notes, chunk_size):
+    """Découpe des notes en morceaux de chunk_size caractères au plus, aux frontières de
+    paragraphes et en commençant si possible un nouveau morceau à chaque titre"""
+    paragraphs = []
+    for paragraph in re.split(r'\n\s*\n', notes):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Paragraphe trop long : découpe par lignes, puis en dernier recours par caractères
+        while len(paragraph) > chunk_size:
+            cut = paragraph.rfind('\n', 0, chunk_size)
+            if cut <= 0:
+                cut = paragraph.rfind(' ', 0, chunk_size)
+            if cut <= 0:
+                cut = chunk_size
+            paragraphs.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if paragraph:
+            paragraphs.append(paragraph)
+    
+    chunks, current = [], ''
+    for paragraph in paragraphs:
+        is_heading = paragraph.startswith('#')
+        too_long = len(current) + len(paragraph) + 2 > chunk_size
+        # Un titre ouvre un nouveau morceau dès que le morceau courant est à moitié plein
+        if current and (too_long or (is_heading and len(current) > chunk_size // 2)):
+            chunks.append(current)
+            current = ''
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+def condense_notes(req):
+    """Générateur : condense les notes par morceaux en parallèle (phase map).
+
+    Produit un événement de progression par morceau terminé et retourne le condensé
+    fusionné ; une nouvelle passe est faite si le condensé dépasse encore MAX_NOTES_LENGTH.
+    """
+    text = req['notes']
+    for level in range(1, MAP_REDUCE_MAX_PASSES + 1):
+        chunks = split_notes(text, MAP_REDUCE_CHUNK_SIZE)
+        logger.info(f"Map-reduce passe {level}: {len(text)} caractères en {len(chunks)} morceaux")
+        digests = [None] * len(chunks)
+        
+        with ThreadPoolExecutor(max_workers=MAP_REDUCE_CONCURRENCY, thread_name_prefix='condense') as executor:
+            futures = {}
+            for index, chunk in enumerate(chunks):
+                chunk_req = derive_report_request(
+                    req,
+                    system=CONDENSE_PROMPT,
+                    user=f"Extrait {index + 1}/{len(chunks)} des notes :\n\n{chunk}",
+                    temperature=0.2,
+                    max_tokens=MAP_REDUCE_CHUNK_MAX_TOKENS,
+                )
+                chunk_req['structured'] = False
+                futures[executor.submit(call_report_provider, chunk_req)] = index
+            try:
+                for done, future in enumerate(as_completed(futures), start=1):
+                    digests[futures[future]] = future.result()
+                    yield {'stage': 'condense', 'pass': level, 'done': done, 'total': len(chunks)}
+            finally:
+                for future in futures:
+                    future.cancel()
+        
+        text = '\n\n'.join(f"### Partie {index + 1}/{len(chunks)}\n\n{digest}" for index, digest in enumerate(digests))
+        if len(text) <= MAX_NOTES_LENGTH:
+            break
+    else:
+        raise GenerationError(f'Notes trop longues : condensé de {len(text)} caractères après '
+                              f'{MAP_REDUCE_MAX_PASSES} passes (max {MAX_NOTES_LENGTH})', 413)
+    return text
+
+# Condensés récents (notes, provider, modèle) : la génération multi-templates ne condense qu'une fois
+notes_digests = OrderedDict()
+notes_digests_lock = threading.Lock()
+digest_flight = SingleFlight()
+
+def notes_digest_key(req):
+    material = f"{req['provider']}\n{req['payload']['model']}\n{req['notes']}"
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def shared_notes_digest(req):
+    """Générateur : condensé des notes (progression de la phase map), relu en mémoire ou partagé
+    avec une condensation identique en cours (autre template des mêmes notes)"""
+    key = notes_digest_key(req)
+    with notes_digests_lock:
+        digest = notes_digests.get(key)
+        if digest is not None:
+            notes_digests.move_to_end(key)
+            return digest
+    
+    def produce(shared_scope):
+        digest = yield from condense_notes(dict(req, scope=shared_scope))
+        with notes_digests_lock:
+            notes_digests[key] = digest
+            while len(notes_digests) > MAP_REDUCE_DIGEST_CACHE_SIZE:
+                notes_digests.popitem(last=False)
+        return digest
+    
+    return (yield from digest_flight.stream(key, produce, req.get('scope')))
+
+def map_reduce_request(req):
+    """Demande de la phase reduce : le template s'applique au condensé des notes"""
+    digest = yield from shared_notes_digest(req)
+    return derive_report_request(req, user=build_report_user_prompt(
+        digest, req['meta'], notes_label='Notes de réunion (condensé de notes longues, par parties)'))
+
+def needs_map_reduce(req):
+    return len(req['notes']) > MAX_NOTES_LENGTH
+
+def drain(generator):
+    """Consomme un générateur et retourne sa valeur de retour"""
+    while True:
+        try:
+            next(generator)
+        except StopIteration as stop:
+            return stop.value
+
+# ============================================
+# TEMPLATES LONGS (SECTIONS EN PARALLÈLE)
+# ============================================
+
+# Prompt système commun à toutes les parties d'un document (préfixe identique, cache provider)
+SECTION_PROMPT = """{preamble}
+
+Ce document est rédigé en plusieurs parties générées en parallèle à partir des mêmes notes, puis assemblées dans l'ordre.
+La partie à rédiger et sa structure sont indiquées à la fin du message utilisateur.
+
+Plan complet du document (pour situer ta partie et éviter les redites) :
+{outline}
+
+IMPORTANT : Renvoie UNIQUEMENT le Markdown de la partie demandée. PAS de bloc de code ```, PAS d'introduction, PAS de contenu appartenant aux autres parties.
+
+{role}"""
+
+# Consigne propre à une partie, ajoutée après les notes partagées
+SECTION_PART_PROMPT = """Tu rédiges UNIQUEMENT la partie {index}/{total}.
+
+Structure OBLIGATOIRE de ta partie :
+{skeleton}
+
+Commence directement par {heading}."""
+
+CONSISTENCY_PROMPT = """Tu es relecteur de documents techniques chez ENOVACOM.
+Le document fourni a été rédigé section par section, en parallèle, à partir des mêmes notes.
+
+Ta mission : vérifier la cohérence ENTRE les sections (noms, dates, versions, chiffres, numéros d'actions, renvois vers d'autres sections ou annexes) et corriger les contradictions.
+
+Réponds UNIQUEMENT par un objet JSON de la forme :
+{"corrections": [{"avant": "extrait exact du document", "apres": "texte corrigé"}]}
+
+Règles :
+- "avant" est copié à l'identique depuis le document et suffisamment long pour n'y apparaître qu'une fois.
+- Corrige uniquement les incohérences : ne reformule pas, ne complète pas les sections.
+- S'il n'y a rien à corriger : {"corrections": []}"""
+
+SECTION_MIN_CHARS = 400  # les sections plus courtes du squelette sont regroupées avec la suivante
+
+def template_sections(template):
+    """Découpe la structure obligatoire d'un template en parties générables séparément.
+
+    Retourne (préambule, rôle, parties) ou None si le template n'a pas de structure
+    exploitable. Les parties suivent les titres ## (ou ### si le document n'a qu'un
+    titre ##), les plus courtes étant regroupées avec la suivante.
+    """
+    parsed = template_structure(template)
+    if parsed is None:
+        return None
+    preamble, role, structure = parsed
+
+    level = '##' if len(re.findall(r'^##\s', structure, re.MULTILINE)) > 1 else '###'
+    sections = [part.strip() for part in re.split(rf'(?m)^(?={level}\s)', structure) if part.strip()]
+
+    parts = []
+    for section in sections:
+        if parts and len(parts[-1]) < SECTION_MIN_CHARS:
+            parts[-1] = f"{parts[-1]}\n\n{section}"
+        else:
+            parts.append(section)
+    if len(parts) < 2:
+        return None
+    return preamble, role, parts
+
+def template_structure(template):
+    """Sépare le prompt d'un template en (préambule, rôle, structure obligatoire), ou None"""
+    prompt = REPORT_PROMPTS[template]
+    marker = re.search(r'^structure obligatoire.*$', prompt, re.IGNORECASE | re.MULTILINE)
+    if not marker:
+        return None
+    end = prompt.find('\nIMPORTANT', marker.end())
+    if end == -1:
+        return None
+    role = re.search(r'^Ton rôle.*$', prompt[end:], re.MULTILINE)
+    return prompt[:marker.start()].strip(), role.group(0) if role else '', prompt[marker.end():end].strip()
+
+def clean_section_markdown(text):
+    """Nettoie une partie générée : bloc de code retiré, texte avant le premier titre ignoré"""
+    match = re.search(r'```(?:markdown|md)?[ \t]*\n(.*?)\n```', text, re.DOTALL)
+    if match:
+        text = match.group(1)
+    heading = re.search(r'^#{2,}\s', text, re.MULTILINE)
+    if heading:
+        text = text[heading.start():]
+    return text.strip()
+
+def apply_consistency_corrections(report, answer):
+    """Applique les corrections JSON de la passe de cohérence (extraits introuvables ou ambigus ignorés)"""
+    match = re.search(r'\{.*\}', answer, re.DOTALL)
+    try:
+        corrections = json.loads(match.group(0)).get('corrections', []) if match else []
+    except (ValueError, AttributeError):
+        logger.warning("Passe de cohérence : réponse JSON illisible, document assemblé conservé")
+        return report, 0
+
+    applied = 0
+    for correction in corrections if isinstance(corrections, list) else []:
+        if not isinstance(correction, dict):
+            continue
+        before, after = correction.get('avant'), correction.get('apres')
+        if not isinstance(before, str) or not isinstance(after, str) or not before or before == after:
+            continue
+        if report.count(before) != 1:
+            continue
+        report = report.replace(before, after)
+        applied += 1
+    return report, applied
+
+def generate_sections_report(req):
+    """Générateur : rédige les parties du template en parallèle puis les assemble dans l'ordre.
+
+    Produit un événement de progression par partie terminée et retourne le rapport
+    nettoyé ; une passe de cohérence optionnelle corrige ensuite les renvois entre parties.
+    """
+    preamble, role, parts = template_sections(req['template'])
+    outline = '\n'.join(
+        f"Partie {index + 1} : " + ' / '.join(line.lstrip('#').strip() for line in part.splitlines() if re.match(r'#{2,3}\s', line))
+        for index, part in enumerate(parts)
+    )
+    logger.info(f"Génération par sections: {req['template']} en {len(parts)} parties")
+    texts = [None] * len(parts)
+    # Système et notes identiques pour toutes les parties : seule la fin du message varie
+    system = SECTION_PROMPT.format(preamble=preamble, outline=outline, role=role)
+    user_message = req['payload']['messages'][1]['content']
+
+    with ThreadPoolExecutor(max_workers=SECTIONS_CONCURRENCY, thread_name_prefix='section') as executor:
+        futures = {}
+        for index, part in enumerate(parts):
+            section_req = derive_report_request(
+                req,
+                system=system,
+                user=f"{user_message}\n\n" + SECTION_PART_PROMPT.format(
+                    index=index + 1, total=len(parts), skeleton=part, heading=part.splitlines()[0]),
+                max_tokens=SECTION_MAX_TOKENS,
+            )
+            futures[executor.submit(call_report_provider, section_req)] = index
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                texts[futures[future]] = clean_section_markdown(future.result())
+                yield {'stage': 'sections', 'done': done, 'total': len(parts)}
+        finally:
+            for future in futures:
+                future.cancel()
+
+    report = '\n\n'.join(texts)
+    if not SECTIONS_CONSISTENCY_PASS:
+        return report
+
+    yield {'stage': 'consistency'}
+    consistency_req = derive_report_request(
+        req,
+        system=CONSISTENCY_PROMPT,
+        user=f"{user_message}\n\nDocument assemblé à vérifier :\n\n{report}",
+        temperature=0,
+        max_tokens=CONSISTENCY_MAX_TOKENS,
+    )
+    try:
+        report, applied = apply_consistency_corrections(report, call_report_provider(consistency_req))
+    except GenerationError as e:
+        # Passe facultative : en cas d'échec, le document assemblé reste valable
+        logger.warning(f"Passe de cohérence ignorée: {e.message}")
+    else:
+        logger.info(f"Passe de cohérence: {applied} correction(s) appliquée(s)")
+    return report
+
+# ============================================
+# RÉGÉNÉRATION D'UNE SECTION
+# ============================================
+
+SECTION_REGENERATE_PROMPT = """{preamble}
+
+Le compte rendu complet a déjà été rédigé. Tu réécris UNIQUEMENT sa section « {title} », qui remplacera la version actuelle ; le reste du document ne change pas.
+
+{skeleton}Règles :
+- Reste cohérent avec le reste du compte rendu (noms, dates, chiffres, numérotation).
+- Intègre les notes complémentaires si elles sont fournies ; elles priment sur la version actuelle.
+- Conserve le niveau de titre actuel ({heading}) et les sous-sections attendues.
+
+IMPORTANT : Renvoie UNIQUEMENT le Markdown de cette section. Commence directement par {heading}. PAS de bloc de code ```, PAS d'introduction, PAS d'autres sections."""
+
+SECTION_REGENERATE_MIN_TOKENS = 300
+
+_MARKDOWN_HEADING = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+
+def normalize_heading(text):
+    """Titre comparable : sans #, sans marqueurs [..], casse et espaces normalisés"""
+    text = re.sub(r'\[[^\]]*\]', '', text.strip().lstrip('#'))
+    return ' '.join(text.replace('*', '').split()).strip(' -:').lower()
+
+def markdown_headings(text):
+    """Liste (début, niveau, titre) des titres Markdown hors blocs de code"""
+    headings, offset, fenced = [], 0, False
+    for line in text.splitlines(keepends=True):
+        if line.lstrip().startswith('```'):
+            fenced = not fenced
+        elif not fenced:
+            match = _MARKDOWN_HEADING.match(line.rstrip('\n'))
             if match:
-                report = match.group(1).strip()
+                headings.append((offset, len(match.group(1)), match.group(2)))
+        offset += len(line)
+    return headings
+
+def find_markdown_section(text, heading):
+    """Bornes (début, fin, niveau, ligne de titre) de la section portant ce titre, ou None.
+
+    La section s'étend jusqu'au titre suivant de niveau égal ou supérieur.
+    """
+    wanted = normalize_heading(heading)
+    level_hint = len(heading) - len(heading.lstrip('#'))
+    headings = markdown_headings(text)
+    for position, (start, level, title) in enumerate(headings):
+        if normalize_heading(title) != wanted or (level_hint and level != level_hint):
+            continue
+        end = next((other for other, other_level, _ in headings[position + 1:] if other_level <= level), len(text))
+        line_end = text.find('\n', start)
+        return start, end, level, text[start:line_end if line_end != -1 else len(text)].rstrip()
+    return None
+
+def template_section_skeleton(template, title):
+    """Extrait de la structure obligatoire du template correspondant au titre, ou ''"""
+    parsed = template_structure(template)
+    if parsed is None:
+        return ''
+    structure = parsed[2]
+    wanted = normalize_heading(title)
+    for _, _, candidate in markdown_headings(structure):
+        expected = normalize_heading(candidate)
+        # Titres à compléter (« Spécifications Techniques - [Nom Flux] ») : comparaison sur le préfixe fixe
+        if expected and (wanted == expected or ('[' in candidate and wanted.startswith(expected))):
+            section = find_markdown_section(structure, candidate)
+            if section:
+                return structure[section[0]:section[1]].strip()
+    return ''
+
+def prepare_section_request(data):
+    """Valide une demande de régénération de section et construit l'appel correspondant"""
+    if not data:
+        raise GenerationError('Corps JSON requis', 400)
+
+    report = (data.get('report') or '').strip()
+    heading = (data.get('heading') or '').strip()
+    extra_notes = (data.get('extra_notes') or '').strip()
+    if not report:
+        raise GenerationError('Compte rendu requis', 400)
+    if not heading:
+        raise GenerationError('Titre de section requis', 400)
+    if len(report) + len(extra_notes) > MAX_NOTES_LENGTH:
+        raise GenerationError(f'Compte rendu et notes trop longs (max {MAX_NOTES_LENGTH} caractères)', 400)
+
+    section = find_markdown_section(report, heading)
+    if section is None:
+        raise GenerationError(f'Section introuvable dans le compte rendu: {heading}', 404)
+    start, end, level, heading_line = section
+
+    # Notes d'origine facultatives : à défaut, le compte rendu actuel sert de source
+    req = prepare_report_request(dict(data, notes=data.get('notes') or report))
+    parsed = template_structure(req['template'])
+    preamble = parsed[0] if parsed else REPORT_PROMPTS[req['template']]
+    skeleton = template_section_skeleton(req['template'], heading_line)
+    system = SECTION_REGENERATE_PROMPT.format(
+        preamble=preamble,
+        title=heading_line.lstrip('#').strip(),
+        skeleton=f"Structure attendue de la section (modèle du template) :\n{skeleton}\n\n" if skeleton else '',
+        heading=heading_line,
+    )
+
+    if data.get('notes'):
+        user = build_report_user_prompt(req['notes'], req['meta'])
+        user += f"\n\nCompte rendu actuel :\n\n{report}"
+    else:
+        user = build_report_user_prompt(report, req['meta'], notes_label='Compte rendu actuel')
+    if extra_notes:
+        user += f"\n\nNotes complémentaires pour cette section :\n\n{extra_notes}"
+    user += f"\n\nSection à réécrire : {heading_line}"
+
+    # Budget de sortie proportionnel à la section actuelle, pas au document
+    max_tokens = min(API_MAX_TOKENS, max(SECTION_REGENERATE_MIN_TOKENS, (end - start + len(extra_notes)) // 2))
+    req = derive_report_request(req, system=system, user=user, max_tokens=max_tokens)
+    req.update(report=report, section_bounds=(start, end), heading_line=heading_line, structured=False)
+    return req
+
+def regenerate_report_section(req):
+    """Régénère la section demandée et la réinsère : retourne (rapport, section)"""
+    heading_line = req['heading_line']
+    section = clean_section_markdown(call_report_provider(req))
+    if not section.startswith('#'):
+        section = f"{heading_line}\n\n{section}".strip()
+
+    report = req['report']
+    start, end = req['section_bounds']
+    # Conserver la séparation d'origine avec la section suivante
+    old = report[start:end]
+    trailing = old[len(old.rstrip()):]
+    return report[:start] + section + trailing + report[end:], section
+
+# ============================================
+# COMPTES RENDUS STRUCTURÉS (SORTIE JSON)
+# ============================================
+
+# Consigne ajoutée au prompt du template : prioritaire sur ses règles de format Markdown
+STRUCTURED_OUTPUT_PROMPT = """FORMAT DE SORTIE (prioritaire sur les consignes de format ci-dessus) :
+Tu ne renvoies PAS de Markdown mais UNIQUEMENT un objet JSON de la forme :
+{"sections": [{"heading": "...", "level": 2, "blocks": [...]}]}
+
+- Chaque titre de la structure obligatoire devient une section, dans le même ordre ;
+  "level" est le nombre de # du titre (## -> 2, ### -> 3) et "heading" son texte sans les #.
+- "blocks" contient le contenu de la section, dans l'ordre :
+  - {"type": "paragraph", "text": "..."} pour un paragraphe ;
+  - {"type": "list", "ordered": false, "items": ["...", "..."]} pour une liste (true si numérotée) ;
+  - {"type": "table", "headers": ["...", "..."], "rows": [["...", "..."]]} pour un tableau.
+- Dans les textes, seul le gras (**...**) et l'italique (*...*) sont autorisés.
+- Aucun texte hors de l'objet JSON."""
+
+_STRUCTURED_TEXT_LIST = {"type": "array", "items": {"type": "string"}}
+
+# Schéma de l'arbre (sortie structurée stricte OpenAI, format Ollama)
+REPORT_TREE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sections": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "heading": {"type": "string"},
+                    "level": {"type": "integer"},
+                    "blocks": {
+                        "type": "array",
+                        "items": {"anyOf": [
+                            {"type": "object", "properties": {
+                                "type": {"type": "string", "enum": ["paragraph"]},
+                                "text": {"type": "string"},
+                            }, "required": ["type", "text"], "additionalProperties": False},
+                            {"type": "object", "properties": {
+                                "type": {"type": "string", "enum": ["list"]},
+                                "ordered": {"type": "boolean"},
+                                "items": _STRUCTURED_TEXT_LIST,
+                            }, "required": ["type", "ordered", "items"], "additionalProperties": False},
+                            {"type": "object", "properties": {
+                                "type": {"type": "string", "enum": ["table"]},
+                                "headers": _STRUCTURED_TEXT_LIST,
+                                "rows": {"type": "array", "items": _STRUCTURED_TEXT_LIST},
+                            }, "required": ["type", "headers", "rows"], "additionalProperties": False},
+                        ]},
+                    },
+                },
+                "required": ["heading", "level", "blocks"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["sections"],
+    "additionalProperties": False,
+}
+
+_INLINE_MARKUP = re.compile(r'\*\*(.+?)\*\*|\*([^*\s][^*]*?)\*')
+
+def structured_output_payload(provider, payload):
+    """Ajoute à une charge utile la contrainte de sortie JSON propre au provider
+    (schéma strict pour OpenAI, schéma en "format" pour Ollama natif, objet JSON ailleurs)"""
+    if provider == 'ollama':
+        return dict(payload, format=REPORT_TREE_SCHEMA)
+    if provider == 'openai':
+        return dict(payload, response_format={'type': 'json_schema', 'json_schema': {
+            'name': 'compte_rendu', 'strict': True, 'schema': REPORT_TREE_SCHEMA}})
+    return dict(payload, response_format={'type': 'json_object'})
+
+def _tree_text(value, field):
+    if not isinstance(value, str):
+        raise ValueError(f'{field} : texte attendu')
+    return clean_squares(value).strip()
+
+def validate_report_tree(data):
+    """Valide et normalise un arbre de sections ; ValueError si la structure est invalide"""
+    if not isinstance(data, dict) or not isinstance(data.get('sections'), list):
+        raise ValueError('objet {"sections": [...]} attendu')
+    sections = []
+    for index, section in enumerate(data['sections'], start=1):
+        if not isinstance(section, dict):
+            raise ValueError(f'section {index} : objet attendu')
+        heading = _tree_text(section.get('heading'), f'section {index}')
+        try:
+            level = min(6, max(1, int(section.get('level', 2))))
+        except (TypeError, ValueError):
+            raise ValueError(f'section {index} : niveau invalide')
+        blocks = []
+        for block in section.get('blocks') or []:
+            kind = block.get('type') if isinstance(block, dict) else None
+            if kind == 'paragraph':
+                text = _tree_text(block.get('text'), f'section {index}, paragraphe')
+                if text:
+                    blocks.append({'type': 'paragraph', 'text': text})
+            elif kind == 'list':
+                items = [_tree_text(item, f'section {index}, liste') for item in block.get('items') or []]
+                items = [item for item in items if item]
+                if items:
+                    blocks.append({'type': 'list', 'ordered': bool(block.get('ordered')), 'items': items})
+            elif kind == 'table':
+                headers = [_tree_text(cell, f'section {index}, tableau') for cell in block.get('headers') or []]
+                rows = [[_tree_text(cell, f'section {index}, tableau') for cell in row]
+                        for row in block.get('rows') or [] if isinstance(row, list)]
+                width = max([len(headers)] + [len(row) for row in rows])
+                if not width:
+                    continue
+                # Lignes complétées (ou tronquées) à la largeur du tableau
+                headers = (headers + [''] * width)[:width]
+                rows = [(row + [''] * width)[:width] for row in rows]
+                blocks.append({'type': 'table', 'headers': headers, 'rows': rows})
+            else:
+                raise ValueError(f'section {index} : bloc de type inconnu ({kind})')
+        if heading or blocks:
+            sections.append({'heading': heading, 'level': level, 'blocks': blocks})
+    if not sections:
+        raise ValueError('aucune section')
+    return {'sections': sections}
+
+def parse_report_tree(answer):
+    """Arbre validé à partir de la réponse du provider ; GenerationError 502 si elle est inexploitable"""
+    text = answer.strip()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        # Providers sans contrainte stricte : objet JSON entouré de texte ou d'un bloc ```json
+        start, end = text.find('{'), text.rfind('}')
+        try:
+            data = json.loads(text[start:end + 1]) if start != -1 and end > start else None
+        except ValueError:
+            data = None
+    try:
+        return validate_report_tree(data)
+    except ValueError as e:
+        logger.debug(f"Réponse structurée invalide: {text[:500]}")
+        raise GenerationError(f'Réponse structurée invalide: {e}', 502)
+
+def report_tree_markdown(tree):
+    """Markdown équivalent à un arbre (éditeur, régénération de section)"""
+    parts = []
+    for section in tree['sections']:
+        if section['heading']:
+            parts.append(f"{'#' * section['level']} {section['heading']}")
+        for block in section['blocks']:
+            if block['type'] == 'paragraph':
+                parts.append(block['text'])
+            elif block['type'] == 'list':
+                parts.append('\n'.join(f"{f'{n}.' if block['ordered'] else '-'} {item}"
+                                       for n, item in enumerate(block['items'], start=1)))
+            else:
+                lines = [block['headers']] + block['rows']
+                table = [f"| {' | '.join(cell.replace('|', '/') for cell in line)} |" for line in lines]
+                table.insert(1, f"|{'---|' * len(block['headers'])}")
+                parts.append('\n'.join(table))
+    return '\n\n'.join(parts)
+
+def report_tree_toc(tree):
+    """Table des matières d'un arbre (mêmes entrées que extract_toc_from_html : niveaux 1 et 2)"""
+    levels = sorted({section['level'] for section in tree['sections'] if section['heading']})[:2]
+    return [{'level': levels.index(section['level']) + 1, 'text': section['heading']}
+            for section in tree['sections'] if section['heading'] and section['level'] in levels]
+
+def inline_runs(text):
+    """Découpe un texte en segments (texte, gras, italique) selon **...** et *...*"""
+    runs, position = [], 0
+    for match in _INLINE_MARKUP.finditer(text):
+        if match.start() > position:
+            runs.append((text[position:match.start()], False, False))
+        if match.group(1) is not None:
+            runs.append((match.group(1), True, False))
+        else:
+            runs.append((match.group(2), False, True))
+        position = match.end()
+    if position < len(text):
+        runs.append((text[position:], False, False))
+    return runs
+
+def report_tree_key(req):
+    """Référence de l'arbre en cache, transmise au client pour les exports"""
+    return report_cache_key(req) if req.get('structured') and REPORT_CACHE_ENABLED else None
+
+def report_response_body(req, report, cached):
+    """Corps de réponse d'un compte rendu : Markdown, plus l'arbre et sa référence en mode structuré"""
+    if not req.get('structured'):
+        return {'report': report, 'cached': cached}
+    body = {'report': report_tree_markdown(report), 'tree': report, 'cached': cached}
+    key = report_tree_key(req)
+    if key:
+        body['tree_key'] = key
+    return body
+
+def export_report_tree(report_data):
+    """Arbre à exporter tel quel (PDF/DOCX) : report.tree, ou report.tree_key relu dans le cache.
+
+    Le client ne transmet l'arbre que si le compte rendu n'a pas été modifié dans l'éditeur ;
+    sinon l'export repart du HTML.
+    """
+    tree = report_data.get('tree')
+    key = report_data.get('tree_key')
+    if tree is None and isinstance(key, str) and re.fullmatch(r'[0-9a-f]{64}', key) and REPORT_CACHE_ENABLED:
+        tree = report_cache.get(key)
+    if tree is None:
+        return None
+    try:
+        return validate_report_tree(tree)
+    except ValueError as e:
+        logger.warning(f"Arbre de compte rendu ignoré pour l'export: {e}")
+        return None
+
+def report_tree_pdf_flowables(tree, styles, normal_style, primary_hex, available_width):
+    """Éléments ReportLab d'un arbre (mêmes styles que le rendu du HTML de l'éditeur)"""
+    primary = colors.HexColor(primary_hex)
+    heading_styles = {
+        1: ParagraphStyle('TreeH1', parent=styles['Heading1'], textColor=primary, fontSize=18, spaceBefore=12, spaceAfter=10, leading=22, fontName='Helvetica-Bold'),
+        2: ParagraphStyle('TreeH2', parent=styles['Heading2'], textColor=primary, fontSize=14, spaceBefore=10, spaceAfter=8, leading=17, fontName='Helvetica-Bold'),
+        3: ParagraphStyle('TreeH3', parent=styles['Heading3'], textColor=primary, fontSize=12, spaceBefore=8, spaceAfter=6, leading=15, fontName='Helvetica-Bold'),
+    }
+    minor_heading = ParagraphStyle('TreeH4', parent=styles['Heading4'], textColor=colors.HexColor('#374151'), fontSize=11, spaceBefore=6, spaceAfter=5, leading=14, fontName='Helvetica-Bold')
+    list_style = ParagraphStyle('TreeListItem', parent=normal_style, leftIndent=20, spaceBefore=2, spaceAfter=2)
+    cell_style = ParagraphStyle('TreeTableCell', parent=normal_style, fontSize=10, leading=14, spaceAfter=0, spaceBefore=0)
+    header_cell_style = ParagraphStyle('TreeTableHeaderCell', parent=cell_style, textColor=colors.white, fontName='Helvetica-Bold')
+
+    def markup(text):
+        out = ''
+        for chunk, bold, italic in inline_runs(text):
+            chunk = chunk.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            out += f'<b>{chunk}</b>' if bold else f'<i>{chunk}</i>' if italic else chunk
+        return out
+
+    flowables = []
+    for section in tree['sections']:
+        if section['heading']:
+            flowables.append(Paragraph(markup(section['heading']), heading_styles.get(section['level'], minor_heading)))
+        for block in section['blocks']:
+            if block['type'] == 'paragraph':
+                flowables.append(Paragraph(markup(block['text']), normal_style))
+                flowables.append(Spacer(1, 6))
+            elif block['type'] == 'list':
+                for number, item in enumerate(block['items'], start=1):
+                    bullet = f'{number}.' if block['ordered'] else '-'
+                    flowables.append(Paragraph(f'{bullet} {markup(item)}', list_style))
+                flowables.append(Spacer(1, 8))
+            else:
+                rows = [[Paragraph(f'<b>{markup(cell)}</b>', header_cell_style) for cell in block['headers']]]
+                rows += [[Paragraph(markup(cell), cell_style) for cell in row] for row in block['rows']]
+                width = len(block['headers'])
+                table = Table(rows, colWidths=[available_width / width] * width, hAlign='LEFT', repeatRows=1, splitByRow=True)
+                style_cmds = [
+                    ('GRID', (0, 0), (-1, -1), 0.75, colors.HexColor('#0C4A45')),
+                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+                    ('LEFTPADDING', (0, 0), (-1, -1), 6),
+                    ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+                    ('TOPPADDING', (0, 0), (-1, -1), 4),
+                    ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#0f5650')),
+                ]
+                style_cmds += [('BACKGROUND', (0, r), (-1, r), colors.HexColor('#F9FAFB'))
+                               for r in range(2, len(rows), 2)]
+                table.setStyle(TableStyle(style_cmds))
+                flowables.append(table)
+                flowables.append(Spacer(1, 10))
+    return flowables
+
+def add_report_tree_docx(doc, tree, primary_color, primary_hex):
+    """Ajoute un arbre au document Word (mêmes styles que le rendu du HTML de l'éditeur)"""
+    heading_sizes = {1: 18, 2: 14, 3: 12, 4: 11, 5: 10, 6: 9}
+
+    def add_runs(paragraph, text):
+        for chunk, bold, italic in inline_runs(text):
+            run = paragraph.add_run(chunk)
+            run.bold = bold or None
+            run.italic = italic or None
+
+    for section in tree['sections']:
+        if section['heading']:
+            heading = doc.add_heading('', level=section['level'])
+            add_runs(heading, section['heading'])
+            for run in heading.runs:
+                run.font.size = Pt(heading_sizes[section['level']])
+                if section['level'] <= 2:
+                    run.font.color.rgb = primary_color
+                elif section['level'] == 3:
+                    run.font.color.rgb = RGBColor(55, 65, 81)
+        for block in section['blocks']:
+            if block['type'] == 'paragraph':
+                paragraph = doc.add_paragraph()
+                add_runs(paragraph, block['text'])
+                paragraph.paragraph_format.space_after = Pt(6)
+            elif block['type'] == 'list':
+                for item in block['items']:
+                    paragraph = doc.add_paragraph(style='List Number' if block['ordered'] else 'List Bullet')
+                    paragraph.paragraph_format.left_indent = Inches(0.5)
+                    paragraph.paragraph_format.space_after = Pt(4)
+                    add_runs(paragraph, item)
+            else:
+                lines = [block['headers']] + block['rows']
+                table = doc.add_table(rows=len(lines), cols=len(block['headers']))
+                table.style = 'Table Grid'
+                for i, line in enumerate(lines):
+                    for j, text in enumerate(line):
+                        cell = table.rows[i].cells[j]
+                        paragraph = cell.paragraphs[0]
+                        add_runs(paragraph, text)
+                        for run in paragraph.runs:
+                            run.font.size = Pt(11 if i == 0 else 10)
+                        if i == 0:
+                            shading = OxmlElement('w:shd')
+                            shading.set(qn('w:val'), 'clear')
+                            shading.set(qn('w:color'), 'auto')
+                            shading.set(qn('w:fill'), primary_hex)
+                            cell._element.get_or_add_tcPr().append(shading)
+                            paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                            for run in paragraph.runs:
+                                run.bold = True
+                                run.font.color.rgb = RGBColor(255, 255, 255)
+                doc.add_paragraph()
+
+# ============================================
+# CACHE DES COMPTES RENDUS (disque)
+# ============================================
+
+class ReportCache:
+    """Cache disque adressé par contenu : entrées compressées, TTL et éviction LRU par taille.
+
+    La date de dernier accès d'une entrée est portée par le mtime de son fichier,
+    ce qui permet à plusieurs processus de partager le même répertoire.
+    """
+
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'expired': 0}
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.z')
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _entries(self):
+        """Liste (chemin, taille, dernier accès) des entrées présentes sur disque"""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not name.endswith('.z'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        """Retourne la valeur en cache (ou None) et rafraîchit sa date d'accès"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except FileNotFoundError:
+            self._count('misses')
+            return None
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Entrée de cache illisible supprimée ({key[:12]}): {e}")
+            self._remove(path)
+            self._count('misses')
+            return None
+        
+        if time.time() - entry.get('created', 0) > self.ttl:
+            self._remove(path)
+            self._count('expired')
+            self._count('misses')
+            return None
         
-        # Cas 3 : Introduction + Markdown (retirer tout avant le premier ##)
-        if not report.startswith('#'):
-            match = re.search(r'(##\s+.*)', report, re.DOTALL)
-            if match:
-                report = match.group(1).strip()
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self._count('hits')
+        return entry.get('value')
+
+    def peek(self, key):
+        """Présence d'une entrée valide, sans la compter comme lecture ni rafraîchir sa date d'accès"""
+        try:
+            with open(self._path(key), 'rb') as f:
+                entry = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except (OSError, ValueError, zlib.error):
+            return False
+        return time.time() - entry.get('created', 0) <= self.ttl
+
+    def put(self, key, value):
+        """Écrit une entrée (écriture atomique) puis applique l'éviction LRU"""
+        data = zlib.compress(json.dumps({'created': time.time(), 'value': value}, ensure_ascii=False).encode('utf-8'))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"Écriture du cache impossible: {e}")
+            return
+        self._count('writes')
+        
+        with self.lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data)
+            if self._size <= self.max_bytes:
+                return
+            # Dépassement : recalcul exact puis suppression des entrées les moins récemment lues
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            self._size = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if self._size <= self.max_bytes:
+                    break
+                self._remove(path)
+                self._size -= size
+                self.counters['evictions'] += 1
+
+    def stats(self):
+        entries = self._entries()
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'hit_rate': round(stats['hits'] / lookups, 3) if lookups else None,
+        })
+        return stats
+
+report_cache = ReportCache(REPORT_CACHE_DIR, REPORT_CACHE_MAX_BYTES, REPORT_CACHE_TTL)
+
+def report_cache_key(req):
+    """Clé de cache d'un compte rendu : provider, modèle, version du prompt, notes, méta, température"""
+    payload = req['payload']
+    system_prompt = REPORT_PROMPTS[req['template']]
+    material = {
+        'provider': req['provider'],
+        'model': payload['model'],
+        'template': req['template'],
+        'prompt_version': hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:16],
+        'notes': req['notes'],
+        'meta': req['meta'],
+        'temperature': payload.get('temperature'),
+    }
+    if req.get('sections_parallel'):
+        material['mode'] = 'sections'
+    elif req.get('structured'):
+        material['mode'] = 'structured'
+    material = json.dumps(material, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def generate_report_text(req, scope=None):
+    """Génère (ou relit en cache) le compte rendu nettoyé : retourne (rapport, depuis_le_cache)
+    (scope : portée d'annulation du demandeur, client HTTP par exemple).
+
+    En mode structuré, le rapport est l'arbre de sections validé (voir report_response_body).
+    """
+    key = report_cache_key(req)
+    if REPORT_CACHE_ENABLED and not req['force_regenerate']:
+        cached = report_cache.get(key)
+        if cached is not None:
+            logger.info(f"Compte rendu servi depuis le cache - Template: {req['template']}")
+            if SPECULATE_ENABLED:
+                speculative_drafts.claim(key)
+            return cached, True
+    elif SPECULATE_ENABLED and not req['force_regenerate']:
+        # Sans cache disque, un brouillon spéculatif terminé pour ces notes exactes est servi depuis la mémoire
+        _, draft = speculative_drafts.claim(key)
+        if draft is not None:
+            return draft, True
+    
+    def call_provider(shared_scope):
+        # Appels amont annulables dès qu'un demandeur peut partir
+        final_req = dict(req, scope=shared_scope) if scope is not None else req
+        with real_report_generation(req, key):
+            final_req = drain(map_reduce_request(final_req)) if needs_map_reduce(final_req) else final_req
+            if final_req['sections_parallel']:
+                report = drain(generate_sections_report(final_req))
+                token_budget.record(req['template'], report)
+            else:
+                answer = call_report_provider_hedged(final_req) if final_req['hedge'] else call_report_provider(final_req)
+                # Sortie structurée : arbre validé à l'arrivée, sans nettoyage du Markdown
+                report = parse_report_tree(answer) if final_req['structured'] else clean_report_markdown(answer)
+                token_budget.record(req['template'], answer, final_req['payload']['max_tokens'])
+        if REPORT_CACHE_ENABLED:
+            report_cache.put(key, report)
+        return report
+    
+    # Les demandes identiques simultanées (double clic, notes partagées) partagent le même appel
+    return report_flight.do(key, call_provider, scope), False
+
+def stream_report_events(req, scope=None):
+    """Générateur SSE : relaie les fragments nettoyés puis le rapport final
+    (scope : portée d'annulation liée au client)"""
+    key = report_cache_key(req)
+    if REPORT_CACHE_ENABLED and not req['force_regenerate']:
+        cached = report_cache.get(key)
+        if cached is not None:
+            if SPECULATE_ENABLED:
+                speculative_drafts.claim(key)
+            yield sse_event('done', report_response_body(req, cached, True))
+            return
+    elif SPECULATE_ENABLED and not req['force_regenerate']:
+        _, draft = speculative_drafts.claim(key)
+        if draft is not None:
+            yield sse_event('done', report_response_body(req, draft, True))
+            return
+    
+    if req['structured']:
+        # Un arbre JSON partiel n'est pas affichable : réponse complète en un seul événement
+        report, cached = generate_report_text(req, scope)
+        yield sse_event('done', report_response_body(req, report, cached))
+        return
+    
+    # Les demandes identiques simultanées (double clic, brouillon spéculatif en cours) partagent
+    # le même appel amont : chacune relit les fragments déjà publiés puis la suite
+    def produce(shared_scope):
+        return counted_report_events(req, key, produce_report_events(req, key, shared_scope))
+    
+    yield from report_flight.stream(key, produce, scope,
+                                    lambda report: sse_event('done', report_response_body(req, report, False)))
+
+def produce_report_events(req, key, scope):
+    """Générateur SSE de l'appel partagé d'un compte rendu streamé : progression, fragments nettoyés
+    puis rapport final ; retourne le rapport (scope : portée de l'appel partagé)"""
+    provider = req['provider']
+    req = dict(req, scope=scope)
+    
+    if needs_map_reduce(req):
+        # Notes longues : progression de la phase map, puis streaming de la phase reduce
+        progress = map_reduce_request(req)
+        while True:
+            try:
+                yield sse_event('progress', next(progress))
+            except StopIteration as stop:
+                req = stop.value
+                break
+    
+    if req['sections_parallel']:
+        # Templates longs : progression par partie, puis le rapport assemblé
+        sections = generate_sections_report(req)
+        while True:
+            try:
+                yield sse_event('progress', next(sections))
+            except StopIteration as stop:
+                report = stop.value
+                break
+        logger.info(f"Generation CR (sections) via {provider} - Template: {req['template']}")
+        token_budget.record(req['template'], report)
+        if REPORT_CACHE_ENABLED:
+            report_cache.put(key, report)
+        yield sse_event('done', {'report': report, 'cached': False})
+        return report
+    
+    # Ollama : position dans la file publiée jusqu'à l'attribution d'un créneau
+    # (avec hedging, chaque tentative réserve son créneau elle-même)
+    ticket = None
+    if provider == 'ollama' and not req['hedge']:
+        ticket = ollama_scheduler.enqueue(req['payload']['model'], estimate_request_tokens(req['payload']))
+    try:
+        if ticket:
+            yield from ollama_queue_events(ticket, scope)
+        # Hedging : flux de secours si le premier token tarde, le premier flux actif est relayé
+        fragments = (hedged_report_fragments(req, scope) if req['hedge']
+                     else stream_report_attempt(req, scope, ticket=ticket))
+        cleaner = ReportStreamCleaner()
+        try:
+            for text in fragments:
+                out = cleaner.feed(text)
+                if out:
+                    yield sse_event('token', {'text': out})
+                if cleaner.done:
+                    # Fin du rapport (marqueur ou clôture du bloc) : la suite n'est plus relayée
+                    break
+            tail, report = cleaner.finish()
+            if tail:
+                yield sse_event('token', {'text': tail})
+            
+            logger.info(f"Generation CR (stream) via {provider} - Template: {req['template']}")
+            token_budget.record(req['template'], report, req['payload']['max_tokens'])
+            if REPORT_CACHE_ENABLED:
+                report_cache.put(key, report)
+            yield sse_event('done', {'report': report, 'cached': False})
+        finally:
+            # Après l'événement final : lecture de la fin du flux (bloc usage) puis fermeture
+            fragments.close()
+    finally:
+        if ticket:
+            ollama_scheduler.release(ticket)
+    return report
+
+@app.route('/api/generate-report', methods=['POST'])
+def generate_report():
+    """Génère un compte rendu professionnel à partir de notes brutes"""
+    if isinstance((request.get_json(silent=True) or {}).get('templates'), list):
+        return generate_report_multi()
+    if wants_event_stream():
+        return generate_report_stream()
+    provider = config.get('active_provider', 'mistral')
+    try:
+        req = prepare_report_request(request.get_json(silent=True))
+        provider = req['provider']
+        if SPECULATE_ENABLED:
+            # Les brouillons devenus obsolètes de cet utilisateur libèrent le provider
+            speculative_drafts.yield_to(speculation_owner(), report_cache_key(req))
         
-        logger.debug(f"Markdown cleaned (first 100 chars): {report[:100]}")
+        # Client parti (onglet fermé, nouveau clic) : l'appel amont est coupé
+        with watch_client_disconnect('report') as scope:
+            report, cached = generate_report_text(req, scope)
         
-        return jsonify({'report': report})
+        return jsonify(report_response_body(req, report, cached))
         
-    except requests.exceptions.Timeout:
-        return jsonify({'error': f'Timeout: {provider} ne répond pas dans les délais'}), 408
-    except requests.exceptions.HTTPError as e:
-        if hasattr(e, 'response') and e.response is not None:
-            if e.response.status_code == 401:
-                return jsonify({'error': f'Clé API {provider} invalide ou expirée'}), 401
-            elif e.response.status_code == 429:
-                return jsonify({'error': f'Limite de débit {provider} atteinte. Réessayez dans quelques instants.'}), 429
-            else:
-                return jsonify({'error': f'Erreur {provider}: {e.response.status_code}'}), 503
-        return jsonify({'error': f'Erreur HTTP {provider}: {str(e)}'}), 503
-    except requests.exceptions.RequestException as e:
-        return jsonify({'error': f"Erreur de connexion à {provider}: {str(e)}"}), 503
+    except GenerationError as e:
+        return jsonify(dict(e.details, error=e.message)), e.status
     except KeyError as e:
         return jsonify({'error': f'Réponse {provider} malformée: {str(e)}'}), 502
     except Exception as e:
         return jsonify({'error': f'Erreur lors de la génération du compte rendu: {str(e)}'}), 500
 
+@app.route('/api/generate-report/stream', methods=['POST'])
+def generate_report_stream():
+    """Variante streamée (SSE) de /api/generate-report : événements token, done, error"""
+    scope, stop_watching = client_cancel_scope('report_stream')
+    try:
+        req = prepare_report_request(request.get_json(silent=True))
+        if SPECULATE_ENABLED:
+            speculative_drafts.yield_to(speculation_owner(), report_cache_key(req))
+        # L'ouverture du flux se fait avant la réponse pour renvoyer les erreurs HTTP classiques
+        events = stream_report_events(req, scope)
+        first = next(events)
+    except GenerationError as e:
+        stop_watching()
+        return jsonify(dict(e.details, error=e.message)), e.status
+    except Exception as e:
+        stop_watching()
+        return jsonify({'error': f'Erreur lors de la génération du compte rendu: {str(e)}'}), 500
+    
+    def generate():
+        yield first
+        try:
+            yield from events
+        except GenerationError as e:
+            yield sse_event('error', {'error': e.message, 'status': e.status})
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(stop_watching)
+    # Client parti : désistement de l'appel partagé, coupé s'il n'est plus attendu par personne
+    response.call_on_close(events.close)
+    return response
+
+def stream_report_fanout(items, concurrency, scope=None):
+    """Générateur SSE : exécute des demandes préparées en parallèle et publie chaque résultat dès qu'il arrive.
+
+    items : liste de dicts {'index', 'req' ou 'error'} (plus des champs d'identification
+    recopiés dans chaque événement 'item') ; scope : portée d'annulation liée au client.
+    """
+    def describe(item):
+        return {k: v for k, v in item.items() if k not in ('req', 'error')}
+    
+    succeeded = failed = 0
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='report-fanout')
+    try:
+        for item in items:
+            if 'error' in item:
+                failed += 1
+                yield sse_event('item', dict(describe(item), error=item['error'].message, status=item['error'].status))
+            else:
+                pending[executor.submit(generate_report_text, item['req'], scope)] = item
+        
+        for future in as_completed(pending):
+            item = pending[future]
+            try:
+                report, cached = future.result()
+                succeeded += 1
+                yield sse_event('item', dict(describe(item), **report_response_body(item['req'], report, cached)))
+            except GenerationError as e:
+                failed += 1
+                yield sse_event('item', dict(describe(item), error=e.message, status=e.status))
+            except Exception as e:
+                failed += 1
+                yield sse_event('item', dict(describe(item), error=f'Erreur lors de la génération du compte rendu: {str(e)}', status=500))
+        
+        yield sse_event('done', {'total': len(items), 'succeeded': succeeded, 'failed': failed})
+    finally:
+        # Client parti ou fin du lot : les demandes pas encore lancées sont abandonnées,
+        # celles en cours sont coupées
+        executor.shutdown(wait=False, cancel_futures=True)
+        if scope is not None:
+            scope.cancel()
+
+def fanout_concurrency(data):
+    """Concurrence demandée par le client, plafonnée par BATCH_MAX_CONCURRENCY"""
+    try:
+        requested = int(data.get('concurrency') or BATCH_MAX_CONCURRENCY)
+    except (TypeError, ValueError):
+        requested = BATCH_MAX_CONCURRENCY
+    return max(1, min(requested, BATCH_MAX_CONCURRENCY))
+
+@app.route('/api/generate-report/batch', methods=['POST'])
+def generate_report_batch():
+    """Génère un lot de comptes rendus en parallèle (SSE : un événement 'item' par compte rendu terminé)"""
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'Corps JSON requis'}), 400
+    
+    entries = data.get('items')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': 'Liste items requise'}), 400
+    if len(entries) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Lot trop volumineux (max {BATCH_MAX_ITEMS} éléments)'}), 400
+    
+    # template, meta et force_regenerate au niveau du lot servent de valeurs par défaut
+    defaults = {key: data[key] for key in ('template', 'meta', 'force_regenerate') if key in data}
+    
+    items = []
+    for index, entry in enumerate(entries):
+        item = {'index': index}
+        if isinstance(entry, dict) and entry.get('id') is not None:
+            item['id'] = entry['id']
+        try:
+            if not isinstance(entry, dict):
+                raise GenerationError('Élément invalide', 400)
+            item['req'] = prepare_report_request(dict(defaults, **entry))
+            item['template'] = item['req']['template']
+        except GenerationError as e:
+            item['error'] = e
+        items.append(item)
+    
+    logger.info(f"Lot de {len(items)} comptes rendus (concurrence {fanout_concurrency(data)})")
+    scope, stop_watching = client_cancel_scope('batch')
+    response = Response(stream_with_context(stream_report_fanout(items, fanout_concurrency(data), scope)),
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(stop_watching)
+    return response
+
+@app.route('/api/generate-report/multi', methods=['POST'])
+def generate_report_multi():
+    """Génère plusieurs templates à partir des mêmes notes (SSE : un événement 'item' par template)"""
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'Corps JSON requis'}), 400
+    
+    templates = data.get('templates')
+    if not isinstance(templates, list) or not templates:
+        return jsonify({'error': 'Liste templates requise'}), 400
+    
+    # Doublons ignorés, ordre conservé
+    templates = list(dict.fromkeys(str(t) for t in templates))
+    if len(templates) > len(REPORT_PROMPTS):
+        return jsonify({'error': 'Trop de templates demandés'}), 400
+    
+    items = []
+    for index, template in enumerate(templates):
+        item = {'index': index, 'template': TEMPLATE_ALIASES.get(template, template)}
+        if item['template'] not in REPORT_PROMPTS:
+            item['error'] = GenerationError(f'Template inconnu: {template}', 400)
+        else:
+            try:
+                item['req'] = prepare_report_request(dict(data, template=template))
+            except GenerationError as e:
+                # Erreur commune à tous les templates (notes, provider) : réponse HTTP classique
+                return jsonify(dict(e.details, error=e.message)), e.status
+        items.append(item)
+    
+    logger.info(f"Génération multi-templates: {', '.join(templates)}")
+    scope, stop_watching = client_cancel_scope('batch')
+    response = Response(stream_with_context(stream_report_fanout(items, min(len(items), fanout_concurrency(data)), scope)),
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(stop_watching)
+    return response
+
+@app.route('/api/generate-report/section', methods=['POST'])
+def generate_report_section():
+    """Régénère une seule section d'un compte rendu existant et la réinsère à sa place"""
+    try:
+        req = prepare_section_request(request.get_json(silent=True))
+        with watch_client_disconnect('report') as scope, real_report_generation(req):
+            report, section = regenerate_report_section(dict(req, scope=scope))
+        logger.info(f"Section régénérée via {req['provider']} - Template: {req['template']}, Section: {req['heading_line']}")
+        return jsonify({'report': report, 'section': section})
+    except GenerationError as e:
+        return jsonify(dict(e.details, error=e.message)), e.status
+    except Exception as e:
+        return jsonify({'error': f'Erreur lors de la régénération de la section: {str(e)}'}), 500
+
+# ============================================
+# GÉNÉRATION SPÉCULATIVE (BROUILLONS PENDANT LA SAISIE)
+# ============================================
+
+def notes_change(old, new):
+    """Nombre de caractères modifiés entre deux versions des notes (hors préfixe et suffixe communs)"""
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    return max(len(old), len(new)) - prefix - suffix
+
+class SpeculativeDrafts:
+    """Brouillons de comptes rendus générés pendant la saisie, à basse priorité.
+
+    Chaque instantané de notes (débouncé par l'éditeur) démarre une génération ordinaire
+    (generate_report_text) : le résultat arrive dans le cache des comptes rendus, et une
+    demande réelle identique arrivée en cours de route (JSON ou SSE) rejoint l'appel via
+    la coalescence.
+    Un brouillon est annulé puis relancé quand les notes changent sensiblement. Les
+    démarrages sont bornés par utilisateur (brouillons en cours, budget de tokens sur
+    SPECULATE_BUDGET_WINDOW) et globalement ; aucun ne démarre si les générations réelles
+    sont déjà nombreuses ou si Ollama est occupé, et une génération réelle qui démarre
+    préempte les brouillons en cours sur son provider (preempt).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.drafts = {}  # (utilisateur, brouillon) -> état
+        self.spent = {}  # utilisateur -> deque[(instant, tokens)]
+        self.ready_keys = OrderedDict()  # clés de cache produites par un brouillon, pas encore servies
+        self.executor = ThreadPoolExecutor(max_workers=max(1, SPECULATE_MAX_CONCURRENCY), thread_name_prefix='speculate')
+        self.counters = {'started': 0, 'restarted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0,
+                         'preempted': 0, 'hits': 0, 'skipped_budget': 0, 'skipped_busy': 0}
+
+    def _running(self, owner=None):
+        return sum(1 for (user, _), draft in self.drafts.items()
+                   if draft['state'] == 'running' and (owner is None or user == owner))
+
+    def _spent(self, owner, now):
+        spent = self.spent.setdefault(owner, deque())
+        while spent and now - spent[0][0] > SPECULATE_BUDGET_WINDOW:
+            spent.popleft()
+        return sum(tokens for _, tokens in spent)
+
+    def _expire(self, now):
+        for draft_key, draft in list(self.drafts.items()):
+            if draft['state'] != 'running' and now - draft['updated'] > SPECULATE_DRAFT_TTL:
+                del self.drafts[draft_key]
+
+    def _cancel(self, draft):
+        if draft['state'] == 'running':
+            draft['state'] = 'cancelled'
+            self.counters['cancelled'] += 1
+            draft['scope'].cancel()
+
+    def _busy(self, req):
+        with report_load_lock:
+            in_flight = report_load['in_flight']
+        return in_flight >= SPECULATE_MAX_LOAD or (req['provider'] == 'ollama' and not ollama_scheduler.idle())
+
+    def submit(self, owner, draft_id, req):
+        """Prend en compte un instantané des notes : retourne l'état du brouillon
+        (running, ready, failed ou skipped, avec la raison dans ce dernier cas)"""
+        key = report_cache_key(req)
+        # Lecture disque hors verrou, sans fausser les statistiques du cache
+        cached = REPORT_CACHE_ENABLED and report_cache.peek(key)
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            draft = self.drafts.get((owner, draft_id))
+            if draft is not None:
+                draft['updated'] = now
+                if draft['key'] == key and draft['state'] in ('running', 'ready'):
+                    return {'status': draft['state']}
+                change = notes_change(draft['notes'], req['notes'])
+                if draft['state'] in ('running', 'ready') and change < max(
+                        SPECULATE_MIN_CHANGE_CHARS, SPECULATE_MIN_CHANGE_RATIO * len(req['notes'])):
+                    # Changement mineur : pas de relance, la saisie n'est sans doute pas finie
+                    return {'status': draft['state'], 'stale': True}
+            
+            if cached:
+                return {'status': 'ready'}
+            replaced = draft is not None and draft['state'] == 'running'
+            if self._running(owner) - replaced >= SPECULATE_MAX_PER_USER:
+                self.counters['skipped_busy'] += 1
+                return {'status': 'skipped', 'reason': 'Brouillons en cours trop nombreux'}
+            if self._busy(req) or self._running() - replaced >= SPECULATE_MAX_CONCURRENCY:
+                self.counters['skipped_busy'] += 1
+                return {'status': 'skipped', 'reason': 'Providers occupés par des demandes réelles'}
+            cost = estimate_request_tokens(req['payload'])
+            if self._spent(owner, now) + cost > SPECULATE_USER_TOKEN_BUDGET:
+                self.counters['skipped_budget'] += 1
+                return {'status': 'skipped', 'reason': 'Budget de brouillons épuisé'}
+            
+            if draft is not None:
+                self._cancel(draft)
+                self.counters['restarted'] += 1
+            self.spent[owner].append((now, cost))
+            self.counters['started'] += 1
+            draft = {'key': key, 'provider': req['provider'], 'notes': req['notes'], 'state': 'running', 'updated': now,
+                     'scope': CancelScope(deadline=now + REQUEST_TIMEOUTS['report'])}
+            self.drafts[(owner, draft_id)] = draft
+        
+        # Pas de requête de secours pour un brouillon : il ne doit rien coûter de plus
+        self.executor.submit(self._run, draft, dict(req, hedge=False, force_regenerate=False, speculative=True))
+        logger.info(f"Brouillon spéculatif démarré - Template: {req['template']}, {len(req['notes'])} caractères")
+        return {'status': 'running'}
+
+    def _run(self, draft, req):
+        try:
+            report, _ = generate_report_text(req, draft['scope'])
+        except GenerationCancelled:
+            return
+        except Exception as e:
+            with self.lock:
+                if draft['state'] == 'running':
+                    draft['state'] = 'failed'
+                    self.counters['failed'] += 1
+            logger.info(f"Brouillon spéculatif abandonné: {e}")
+            return
+        with self.lock:
+            if draft['state'] != 'running':
+                return
+            draft['state'] = 'ready'
+            self.counters['completed'] += 1
+            # Sans cache disque, le brouillon reste servi depuis la mémoire
+            self.ready_keys[draft['key']] = None if REPORT_CACHE_ENABLED else report
+            while len(self.ready_keys) > 1000:
+                self.ready_keys.popitem(last=False)
+
+    def claim(self, key):
+        """Demande réelle : (True, rapport ou None) si un brouillon a produit ce compte rendu"""
+        with self.lock:
+            if key not in self.ready_keys:
+                return False, None
+            self.counters['hits'] += 1
+            return True, self.ready_keys.pop(key)
+
+    def yield_to(self, owner, key):
+        """Demande réelle d'un utilisateur : ses brouillons portant sur d'autres notes sont annulés"""
+        with self.lock:
+            for (user, _), draft in self.drafts.items():
+                if user == owner and draft['key'] != key:
+                    self._cancel(draft)
+
+    def preempt(self, provider, key=None):
+        """Génération réelle sur provider : annule les brouillons en cours sur ce provider
+        (sauf celui produisant key, que la demande peut rejoindre)"""
+        with self.lock:
+            for draft in self.drafts.values():
+                if draft['state'] == 'running' and draft['provider'] == provider and draft['key'] != key:
+                    self._cancel(draft)
+                    self.counters['preempted'] += 1
+
+    def cancel(self, owner, draft_id):
+        with self.lock:
+            draft = self.drafts.pop((owner, draft_id), None)
+            if draft is not None:
+                self._cancel(draft)
+        return draft is not None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, running=self._running(), drafts=len(self.drafts),
+                        real_in_flight=report_load['in_flight'], enabled=SPECULATE_ENABLED)
+
+speculative_drafts = SpeculativeDrafts()
+
+def speculation_owner():
+    """Utilisateur d'une demande, pour les plafonds des brouillons : adresse IP du client"""
+    return request.remote_addr or 'local'
+
+@app.route('/api/generate-report/speculate', methods=['POST', 'DELETE'])
+def speculate_report():
+    """Brouillon spéculatif : l'éditeur envoie des instantanés débouncés des notes (même corps que
+    /api/generate-report, plus draft_id) ; la génération finale identique est alors immédiate"""
+    if not SPECULATE_ENABLED:
+        return jsonify({'error': 'Génération spéculative désactivée'}), 403
+    data = request.get_json(silent=True) or {}
+    draft_id = str(data.get('draft_id') or 'default')[:64]
+    if request.method == 'DELETE':
+        return jsonify({'cancelled': speculative_drafts.cancel(speculation_owner(), draft_id)})
+    try:
+        req = prepare_report_request(data)
+        return jsonify(speculative_drafts.submit(speculation_owner(), draft_id, req))
+    except GenerationError as e:
+        return jsonify(dict(e.details, error=e.message)), e.status
+    except Exception as e:
+        return jsonify({'error': f'Erreur lors du brouillon spéculatif: {str(e)}'}), 500
+
+# ============================================
+# FILE DE TRAVAUX ASYNCHRONES (SQLite WAL)
+# ============================================
+
+class JobQueue:
+    """File de travaux persistante partageable entre processus (SQLite en mode WAL).
+
+    Un travail réclamé par un worker porte un bail (lease_until), renouvelé tant que
+    le travail s'exécute : si le processus meurt, le travail redevient disponible
+    à l'expiration du bail.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def _connect(self):
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                    conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                        id TEXT PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        payload TEXT NOT NULL,
+                        result TEXT,
+                        error TEXT,
+                        error_status INTEGER,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        worker TEXT,
+                        lease_until REAL,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )''')
+                    conn.execute('CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)')
+                    conn.close()
+                    self._initialized = True
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, kind, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('INSERT INTO jobs (id, kind, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                         (job_id, kind, 'queued', json.dumps(payload, ensure_ascii=False), now, now))
+        finally:
+            conn.close()
+        self.wakeup.set()
+        return job_id
+
+    def claim(self, worker):
+        """Réserve le plus ancien travail disponible (en attente ou bail expiré)"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY created_at LIMIT 1", (now,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            if row['attempts'] >= JOB_MAX_ATTEMPTS:
+                # Travail repris trop souvent après un arrêt brutal : abandon
+                conn.execute("UPDATE jobs SET status = 'failed', error = ?, error_status = 500, updated_at = ? WHERE id = ?",
+                             ('Travail abandonné après plusieurs interruptions', now, row['id']))
+                conn.execute('COMMIT')
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                         (worker, now + JOB_LEASE_SECONDS, now, row['id']))
+            conn.execute('COMMIT')
+            return {'id': row['id'], 'kind': row['kind'], 'payload': json.loads(row['payload'])}
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def renew(self, job_id, worker):
+        """Prolonge le bail d'un travail en cours : False s'il a été annulé ou repris entre-temps"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                (now + JOB_LEASE_SECONDS, now, job_id, worker))
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def finish(self, job_id, worker, result=None, error=None, error_status=None):
+        """Enregistre l'issue d'un travail, sauf s'il a été annulé ou repris entre-temps"""
+        status = 'failed' if error is not None else 'done'
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, error_status = ?, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND worker = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, error_status, time.time(), job_id, worker))
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def cancel(self, job_id):
+        """Annule un travail en attente ou en cours : retourne le statut résultant (ou None)"""
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND status IN ('queued', 'running')", (time.time(), job_id))
+            row = conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return row['status'] if row else None
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = {
+                'id': row['id'],
+                'kind': row['kind'],
+                'status': row['status'],
+                'attempts': row['attempts'],
+                'created_at': row['created_at'],
+                'updated_at': row['updated_at'],
+            }
+            if row['status'] == 'queued':
+                job['position'] = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?",
+                    (row['created_at'],)).fetchone()[0] + 1
+            if row['result'] is not None:
+                job['result'] = json.loads(row['result'])
+            if row['error'] is not None:
+                job['error'] = row['error']
+                job['error_status'] = row['error_status']
+            return job
+        finally:
+            conn.close()
+
+    def purge(self, older_than):
+        """Supprime les travaux terminés plus anciens que older_than (secondes)"""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < ?",
+                         (time.time() - older_than,))
+        finally:
+            conn.close()
+
+    def stats(self):
+        if not self._initialized and not os.path.exists(self.path):
+            return {'workers': len(_job_workers)}
+        conn = self._connect()
+        try:
+            counts = {row['status']: row['n'] for row in
+                      conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status')}
+        finally:
+            conn.close()
+        counts['workers'] = len(_job_workers)
+        return counts
+
+job_queue = JobQueue(JOBS_DB_PATH)
+_job_workers = []
+_job_workers_lock = threading.Lock()
+
+def run_report_job(payload, scope=None, job_id=None):
+    """Exécute un travail 'report' : même traitement que /api/generate-report
+    (scope : portée annulée avec le travail)"""
+    req = prepare_report_request(payload)
+    # Position du travail dans la file Ollama, consultable via GET /api/jobs/<id>
+    req['queue_tag'] = job_id
+    report, cached = generate_report_text(req, scope)
+    return report_response_body(req, report, cached)
+
+JOB_HANDLERS = {
+    'report': run_report_job,
+}
+
+def job_heartbeat(job_id, worker, scope, stop):
+    """Renouvelle le bail d'un travail jusqu'à stop ; annule scope si le travail a été annulé ou repris"""
+    while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+        try:
+            renewed = job_queue.renew(job_id, worker)
+        except sqlite3.Error as e:
+            logger.warning(f"Renouvellement du bail du travail {job_id} impossible: {e}")
+            continue
+        if not renewed:
+            logger.info(f"Travail {job_id} annulé ou repris : génération interrompue")
+            scope.cancel()
+            return
+
+def job_worker_loop(worker):
+    """Boucle d'un worker : réserve, exécute et enregistre les travaux de la file"""
+    last_purge = 0
+    while True:
+        try:
+            job = job_queue.claim(worker)
+        except sqlite3.Error as e:
+            logger.error(f"File de travaux indisponible: {e}")
+            time.sleep(JOB_POLL_INTERVAL * 10)
+            continue
+        
+        if job is None:
+            if time.time() - last_purge > 3600:
+                try:
+                    job_queue.purge(JOB_RETENTION)
+                except sqlite3.Error as e:
+                    # Base verrouillée ou indisponible : nouvelle tentative au prochain passage
+                    logger.error(f"Purge de la file de travaux impossible: {e}")
+                last_purge = time.time()
+            job_queue.wakeup.wait(JOB_POLL_INTERVAL)
+            job_queue.wakeup.clear()
+            continue
+        
+        logger.info(f"Travail {job['id']} ({job['kind']}) pris en charge par {worker}")
+        # Bail renouvelé pendant l'exécution (files d'attente, map-reduce...) ; DELETE coupe les appels amont
+        deadline = time.monotonic() + REQUEST_TIMEOUTS['job'] if REQUEST_TIMEOUTS['job'] > 0 else None
+        scope = CancelScope(deadline=deadline)
+        stop = threading.Event()
+        threading.Thread(target=job_heartbeat, args=(job['id'], worker, scope, stop), daemon=True,
+                         name=f'job-heartbeat-{worker}').start()
+        try:
+            result = JOB_HANDLERS[job['kind']](job['payload'], scope, job['id'])
+            stored = job_queue.finish(job['id'], worker, result=result)
+        except GenerationError as e:
+            stored = job_queue.finish(job['id'], worker, error=e.message, error_status=e.status)
+        except Exception as e:
+            logger.error(f"Erreur travail {job['id']}: {e}")
+            stored = job_queue.finish(job['id'], worker, error=f'Erreur lors de la génération du compte rendu: {str(e)}', error_status=500)
+        finally:
+            stop.set()
+        if not stored:
+            logger.info(f"Travail {job['id']} annulé ou repris : résultat ignoré")
+
+def ensure_job_workers():
+    """Démarre le pool de workers de ce processus (une seule fois)"""
+    if _job_workers or JOB_WORKERS <= 0:
+        return
+    with _job_workers_lock:
+        if _job_workers:
+            return
+        for i in range(JOB_WORKERS):
+            worker = f"{socket.gethostname()}:{os.getpid()}:{i}"
+            thread = threading.Thread(target=job_worker_loop, args=(worker,), daemon=True, name=f'job-worker-{i}')
+            thread.start()
+            _job_workers.append(thread)
+        logger.info(f"{JOB_WORKERS} workers de travaux démarrés ({JOBS_DB_PATH})")
+
+@app.before_request
+def start_background_workers():
+    # Démarrage dans le processus qui sert les requêtes (pas dans le superviseur du reloader)
+    ensure_job_workers()
+    provider_router.ensure_probes()
+
+@app.route('/api/jobs/report', methods=['POST'])
+def create_report_job():
+    """Met en file une génération de compte rendu et retourne immédiatement son identifiant"""
+    data = request.get_json(silent=True)
+    try:
+        # Validation immédiate pour renvoyer les erreurs de saisie sans attendre un worker
+        prepare_report_request(data)
+    except GenerationError as e:
+        return jsonify(dict(e.details, error=e.message)), e.status
+    
+    job_id = job_queue.enqueue('report', data)
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202, {'Location': f'/api/jobs/{job_id}'}
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Statut d'un travail (et son résultat une fois terminé)"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Travail introuvable'}), 404
+    if job['status'] == 'running':
+        # En attente d'un créneau Ollama (worker de ce processus) : rang dans la file
+        position = ollama_scheduler.tag_position(job_id)
+        if position:
+            job['queue_position'] = position
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Annule un travail en attente ou en cours"""
+    status = job_queue.cancel(job_id)
+    if status is None:
+        return jsonify({'error': 'Travail introuvable'}), 404
+    if status != 'cancelled':
+        return jsonify({'error': f'Travail déjà terminé ({status})', 'status': status}), 409
+    return jsonify({'job_id': job_id, 'status': status})
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Compteurs de fonctionnement (caches, files d'attente, providers)"""
+    return jsonify({
+        'report_cache': report_cache.stats(),
+        'diagram_cache': diagram_cache.stats(),
+        'jobs': job_queue.stats(),
+        'time_to_first_token': ttft_tracker.stats(),
+        'hedging': dict(hedge_counters),
+        'routing': provider_router.stats(),
+        'rate_limits': {provider: limiter.stats() for provider, limiter in list(_rate_limiters.items())},
+        'circuit_breakers': {provider: breaker.stats() for provider, breaker in list(_circuit_breakers.items())},
+        'retries': dict(retry_counters),
+        'token_budget': token_budget.stats(),
+        'prompt_cache': prompt_cache_tracker.stats(),
+        'cancellations': dict(cancel_counters),
+        'speculation': speculative_drafts.stats(),
+        'ollama_scheduler': ollama_scheduler.stats(),
+        'coalescing': {
+            'reports': report_flight.stats(),
+            'diagrams': diagram_flight.stats(),
+        },
+    })
+
 def extract_toc_from_html(html_content):
     """Extrait la table des matières depuis le HTML (titres H1 et H2)"""
     toc = []
@@ -4512,9 +8532,10 @@ def generate_pdf():
         
         story.append(Spacer(1, 20))
         
-        # 4. Table des matières (extraite du HTML du rapport)
+        # 4. Table des matières (arbre structuré s'il est fourni, sinon extraite du HTML du rapport)
         html_report = report_data.get('generated', '')
-        toc_entries = extract_toc_from_html(html_report)
+        report_tree = export_report_tree(report_data)
+        toc_entries = report_tree_toc(report_tree) if report_tree else extract_toc_from_html(html_report)
         
         if toc_entries:
             # TOC adaptive : ajuster taille police si trop d'entrées
@@ -4588,6 +8609,11 @@ def generate_pdf():
                 print("📊 Diagramme ignoré - Utilisez la section Images pour ajouter le diagramme manuellement")
                 pass
             
+            elif block == 'report' and report_tree:
+                # Compte rendu structuré : rendu direct de l'arbre, sans passer par le HTML
+                story.extend(report_tree_pdf_flowables(report_tree, styles, normal_style,
+                                                       pdf_config.get('theme', {}).get('primary', '#0C4A45'), available_width))
+                story.append(Spacer(1, 12))
             elif block == 'report' and report_data.get('generated'):
                 # Rendu propre du HTML de l'éditeur dans le PDF
                 html_input = report_data.get('generated', '')
@@ -5223,9 +9249,10 @@ def generate_docx():
         doc.add_paragraph()  # Espace
         doc.add_paragraph()  # Espace supplémentaire
         
-        # 5. Table des matières
+        # 5. Table des matières (arbre structuré s'il est fourni, sinon extraite du HTML du rapport)
         html_report = report_data.get('generated', '')
-        toc_entries = extract_toc_from_html(html_report)
+        report_tree = export_report_tree(report_data)
+        toc_entries = report_tree_toc(report_tree) if report_tree else extract_toc_from_html(html_report)
         
         if toc_entries:
             # Titre "Table des matières"
@@ -5257,7 +9284,10 @@ def generate_docx():
         order = pdf_config.get('order', ['diagram', 'report', 'images'])
         
         for block in order:
-            if block == 'report' and report_data.get('generated'):
+            if block == 'report' and report_tree:
+                # Compte rendu structuré : rendu direct de l'arbre, sans passer par le HTML
+                add_report_tree_docx(doc, report_tree, primary_color, primary_hex)
+            elif block == 'report' and report_data.get('generated'):
                 html_input = report_data.get('generated', '')
                 
                 # Nettoyer les carrés Unicode (même logique que PDF)
@@ -6038,7 +10068,6 @@ def update_env_file(updates):
 
 if __name__ == '__main__':
     import webbrowser
-    import threading
     
     host = os.getenv('HOST', '127.0.0.1')
     port = int(os.getenv('PORT', 5173))
@@ -6054,6 +10083,9 @@ if __name__ == '__main__':
         webbrowser.open(url)
     
     threading.Thread(target=open_browser, daemon=True).start()
+    # Préchauffer les connexions vers les providers configurés et charger les modèles Ollama
+    warm_http_sessions(background=True)
+    preload_ollama_models(background=True)
     run_kwargs = {'host': host, 'port': port, 'debug': debug}
     if debug and os.name == 'nt':
         print("ℹ️ Windows detected: disabling watchdog reloader (use_reloader=False) to avoid Python 3.13 issue")
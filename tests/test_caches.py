@@ -0,0 +1,113 @@
+"""Caches des comptes rendus (disque, TTL et LRU) et des diagrammes (mémoire, persistance)"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class ReportCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def test_round_trip_and_counters(self):
+        cache = app.ReportCache(self.directory, 10 ** 6, 60)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', {'sections': []})
+        self.assertEqual(cache.get('a'), {'sections': []})
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['writes'], stats['entries']), (1, 1, 1, 1))
+
+    def test_expired_entry_is_removed(self):
+        cache = app.ReportCache(self.directory, 10 ** 6, 60)
+        cache.put('a', 'rapport')
+        with open(cache._path('a'), 'wb') as f:
+            f.write(zlib.compress(json.dumps({'created': time.time() - 61, 'value': 'rapport'}).encode('utf-8')))
+        self.assertFalse(cache.peek('a'))
+        self.assertIsNone(cache.get('a'))
+        self.assertFalse(os.path.exists(cache._path('a')))
+        self.assertEqual(cache.stats()['expired'], 1)
+
+    def test_unreadable_entry_is_a_miss(self):
+        cache = app.ReportCache(self.directory, 10 ** 6, 60)
+        with open(cache._path('a'), 'wb') as f:
+            f.write(b'pas du zlib')
+        self.assertIsNone(cache.get('a'))
+        self.assertFalse(os.path.exists(cache._path('a')))
+
+    def test_least_recently_read_entry_is_evicted(self):
+        cache = app.ReportCache(self.directory, 10 ** 6, 60)
+        value = os.urandom(400).hex()
+        cache.put('old', value)
+        cache.put('recent', value)
+        entry_size = os.path.getsize(cache._path('old'))
+        past = time.time() - 100
+        os.utime(cache._path('old'), (past, past))
+        os.utime(cache._path('recent'), (past, past))
+        # Lecture : 'old' redevient l'entrée la plus récemment utilisée
+        self.assertIsNotNone(cache.get('old'))
+
+        cache.max_bytes = entry_size * 2 + entry_size // 2
+        cache.put('new', value)
+        self.assertTrue(cache.peek('old'))
+        self.assertFalse(cache.peek('recent'))
+        self.assertTrue(cache.peek('new'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_peek_does_not_count_or_touch(self):
+        cache = app.ReportCache(self.directory, 10 ** 6, 60)
+        self.assertFalse(cache.peek('a'))
+        cache.put('a', 'rapport')
+        past = time.time() - 100
+        os.utime(cache._path('a'), (past, past))
+        self.assertTrue(cache.peek('a'))
+        self.assertEqual(os.path.getmtime(cache._path('a')), past)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 0))
+
+
+class DiagramCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.path = os.path.join(self.directory, 'diagrams.json')
+
+    def test_lru_eviction(self):
+        cache = app.DiagramCache(2)
+        cache.put('a', 'graph TD')
+        cache.put('b', 'graph LR')
+        cache.get('a')
+        cache.put('c', 'sequenceDiagram')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'graph TD')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_survive_restart(self):
+        cache = app.DiagramCache(2, self.path)
+        cache.put('a', 'graph TD')
+        cache.put('b', 'graph LR')
+        reloaded = app.DiagramCache(1, self.path)
+        self.assertIsNone(reloaded.get('a'))
+        self.assertEqual(reloaded.get('b'), 'graph LR')
+
+    def test_unexpected_file_content_starts_empty(self):
+        for content in ('{"a": 1}', '[1, 2]', 'pas du json'):
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            cache = app.DiagramCache(10, self.path)
+            self.assertEqual(cache.stats()['entries'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""Coalescence des générations identiques (SingleFlight) : appel partagé, erreurs et annulation"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = app.SingleFlight()
+
+    def test_concurrent_callers_share_one_call(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fn(scope):
+            calls.append(scope)
+            started.set()
+            release.wait(5)
+            return 'rapport'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.flight.do('k', fn)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        followers = [threading.Thread(target=lambda: results.append(self.flight.do('k', fn))) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['rapport'] * 4)
+        self.assertEqual(self.flight.stats(), {'upstream_calls': 1, 'saved_calls': 3, 'in_flight': 0})
+
+    def test_error_is_shared_then_key_is_released(self):
+        def failing(scope):
+            raise app.GenerationError('Provider indisponible', 503)
+
+        with self.assertRaises(app.GenerationError) as ctx:
+            self.flight.do('k', failing)
+        self.assertEqual(ctx.exception.status, 503)
+        self.assertEqual(self.flight.do('k', lambda scope: 'ok'), 'ok')
+
+    def test_shared_scope_cancelled_only_when_every_caller_left(self):
+        started = threading.Event()
+        shared = {}
+
+        def fn(scope):
+            shared['scope'] = scope
+            started.set()
+            scope.event.wait(5)
+            scope.check()
+
+        first, second = app.CancelScope(), app.CancelScope()
+        errors = []
+
+        def call(scope):
+            try:
+                self.flight.do('k', fn, scope)
+            except app.GenerationCancelled as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call, args=(first,))]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        threads.append(threading.Thread(target=call, args=(second,)))
+        threads[1].start()
+        time.sleep(0.05)
+
+        first.cancel()
+        time.sleep(0.05)
+        self.assertFalse(shared['scope'].cancelled)
+        second.cancel()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(shared['scope'].cancelled)
+        self.assertEqual(len(errors), 2)
+
+    def test_stream_replays_events_to_late_subscriber(self):
+        gate = threading.Event()
+
+        def produce(scope):
+            yield 'a'
+            gate.wait(5)
+            yield 'b'
+            return 'final'
+
+        first = self.flight.stream('k', produce)
+        self.assertEqual(next(first), 'a')
+        second = self.flight.stream('k', produce)
+        gate.set()
+
+        def drain(events):
+            received = []
+            while True:
+                try:
+                    received.append(next(events))
+                except StopIteration as stop:
+                    return received, stop.value
+
+        self.assertEqual(drain(first), (['b'], 'final'))
+        self.assertEqual(drain(second), (['a', 'b'], 'final'))
+        self.assertEqual(self.flight.stats()['upstream_calls'], 1)
+
+    def test_stream_follower_of_plain_call_gets_final_event(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def fn(scope):
+            started.set()
+            release.wait(5)
+            return 'rapport'
+
+        result = []
+        leader = threading.Thread(target=lambda: result.append(self.flight.do('k', fn)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        events = self.flight.stream('k', lambda scope: iter(()), final_event=lambda report: f'done:{report}')
+        release.set()
+        self.assertEqual(list(events), ['done:rapport'])
+        leader.join(5)
+        self.assertEqual(result, ['rapport'])
+
+
+if __name__ == '__main__':
+    unittest.main()
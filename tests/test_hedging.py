@@ -0,0 +1,63 @@
+"""Hedging d'une demande en map-reduce : la requête de secours reprend le condensé des notes"""
+
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class HedgedMapReduceTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(app.config, {
+            'active_provider': 'mistral',
+            'mistral_base_url': 'http://mistral.test', 'mistral_api_key': 'k1',
+            'openai_base_url': 'http://openai.test', 'openai_api_key': 'k2',
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name, value in (('REPORT_CACHE_ENABLED', False), ('ROUTING_ENABLED', False),
+                            ('HEDGE_PROVIDERS', ['openai']), ('SPECULATE_ENABLED', False)):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_secondary_request_uses_condensed_notes(self):
+        sent = {}
+        lock = threading.Lock()
+
+        def provider_stream(req, scope=None, on_first_token=None):
+            with lock:
+                sent[req['provider']] = req['payload']['messages']
+            if req['provider'] == 'mistral':
+                # Provider principal lent : le secours part et l'emporte
+                scope.event.wait(5)
+                raise app.GenerationCancelled()
+            return '# Compte rendu\n\nContenu'
+
+        notes = '\n\n'.join(f"Point {i} : " + 'détail ' * 200 for i in range(60))
+        self.assertGreater(len(notes), app.MAX_NOTES_LENGTH)
+        req = app.prepare_report_request({'notes': notes, 'template': 'client_formel', 'hedge': True})
+
+        with mock.patch.object(app, 'call_report_provider', return_value='condensé du morceau'), \
+                mock.patch.object(app, 'call_report_provider_stream', side_effect=provider_stream), \
+                mock.patch.object(app, 'hedge_delay', return_value=0.05):
+            report, cached = app.generate_report_text(req)
+
+        self.assertFalse(cached)
+        self.assertIn('Contenu', report)
+        self.assertEqual(set(sent), {'mistral', 'openai'})
+        self.assertEqual(sent['openai'], sent['mistral'])
+        user_prompt = sent['openai'][1]['content']
+        self.assertIn('condensé du morceau', user_prompt)
+        self.assertNotIn(notes[:500], user_prompt)
+        self.assertLess(len(user_prompt), app.MAX_NOTES_LENGTH)
+
+
+if __name__ == '__main__':
+    unittest.main()
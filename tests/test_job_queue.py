@@ -0,0 +1,93 @@
+"""File de travaux SQLite : bail, renouvellement, reprise après un arrêt brutal et annulation"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.queue = app.JobQueue(os.path.join(directory, 'jobs.db'))
+
+    def expire_leases(self):
+        """Bail déjà expiré à la réservation : simule un worker mort"""
+        return mock.patch.object(app, 'JOB_LEASE_SECONDS', -1)
+
+    def test_jobs_are_claimed_in_order_once(self):
+        first = self.queue.enqueue('report', {'notes': 'a'})
+        second = self.queue.enqueue('report', {'notes': 'b'})
+        self.assertEqual(self.queue.get(second)['position'], 2)
+
+        job = self.queue.claim('w1')
+        self.assertEqual((job['id'], job['payload']), (first, {'notes': 'a'}))
+        self.assertEqual(self.queue.claim('w2')['id'], second)
+        self.assertIsNone(self.queue.claim('w3'))
+
+    def test_finish_records_result(self):
+        job_id = self.queue.enqueue('report', {})
+        self.queue.claim('w1')
+        self.assertTrue(self.queue.finish(job_id, 'w1', result={'report': 'ok'}))
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['result']), ('done', {'report': 'ok'}))
+
+    def test_expired_lease_is_requeued_to_another_worker(self):
+        job_id = self.queue.enqueue('report', {})
+        with self.expire_leases():
+            self.assertEqual(self.queue.claim('w1')['id'], job_id)
+        job = self.queue.claim('w2')
+        self.assertEqual(job['id'], job_id)
+        self.assertEqual(self.queue.get(job_id)['attempts'], 2)
+
+        # Le premier worker a perdu le travail : ni renouvellement ni résultat
+        self.assertFalse(self.queue.renew(job_id, 'w1'))
+        self.assertFalse(self.queue.finish(job_id, 'w1', result={'report': 'périmé'}))
+        self.assertTrue(self.queue.finish(job_id, 'w2', result={'report': 'ok'}))
+
+    def test_renewed_lease_is_not_requeued(self):
+        job_id = self.queue.enqueue('report', {})
+        with self.expire_leases():
+            self.queue.claim('w1')
+        self.assertTrue(self.queue.renew(job_id, 'w1'))
+        self.assertIsNone(self.queue.claim('w2'))
+
+    def test_job_abandoned_after_max_attempts(self):
+        job_id = self.queue.enqueue('report', {})
+        with self.expire_leases():
+            for attempt in range(app.JOB_MAX_ATTEMPTS):
+                self.assertEqual(self.queue.claim(f'w{attempt}')['id'], job_id)
+        self.assertIsNone(self.queue.claim('w-last'))
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['error_status']), ('failed', 500))
+
+    def test_cancelled_job_cannot_be_renewed_or_finished(self):
+        job_id = self.queue.enqueue('report', {})
+        self.queue.claim('w1')
+        self.assertEqual(self.queue.cancel(job_id), 'cancelled')
+        self.assertFalse(self.queue.renew(job_id, 'w1'))
+        self.assertFalse(self.queue.finish(job_id, 'w1', result={}))
+        self.assertEqual(self.queue.get(job_id)['status'], 'cancelled')
+
+    def test_heartbeat_cancels_scope_when_job_is_lost(self):
+        job_id = self.queue.enqueue('report', {})
+        self.queue.claim('w1')
+        self.queue.cancel(job_id)
+        scope = app.CancelScope()
+        stop = threading.Event()
+        with mock.patch.object(app, 'job_queue', self.queue), mock.patch.object(app, 'JOB_HEARTBEAT_INTERVAL', 0.01):
+            app.job_heartbeat(job_id, 'w1', scope, stop)
+        self.assertTrue(scope.cancelled)
+
+
+if __name__ == '__main__':
+    unittest.main()
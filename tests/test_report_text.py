@@ -0,0 +1,101 @@
+"""Traitement du texte des comptes rendus : réinsertion d'une section, séquences d'arrêt et marqueur de fin"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+REPORT = """# Compte rendu
+
+## Participants
+
+- Alice
+- Bob
+
+## Décisions
+
+### Technique
+
+Migration validée.
+
+## Actions
+
+- Bob : livrer la v2
+"""
+
+
+class SectionSpliceTest(unittest.TestCase):
+
+    def regenerate(self, heading, answer):
+        start, end, _, heading_line = app.find_markdown_section(REPORT, heading)
+        req = {'report': REPORT, 'section_bounds': (start, end), 'heading_line': heading_line}
+        with mock.patch.object(app, 'call_report_provider', return_value=answer):
+            return app.regenerate_report_section(req)
+
+    def test_section_extends_to_next_heading_of_same_level(self):
+        start, end, level, heading_line = app.find_markdown_section(REPORT, 'Décisions')
+        self.assertEqual((level, heading_line), (2, '## Décisions'))
+        self.assertTrue(REPORT[start:end].startswith('## Décisions'))
+        self.assertIn('Migration validée.', REPORT[start:end])
+        self.assertTrue(REPORT[end:].startswith('## Actions'))
+        self.assertIsNone(app.find_markdown_section(REPORT, 'Risques'))
+
+    def test_only_target_section_is_replaced(self):
+        answer = "Voici la section :\n```markdown\n## Décisions\n\nReport de la migration.\n```"
+        report, section = self.regenerate('## Décisions', answer)
+        self.assertEqual(section, '## Décisions\n\nReport de la migration.')
+        self.assertIn('## Décisions\n\nReport de la migration.\n\n## Actions', report)
+        self.assertNotIn('Migration validée.', report)
+        self.assertTrue(report.startswith(REPORT[:REPORT.index('## Décisions')]))
+        self.assertTrue(report.endswith('## Actions\n\n- Bob : livrer la v2\n'))
+
+    def test_heading_added_when_missing(self):
+        report, section = self.regenerate('Actions', '- Alice : relancer le client')
+        self.assertEqual(section, '## Actions\n\n- Alice : relancer le client')
+        self.assertTrue(report.endswith('## Actions\n\n- Alice : relancer le client\n'))
+
+
+class StopSequenceTest(unittest.TestCase):
+
+    def test_cut_at_first_stop(self):
+        self.assertEqual(app.cut_at_stop('# Titre\nTexte<<FIN>>reliquat', [app.REPORT_END_MARKER]), '# Titre\nTexte')
+        self.assertEqual(app.cut_at_stop('a STOP b <<FIN>> c', ['<<FIN>>', 'STOP']), 'a ')
+        self.assertEqual(app.cut_at_stop('sans arrêt', ['<<FIN>>']), 'sans arrêt')
+        self.assertEqual(app.cut_at_stop('texte', None), 'texte')
+
+
+class ReportStreamCleanerTest(unittest.TestCase):
+
+    def clean(self, fragments):
+        cleaner = app.ReportStreamCleaner()
+        published = ''.join(cleaner.feed(fragment) for fragment in fragments)
+        tail, report = cleaner.finish()
+        return published + tail, report, cleaner
+
+    def test_preamble_dropped_and_marker_split_across_fragments(self):
+        published, report, cleaner = self.clean(['Bien sûr !\n', '## Titre\nCorps', ' du rapport<<F', 'IN>> ignoré'])
+        self.assertEqual(report, '## Titre\nCorps du rapport')
+        self.assertEqual(published, '## Titre\nCorps du rapport')
+        self.assertTrue(cleaner.done)
+
+    def test_partial_marker_is_held_back(self):
+        cleaner = app.ReportStreamCleaner()
+        self.assertEqual(cleaner.feed('## Titre\nTexte <'), '## Titre\nTexte ')
+        self.assertEqual(cleaner.feed('pas un marqueur'), '<pas un marqueur')
+
+    def test_fenced_block_closes_report(self):
+        _, report, cleaner = self.clean(['Voici :\n```markdown\n', '## Titre\nTexte\n``', '`\nNote finale'])
+        self.assertEqual(report, '## Titre\nTexte')
+        self.assertTrue(cleaner.done)
+
+    def test_marker_before_any_heading_keeps_text(self):
+        _, report, _ = self.clean(['Rapport sans titre', '<<FIN>> suite'])
+        self.assertEqual(report, 'Rapport sans titre')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Limiteur de débit, disjoncteur et routage des providers"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class ProviderRateLimiterTest(unittest.TestCase):
+
+    def test_requests_per_minute(self):
+        limiter = app.ProviderRateLimiter('test', rpm=2)
+        deadline = time.monotonic() + 5
+        limiter.acquire(1, deadline)
+        limiter.acquire(1, deadline)
+        # Troisième demande : 30 s d'attente, au-delà de l'échéance
+        with self.assertRaises(app.GenerationError) as ctx:
+            limiter.acquire(1, deadline)
+        self.assertEqual(ctx.exception.status, 429)
+        self.assertEqual(limiter.stats()['timeouts'], 1)
+
+    def test_tokens_per_minute_refill(self):
+        limiter = app.ProviderRateLimiter('test', tpm=6000)
+        limiter.acquire(6000, time.monotonic() + 1)
+        started = time.monotonic()
+        # 100 jetons/s : 10 jetons disponibles en 0,1 s
+        limiter.acquire(10, time.monotonic() + 5)
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(limiter.stats()['waited'], 1)
+
+    def test_full_queue_rejects(self):
+        limiter = app.ProviderRateLimiter('test', rpm=1)
+        limiter.acquire(1, time.monotonic() + 1)
+        with mock.patch.object(app, 'RATE_LIMIT_QUEUE_SIZE', 0):
+            with self.assertRaises(app.GenerationError) as ctx:
+                limiter.acquire(1, time.monotonic() + 120)
+        self.assertEqual(ctx.exception.status, 429)
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+    def test_block_for_retry_after(self):
+        limiter = app.ProviderRateLimiter('test')
+        limiter.block_for(60)
+        with self.assertRaises(app.GenerationError):
+            limiter.acquire(1, time.monotonic() + 1)
+
+    def test_cancelled_waiter_leaves_queue(self):
+        limiter = app.ProviderRateLimiter('test', rpm=1)
+        limiter.acquire(1, time.monotonic() + 1)
+        scope = app.CancelScope()
+        errors = []
+
+        def wait():
+            try:
+                limiter.acquire(1, time.monotonic() + 120, scope)
+            except app.GenerationError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(limiter.stats()['queue_depth'], 1)
+        scope.cancel()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertIsInstance(errors[0], app.GenerationCancelled)
+        self.assertEqual(limiter.stats()['queue_depth'], 0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in (('CIRCUIT_FAILURE_THRESHOLD', 2), ('CIRCUIT_RESET_TIMEOUT', 0.05)):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.breaker = app.CircuitBreaker('test')
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        with self.assertRaises(app.GenerationError) as ctx:
+            self.breaker.before_call()
+        self.assertEqual(ctx.exception.status, 503)
+
+    def test_half_open_allows_single_probe(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(0.06)
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, 'half_open')
+        with self.assertRaises(app.GenerationError):
+            self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.before_call()
+
+    def test_failed_probe_reopens(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(0.06)
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(self.breaker.stats()['opened'], 2)
+
+    def test_release_frees_probe_without_verdict(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(0.06)
+        self.breaker.before_call()
+        self.breaker.release()
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, 'half_open')
+
+
+class ProviderRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = app.ProviderRouter()
+
+    def observe_error(self, error):
+        with self.assertRaises(type(error)):
+            with self.router.observe('mistral', 'm'):
+                raise error
+
+    def test_client_side_errors_are_not_recorded(self):
+        self.observe_error(app.GenerationCancelled())
+        self.observe_error(app.DeadlineExceeded())
+        self.observe_error(app.GenerationError('Clé API invalide', 401))
+        self.assertNotIn(('mistral', 'm'), self.router.models)
+
+    def test_provider_failures_are_recorded(self):
+        self.observe_error(app.GenerationError('Limite de débit', 429))
+        self.observe_error(app.GenerationError('Provider indisponible', 503))
+        self.observe_error(app.requests.exceptions.ConnectionError())
+        stats = self.router.models[('mistral', 'm')]
+        self.assertEqual((stats['calls'], stats['errors']), (3, 3))
+        self.assertGreater(stats['error_rate'], app.ROUTER_MAX_ERROR_RATE)
+        self.assertFalse(self.router.is_healthy('mistral'))
+
+    def test_score_weights_models_by_calls(self):
+        for _ in range(3):
+            self.router.record('mistral', 'small', 1.0, ok=True)
+        self.router.record('mistral', 'large', 5.0, ok=True)
+        self.assertAlmostEqual(self.router.score('mistral'), 2.0)
+        self.assertEqual(self.router.score('openai'), 0.0)
+
+    def test_successful_probes_restore_routed_away_provider(self):
+        for _ in range(3):
+            self.router.record('mistral', 'm', 1.0, ok=False)
+        self.assertFalse(self.router.is_healthy('mistral'))
+
+        response = mock.Mock()
+        session = mock.Mock()
+        session.get.return_value = response
+        with mock.patch.dict(app.config, {'mistral_base_url': 'http://mistral.test', 'mistral_api_key': 'k'}), \
+                mock.patch.object(app, 'get_http_session', return_value=session):
+            for _ in range(3):
+                self.router.probe('mistral')
+        self.assertTrue(self.router.health['mistral']['ok'])
+        self.assertTrue(self.router.is_healthy('mistral'))
+
+    def test_failed_probe_marks_provider_unhealthy(self):
+        session = mock.Mock()
+        session.get.side_effect = app.requests.exceptions.ConnectionError('refusé')
+        with mock.patch.dict(app.config, {'mistral_base_url': 'http://mistral.test', 'mistral_api_key': 'k'}), \
+                mock.patch.object(app, 'get_http_session', return_value=session):
+            self.router.probe('mistral')
+        self.assertFalse(self.router.is_healthy('mistral'))
+
+
+if __name__ == '__main__':
+    unittest.main()